@@ -25,7 +25,11 @@
 import re
 import logging
 import datetime
+import fnmatch
 import functools
+import json
+import os
+import queue
 import time
 import threading
 import lib.db
@@ -65,26 +69,106 @@ class Database(SmartPlugin):
       '3' : ["CREATE UNIQUE INDEX {log}_{item}_id_time ON {log} (item_id, time);", "DROP INDEX {log}_{item}_id_time;"],
       '4' : ["CREATE INDEX {log}_{item}_id_changed ON {log} (item_id, changed);", "DROP INDEX {log}_{item}_id_changed;"],
       '5' : ["CREATE UNIQUE INDEX {item}_id ON {item} (id);", "DROP INDEX {item}_id;"],
-      '6' : ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"]
+      '6' : ["CREATE INDEX {item}_name ON {item} (name);", "DROP INDEX {item}_name;"],
+      '7' : ["CREATE TABLE {log_minute} (item_id INTEGER, time BIGINT, duration BIGINT, val_sum DOUBLE PRECISION, val_min REAL, val_max REAL, bool_sum DOUBLE PRECISION);", "DROP TABLE {log_minute};"],
+      '8' : ["CREATE UNIQUE INDEX {log_minute}_id_time ON {log_minute} (item_id, time);", "DROP INDEX {log_minute}_id_time;"],
+      '9' : ["CREATE TABLE {log_hour} (item_id INTEGER, time BIGINT, duration BIGINT, val_sum DOUBLE PRECISION, val_min REAL, val_max REAL, bool_sum DOUBLE PRECISION);", "DROP TABLE {log_hour};"],
+      '10' : ["CREATE UNIQUE INDEX {log_hour}_id_time ON {log_hour} (item_id, time);", "DROP INDEX {log_hour}_id_time;"],
+      '11' : ["CREATE TABLE {log_day} (item_id INTEGER, time BIGINT, duration BIGINT, val_sum DOUBLE PRECISION, val_min REAL, val_max REAL, bool_sum DOUBLE PRECISION);", "DROP TABLE {log_day};"],
+      '12' : ["CREATE UNIQUE INDEX {log_day}_id_time ON {log_day} (item_id, time);", "DROP INDEX {log_day}_id_time;"]
     }
 
-    def __init__(self, smarthome, driver, connect, prefix="", cycle=60):
+    # SQL dialects of drivers supporting bulk upserts
+    _dialects = {
+      'sqlite3'         : 'sqlite',
+      'pymysql'         : 'mysql',
+      'MySQLdb'         : 'mysql',
+      'mysql.connector' : 'mysql',
+      'psycopg2'        : 'pgsql',
+      'pg8000'          : 'pgsql'
+    }
+
+    # Bulk upsert queries per dialect: {values} = list of value tuples
+    _upsert = {
+      'sqlite' : "INSERT OR REPLACE INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES {values};",
+      'mysql'  : "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES {values} ON DUPLICATE KEY UPDATE duration = VALUES(duration), val_str = VALUES(val_str), val_num = VALUES(val_num), val_bool = VALUES(val_bool), changed = VALUES(changed);",
+      'pgsql'  : "INSERT INTO {log}(item_id, time, val_str, val_num, val_bool, duration, changed) VALUES {values} ON CONFLICT (item_id, time) DO UPDATE SET duration = EXCLUDED.duration, val_str = EXCLUDED.val_str, val_num = EXCLUDED.val_num, val_bool = EXCLUDED.val_bool, changed = EXCLUDED.changed;"
+    }
+
+    # Rollup tables (table, resolution): log values aggregated by the start
+    # time of the log entries, coarsest resolution last
+    _rollups = [
+      ('log_minute', 60 * 1000),
+      ('log_hour',   60 * 60 * 1000),
+      ('log_day',    24 * 60 * 60 * 1000)
+    ]
+
+    # Bulk upsert queries adding values to rollups per dialect: {rollup} =
+    # rollup table name, {values} = list of value tuples
+    _upsert_rollup = {
+      'sqlite' : "INSERT INTO {rollup}(item_id, time, duration, val_sum, val_min, val_max, bool_sum) VALUES {values} ON CONFLICT (item_id, time) DO UPDATE SET duration = duration + excluded.duration, val_sum = val_sum + excluded.val_sum, val_min = MIN(val_min, excluded.val_min), val_max = MAX(val_max, excluded.val_max), bool_sum = bool_sum + excluded.bool_sum;",
+      'mysql'  : "INSERT INTO {rollup}(item_id, time, duration, val_sum, val_min, val_max, bool_sum) VALUES {values} ON DUPLICATE KEY UPDATE duration = duration + VALUES(duration), val_sum = val_sum + VALUES(val_sum), val_min = LEAST(val_min, VALUES(val_min)), val_max = GREATEST(val_max, VALUES(val_max)), bool_sum = bool_sum + VALUES(bool_sum);",
+      'pgsql'  : "INSERT INTO {rollup}(item_id, time, duration, val_sum, val_min, val_max, bool_sum) VALUES {values} ON CONFLICT (item_id, time) DO UPDATE SET duration = {rollup}.duration + EXCLUDED.duration, val_sum = {rollup}.val_sum + EXCLUDED.val_sum, val_min = LEAST({rollup}.val_min, EXCLUDED.val_min), val_max = GREATEST({rollup}.val_max, EXCLUDED.val_max), bool_sum = {rollup}.bool_sum + EXCLUDED.bool_sum;"
+    }
+
+    # Queries to partition the log table (or a rollup table replacing {log})
+    # by month per dialect: {partitions} = list of partition definitions,
+    # {partition} = partition name
+    _partition_queries = {
+      'mysql' : {
+        'read'   : "SELECT partition_name, partition_description FROM information_schema.partitions WHERE table_schema = DATABASE() AND table_name = '{log}' AND partition_name IS NOT NULL;",
+        'create' : "ALTER TABLE {log} PARTITION BY RANGE (time) ({partitions});",
+        'add'    : "ALTER TABLE {log} REORGANIZE PARTITION {log}_max INTO ({partitions});",
+        'drop'   : "ALTER TABLE {log} DROP PARTITION {partition};",
+        'range'  : "PARTITION {partition} VALUES LESS THAN ({time})",
+        'max'    : "PARTITION {log}_max VALUES LESS THAN MAXVALUE"
+      }
+    }
+
+    # Number of log rows written by a single bulk upsert statement (keep the
+    # number of parameters below SQLite's limit of 999)
+    _upsert_rows = 100
+
+    def __init__(self, smarthome, driver, connect, prefix="", cycle=60, maxage=0, partition=None, journal=None, flush_size=1000, queue_size=10000, maxage_day=0):
         self._sh = smarthome
         self.logger = logging.getLogger(__name__)
         self._dump_cycle = int(cycle)
+        self._flush_size = int(flush_size)
+        self._maxage = float(maxage)
+        self._maxage_day = float(maxage_day)
+        self._partition = partition
+        self._journal = journal
+        self._dialect = self._dialects.get(driver)
         self._name = self.get_instance_name()
         self._replace = {table: table if prefix == "" else prefix + "_" + table for table in ["log", "item"]}
+        self._replace.update({rollup: self._replace['log'] + rollup[3:] for rollup, resolution in self._rollups})
         self._replace['item_columns'] = ", ".join(COL_ITEM)
         self._replace['log_columns'] = ", ".join(COL_LOG)
         self._buffer = {}
         self._buffer_lock = threading.Lock()
         self._dump_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=int(queue_size))
+        self._flush = threading.Event()
+        self._writer = None
+        self._metrics = {'flushes' : 0, 'overflows' : 0, 'flush_latency' : 0.0, 'flush_latency_max' : 0.0}
+        self._item_ids = {}
+        self._item_ids_inserted = []  # names of items inserted since the last dump, forgotten on rollback
+        self._item_maxage = {}
+        self._rollup_until = {}
+        self._rollups_pending = set()  # ids of items without rollups, they are built after start
+        self._transaction = None    # cursor of the running dump, statement errors on it are raised
 
         self._db = lib.db.Database(("" if prefix == "" else prefix.capitalize() + "_") + "Database", driver, connect)
         self._db.connect()
         self._db.setup({i: [self._prepare(query[0]), self._prepare(query[1])] for i, query in self._setup.items()})
+        self._load_item_ids()
+
+        if self._partition is not None and (self._partition != 'month' or self._dialect not in self._partition_queries):
+            self.logger.warning("Database: partitioning '{}' not supported for driver {}, ignoring".format(self._partition, driver))
+            self._partition = None
 
-        smarthome.scheduler.add('Database dump ' + self._name + ("" if prefix == "" else " [" + prefix + "]"), self._dump, cycle=self._dump_cycle, prio=5)
+        self._writer_name = 'Database writer ' + self._name + ("" if prefix == "" else " [" + prefix + "]")
+        smarthome.scheduler.add('Database maintenance ' + self._name + ("" if prefix == "" else " [" + prefix + "]"), self._maintenance, cron='3 3 * *', prio=5)
 
     def parse_item(self, item):
         if self.has_iattr(item.conf, 'database'):
@@ -94,6 +178,8 @@ class Database(SmartPlugin):
             item.series = functools.partial(self._series, item=item.id())
             item.db = functools.partial(self._single, item=item.id())
             item.dbplugin = self
+            if self.has_iattr(item.conf, 'database_maxage'):
+                self._item_maxage[item] = float(self.get_iattr_value(item.conf, 'database_maxage'))
 
             if self.get_iattr_value(item.conf, 'database') == 'init':
                 if not self._db.lock(5):
@@ -122,53 +208,174 @@ class Database(SmartPlugin):
 
     def run(self):
         self.alive = True
+        self._rollups_pending = self._missing_rollups()
+        if self._rollups_pending:
+            self._sh.scheduler.add('Database rollups ' + self._name, self._build_rollups, prio=5, next=self._sh.now())
+        self._writer = threading.Thread(target=self._write, name=self._writer_name)
+        self._writer.start()
 
     def stop(self):
         self.alive = False
+        if self._writer is not None:
+            self._flush.set()
+            self._writer.join()
+            self._writer = None
         self._dump(True)
         self._db.close()
 
     def update_item(self, item, caller=None, source=None, dest=None):
         acl = 'rw' if not self.has_iattr(item.conf, 'database_acl') else self.get_iattr_value(item.conf, 'database_acl')
         if acl is 'rw':
-            start = self._timestamp(item.prev_change())
-            end = self._timestamp(item.last_change())
-            last = None if len(self._buffer[item]) == 0 or self._buffer[item][-1][1] is not None else self._buffer[item][-1]
-            if last:  # update current value with duration
-                self._buffer[item][-1] = (last[0], end - start, last[2])
-            else:     # append new value with none duration
-                self._buffer[item].append((start, end - start, item.prev_value()))
-
-            # add current value with None duration
-            self._buffer[item].append((end, None, item()))
-
-    def dump(self, dumpfile, id = None, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None):
+            value = (item, self._timestamp(item.prev_change()), self._timestamp(item.last_change()), item.prev_value(), item())
+            try:
+                self._queue.put_nowait(value)
+            except queue.Full:
+                # Move queued values to the buffer to make room for this value
+                # and dump the buffer, which is not limited
+                self._metrics['overflows'] += 1
+                self._drain()
+                self._queue.put(value)
+                self._flush.set()
+            if self._queue.qsize() >= self._flush_size:
+                self._flush.set()
+
+    def metrics(self):
+        return dict(self._metrics, queue_depth=self._queue.qsize(), queue_size=self._queue.maxsize)
+
+    def _write(self):
+        # Dump the buffer when enough values are queued or the dump cycle is
+        # over, whatever comes first
+        last = time.time()
+        while self.alive:
+            try:
+                self._flush.wait(max(0, last + self._dump_cycle - time.time()))
+                self._flush.clear()
+                if not self.alive:
+                    break
+                last = time.time()
+                self._dump()
+            except Exception as e:
+                # Keep the writer alive, the values are dumped again next time
+                self.logger.exception("Database: writer failed: {}".format(e))
+
+    def _drain(self):
+        self._buffer_lock.acquire()
+        try:
+            while True:
+                try:
+                    (item, start, end, prev, val) = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                last = None if len(self._buffer[item]) == 0 or self._buffer[item][-1][1] is not None else self._buffer[item][-1]
+                if last:  # update current value with duration
+                    self._buffer[item][-1] = (last[0], end - start, last[2])
+                else:     # append new value with none duration
+                    self._buffer[item].append((start, end - start, prev))
+
+                # add current value with None duration
+                self._buffer[item].append((end, None, val))
+        finally:
+            self._buffer_lock.release()
+
+    def dump(self, dumpfile, id = None, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None, name = None, format = 'csv', size = 10000, progress = None):
         self.logger.info("Starting file dump to {} ...".format(dumpfile))
 
         item_ids = self.readItems(cur=cur) if id is None else [self.readItem(id, cur=cur)]
+        if item_ids is None or None in item_ids:
+            self.logger.error("File dump to {} failed: can't read items".format(dumpfile))
+            return False
+        if name is not None:
+            item_ids = [item for item in item_ids if fnmatch.fnmatchcase(item[COL_ITEM_NAME], name)]
 
-        s = ';'
         h = ['item_id', 'item_name', 'time', 'duration', 'val_str', 'val_num', 'val_bool', 'changed', 'time_date', 'changed_date']
-        f = open(dumpfile, 'w')
-        f.write(s.join(h) + "\n")
-        for item in item_ids:
-            self.logger.debug("... dumping item {}/{}".format(item[1], item[0]))
-
-            rows = self.readLogs(item[0], time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end, cur=cur)
-
-            for row in rows:
-                cols = []
-                for key in [COL_ITEM_ID, COL_ITEM_NAME]:
-                    cols.append(item[key])
-                for key in [COL_LOG_TIME, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM, COL_LOG_VAL_BOOL, COL_LOG_CHANGED]:
-                    cols.append(row[key])
-                for key in [COL_ITEM_ID, COL_LOG_CHANGED]:
-                  cols.append('' if row[key] is None else datetime.datetime.fromtimestamp(row[key]/1000.0))
-                cols = map(lambda col: '' if col is None else col, cols)
-                cols = map(lambda col: str(col) if not '"' in str(col) else col.replace('"', '\\"'), cols)
-                f.write(s.join(cols) + "\n")
-        f.close()
-        self.logger.info("File dump completed ({} items) ...".format(len(item_ids)))
+        if format == 'csv':
+            f = open(dumpfile, 'w')
+            f.write(';'.join(h) + "\n")
+            write = lambda item, logs: f.write(self._dump_csv(item, logs))
+            close = f.close
+        elif format == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError as e:
+                self.logger.error("Database: Parquet file dump requires pyarrow: {}".format(e))
+                return False
+            schema = pyarrow.schema([
+              ('item_id', pyarrow.int64()), ('item_name', pyarrow.string()), ('time', pyarrow.int64()), ('duration', pyarrow.int64()),
+              ('val_str', pyarrow.string()), ('val_num', pyarrow.float64()), ('val_bool', pyarrow.int8()), ('changed', pyarrow.int64())
+            ])
+            writer = pyarrow.parquet.ParquetWriter(dumpfile, schema)
+            write = lambda item, logs: writer.write_table(self._dump_arrow(pyarrow, item, logs, schema))
+            close = writer.close
+        else:
+            self.logger.error("Database: Unknown file dump format '{}'".format(format))
+            return False
+
+        count = 0
+        try:
+            for (i, item) in enumerate(item_ids):
+                self.logger.debug("... dumping item {}/{}".format(item[1], item[0]))
+
+                for logs in self._chunkLogs(item[0], time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end, cur=cur, size=size):
+                    write(item, logs)
+                    count += len(logs)
+                    if progress is not None:
+                        progress(i, len(item_ids), count)
+        except RuntimeError as e:
+            self.logger.error("File dump to {} is partial ({} log entries): {}".format(dumpfile, count, e))
+            return False
+        finally:
+            close()
+        self.logger.info("File dump completed ({} items, {} log entries) ...".format(len(item_ids), count))
+        return True
+
+    def _chunkLogs(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None, size = 10000):
+        # Read chunks of log entries continuing after the last time of the
+        # previous chunk, so the database is not locked between the chunks.
+        # This keyset paging is used instead of server side cursors, which
+        # lib.db does not expose and which would keep the connection locked.
+        condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
+        after = ""
+        while True:
+            logs = self._fetchall("SELECT {log_columns} FROM {log} WHERE " + condition + after + " ORDER BY time ASC LIMIT " + str(int(size)) + ";", params, cur=cur)
+            if logs is None:
+                raise RuntimeError("can't read log entries of item {}".format(id))
+            if not logs:
+                return
+            yield logs
+            if len(logs) < size:
+                return
+            params['time_after'] = logs[-1][COL_LOG_TIME]
+            after = " AND time > :time_after"
+
+    def _dump_csv(self, item, logs):
+        def col(value):
+            if value is None:
+                return ''
+            value = str(value)
+            return value if not '"' in value else value.replace('"', '\\"')
+
+        def date(value):
+            return '' if value is None else str(datetime.datetime.fromtimestamp(value / 1000.0))
+
+        prefix = col(item[COL_ITEM_ID]) + ';' + col(item[COL_ITEM_NAME]) + ';'
+        lines = []
+        for log in logs:
+            cols = [col(log[key]) for key in (COL_LOG_TIME, COL_LOG_DURATION, COL_LOG_VAL_STR, COL_LOG_VAL_NUM, COL_LOG_VAL_BOOL, COL_LOG_CHANGED)]
+            cols.append(date(log[COL_LOG_TIME]))
+            cols.append(date(log[COL_LOG_CHANGED]))
+            lines.append(prefix + ';'.join(cols) + "\n")
+        return ''.join(lines)
+
+    def _dump_arrow(self, pyarrow, item, logs, schema):
+        data = {
+          'item_id'   : [item[COL_ITEM_ID]] * len(logs),
+          'item_name' : [item[COL_ITEM_NAME]] * len(logs)
+        }
+        for key, column in [(COL_LOG_TIME, 'time'), (COL_LOG_DURATION, 'duration'), (COL_LOG_VAL_STR, 'val_str'), (COL_LOG_VAL_NUM, 'val_num'), (COL_LOG_CHANGED, 'changed')]:
+            data[column] = [log[key] for log in logs]
+        data['val_bool'] = [None if log[COL_LOG_VAL_BOOL] is None else int(log[COL_LOG_VAL_BOOL]) for log in logs]
+        return pyarrow.Table.from_pydict(data, schema=schema)
 
     def cleanup(self):
         items = [item.id() for item in self._buffer]
@@ -185,18 +392,54 @@ class Database(SmartPlugin):
         cur.close()
         self._db.release()
 
+    def expire(self):
+        if not self._db.lock(60):
+            self.logger.error("Can not acquire lock for database expire")
+            return
+        now = self._timestamp(self._sh.now())
+        cur = self._db.cursor()
+        try:
+            for item in list(self._buffer):
+                maxage = self._item_maxage.get(item, self._maxage)
+                id = self.id(item, create=False, cur=cur)
+                if maxage <= 0 or id is None:
+                    continue
+                # The rollups expire with the log entries, except the day
+                # rollups which may be kept longer
+                for table in ['log'] + [rollup for rollup, resolution in self._rollups[:-1]]:
+                    self._execute(self._prepare("DELETE FROM {" + table + "} WHERE item_id = :id AND time < :time;"), {'id':id, 'time':now - int(maxage * 24 * 3600 * 1000)}, cur=cur)
+                if self._maxage_day > 0:
+                    self._execute(self._prepare("DELETE FROM {" + self._rollups[-1][0] + "} WHERE item_id = :id AND time < :time;"), {'id':id, 'time':now - int(max(maxage, self._maxage_day) * 24 * 3600 * 1000)}, cur=cur)
+            self._db.commit()
+        except Exception as e:
+            self.logger.error("Database expire failed: {}".format(e))
+            self._db.rollback()
+        cur.close()
+        self._db.release()
+
     def id(self, item, create=True, cur=None):
-        id = self.readItem(str(item.id()), cur=cur)
+        name = str(item.id())
+        if name in self._item_ids:
+            return self._item_ids[name]
+
+        # Item may have been created by another instance using the same tables
+        id = self.readItem(name, cur=cur)
+        if id != None:
+            self._item_ids[name] = int(id[COL_ITEM_ID])
+            return self._item_ids[name]
 
-        if id == None and create == True:
-            id = [self.insertItem(item.id(), cur)]
+        if create == True:
+            return self.insertItem(name, cur)
 
-        return None if id == None else int(id[COL_ITEM_ID])
+        return None
 
     def insertItem(self, name, cur=None):
-        id = self._fetchone("SELECT MAX(id) FROM {item};", cur=cur)
-        self._execute(self._prepare("INSERT INTO {item}(id, name) VALUES(:id, :name);"), {'id':1 if id[0] == None else id[0]+1, 'name':name}, cur=cur)
+        # Allocate the next id within the insert statement itself to avoid
+        # races with other instances inserting items at the same time
+        self._execute(self._prepare("INSERT INTO {item}(id, name) SELECT COALESCE(MAX(id), 0) + 1, :name FROM {item};"), {'name':name}, cur=cur)
         id = self._fetchone("SELECT id FROM {item} where name = :name;", {'name':name}, cur=cur)
+        self._item_ids[name] = int(id[0])
+        self._item_ids_inserted.append(name)
         return int(id[0])
 
     def updateItem(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
@@ -216,7 +459,12 @@ class Database(SmartPlugin):
     def deleteItem(self, id, cur=None):
         params = {'id':id}
         self.deleteLog(id, cur=cur)
+        for rollup, resolution in self._rollups:
+            self._execute(self._prepare("DELETE FROM {" + rollup + "} WHERE item_id = :id;"), params, cur=cur)
+        self._rollup_until.pop(id, None)
         self._execute(self._prepare("DELETE FROM {item} WHERE id = :id;"), params, cur=cur)
+        for name in [name for name, item_id in self._item_ids.items() if item_id == id]:
+            del self._item_ids[name]
 
     def insertLog(self, id, time, duration=0, val=None, it=None, changed=None, cur=None):
         params = {'id':id, 'time':time, 'changed':changed, 'duration':duration}
@@ -228,36 +476,112 @@ class Database(SmartPlugin):
         params.update(self._item_value_tuple(it, val))
         self._execute(self._prepare("UPDATE {log} SET duration = :duration, val_str = :val_str, val_num = :val_num, val_bool = :val_bool, changed = :changed WHERE item_id = :id AND time = :time;"), params, cur=cur)
 
+    def upsertLogs(self, logs, cur=None):
+        if self._dialect is None:
+            for (id, time, duration, val, it, changed) in logs:
+                if len(self.readLog(id, time, cur)):
+                    self.updateLog(id, time, duration, val, it, changed, cur)
+                else:
+                    self.insertLog(id, time, duration, val, it, changed, cur)
+            return
+
+        # Only the last log entry per item and time can be written by one statement
+        logs = list({(log[0], log[1]): log for log in logs}.values())
+        for offset in range(0, len(logs), self._upsert_rows):
+            values = []
+            params = {}
+            for i, (id, time, duration, val, it, changed) in enumerate(logs[offset:offset + self._upsert_rows]):
+                key = self._param_key(i)
+                values.append("(:id_{0},:time_{0},:val_str_{0},:val_num_{0},:val_bool_{0},:duration_{0},:changed_{0})".format(key))
+                params.update({'id_' + key:id, 'time_' + key:time, 'duration_' + key:duration, 'changed_' + key:changed})
+                params.update({name + '_' + key:value for name, value in self._item_value_tuple(it, val).items()})
+            self._execute(self._prepare(self._upsert[self._dialect].replace('{values}', ", ".join(values))), params, cur=cur)
+
+    def upsertRollups(self, rollups, cur=None):
+        if self._dialect is None:
+            return
+
+        for rollup, resolution in self._rollups:
+            rows = [(key[1], key[2]) + tuple(value) for key, value in rollups.items() if key[0] == rollup]
+            for offset in range(0, len(rows), self._upsert_rows):
+                values = []
+                params = {}
+                for i, (id, time, duration, val_sum, val_min, val_max, bool_sum) in enumerate(rows[offset:offset + self._upsert_rows]):
+                    key = self._param_key(i)
+                    values.append("(:id_{0},:time_{0},:duration_{0},:val_sum_{0},:val_min_{0},:val_max_{0},:bool_sum_{0})".format(key))
+                    params.update({'id_' + key:id, 'time_' + key:time, 'duration_' + key:duration, 'val_sum_' + key:val_sum, 'val_min_' + key:val_min, 'val_max_' + key:val_max, 'bool_sum_' + key:bool_sum})
+                self._execute(self._prepare(self._upsert_rollup[self._dialect].replace('{rollup}', '{' + rollup + '}').replace('{values}', ", ".join(values))), params, cur=cur)
+
+    def buildRollups(self, id=None, cur=None):
+        if self._dialect is None:
+            return
+
+        ids = [item[COL_ITEM_ID] for item in self.readItems(cur=cur)] if id is None else [id]
+        for id in ids:
+            rollups = {}
+            logs = self.iterLogs(id, cur=cur)
+            until = self._rollup_logs(rollups, id, ((log[COL_LOG_TIME], log[COL_LOG_DURATION], log[COL_LOG_VAL_NUM], log[COL_LOG_VAL_BOOL]) for log in logs), 0)
+            for rollup, resolution in self._rollups:
+                self._execute(self._prepare("DELETE FROM {" + rollup + "} WHERE item_id = :id;"), {'id':id}, cur=cur)
+            self.upsertRollups(rollups, cur=cur)
+            self._rollup_until[id] = until
+
     def readLog(self, id, time, cur = None):
         params = {'id':id, 'time':time}
         return self._fetchall("SELECT {log_columns} FROM {log} WHERE item_id = :id AND time = :time;", params, cur=cur)
 
     def readLogs(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None):
         condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
-        return self._fetchall("SELECT {log_columns} FROM {log} WHERE " + condition, params, cur=cur)
+        return self._fetchall("SELECT {log_columns} FROM {log} WHERE " + condition + ";", params, cur=cur)
+
+    def iterLogs(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None, size = 1000):
+        condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
+        query = self._prepare("SELECT {log_columns} FROM {log} WHERE " + condition + " ORDER BY time ASC;")
+        if cur is None:
+            if self._db.verify(5) == 0:
+                self.logger.error("Database: Connection not recovered")
+                return
+            if not self._db.lock(300):
+                self.logger.error("Database: Can't query due to fail to acquire lock")
+                return
+            _cur = self._db.cursor()
+        else:
+            _cur = cur
+        try:
+            self._db.execute(query, params, cur=_cur)
+            while True:
+                logs = _cur.fetchmany(size)
+                if not logs:
+                    break
+                for log in logs:
+                    yield log
+        finally:
+            if cur is None:
+                _cur.close()
+                self._db.release()
 
     def deleteLog(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None, cur = None):
         condition, params = self._slice_condition(id, time=time, time_start=time_start, time_end=time_end, changed=changed, changed_start=changed_start, changed_end=changed_end)
-        self._execute(self._prepare("DELETE FROM {log} WHERE " + condition), params, cur=cur)
+        self._execute(self._prepare("DELETE FROM {log} WHERE " + condition + ";"), params, cur=cur)
 
     def _slice_condition(self, id, time = None, time_start = None, time_end = None, changed = None, changed_start = None, changed_end = None):
-        params = {
-          'id'            : id,
-          'time'          : time,          'time_flag'          : 1 if time          == None else 0,
-          'time_start'    : time_start,    'time_start_flag'    : 1 if time_start    == None else 0,
-          'time_end'      : time_end,      'time_end_flag'      : 1 if time_end      == None else 0,
-          'changed'       : changed,       'changed_flag'       : 1 if changed       == None else 0,
-          'changed_start' : changed_start, 'changed_start_flag' : 1 if changed_start == None else 0,
-          'changed_end'   : changed_end,   'changed_end_flag'   : 1 if changed_end   == None else 0
-        }
-
-        condition = "(item_id = :id                                      ) AND " + \
-                    "(time    = :time          OR 1 = :time_flag         ) AND " + \
-                    "(time    > :time_start    OR 1 = :time_start_flag   ) AND " + \
-                    "(time    < :time_end      OR 1 = :time_end_flag     ) AND " + \
-                    "(changed = :changed       OR 1 = :changed_flag      ) AND " + \
-                    "(changed > :changed_start OR 1 = :changed_start_flag) AND " + \
-                    "(changed < :changed_end   OR 1 = :changed_end_flag  );    "
+        # Only add conditions for given parameters to allow using the indexes
+        # on (item_id, time) and (item_id, changed)
+        slices = [
+          ('time',    '=', 'time',          time),
+          ('time',    '>', 'time_start',    time_start),
+          ('time',    '<', 'time_end',      time_end),
+          ('changed', '=', 'changed',       changed),
+          ('changed', '>', 'changed_start', changed_start),
+          ('changed', '<', 'changed_end',   changed_end)
+        ]
+
+        params = {'id' : id}
+        condition = "item_id = :id"
+        for (column, op, name, value) in slices:
+            if value is not None:
+                params[name] = value
+                condition += " AND {} {} :{}".format(column, op, name)
         return (condition, params)
 
     def db(self):
@@ -293,93 +617,354 @@ class Database(SmartPlugin):
     def _prepare(self, query):
         return query.format(**self._replace)
 
+    def _load_item_ids(self):
+        items = self.readItems()
+        self._item_ids = {} if items is None else {item[COL_ITEM_NAME]: int(item[COL_ITEM_ID]) for item in items}
+
+    def _maintenance(self):
+        if self._partition is not None:
+            self._maintain_partitions()
+        self.expire()
+
+    def _maintain_partitions(self):
+        # The day rollups are small and kept longer, they are only expired
+        for table in ['log'] + [rollup for rollup, resolution in self._rollups[:-1]]:
+            self._maintain_table_partitions(table)
+
+    def _maintain_table_partitions(self, table):
+        queries = {name: query.replace('{log}', '{' + table + '}') for name, query in self._partition_queries[self._dialect].items()}
+        partitions = self._fetchall(queries['read'])
+        if partitions is None:
+            return
+
+        # Partitions of the current and the next month should always exist
+        now = self._sh.now()
+        month = (now.year * 12 + now.month - 1) + 2
+        bounds = {self._timestamp(datetime.datetime(m // 12, m % 12 + 1, 1)): m for m in range(month - 2, month + 1)}
+        existing = {int(p[1]): p[0] for p in partitions if p[1] != 'MAXVALUE'}
+        if len(partitions) == 0:
+            first = self._fetchone("SELECT MIN(time) FROM {" + table + "};")
+            if first is not None and first[0] is not None:
+                first = self._datetime(first[0])
+                bounds.update({self._timestamp(datetime.datetime(m // 12, m % 12 + 1, 1)): m for m in range(first.year * 12 + first.month, month)})
+        missing = sorted([bound for bound in bounds if bound not in existing and (len(existing) == 0 or bound > max(existing))])
+        if len(missing):
+            definitions = [queries['range'].format(partition='{' + table + '}_' + '{:04d}{:02d}'.format((bounds[bound] - 1) // 12, (bounds[bound] - 1) % 12 + 1), time=bound) for bound in missing]
+            definitions.append(queries['max'])
+            self.logger.info("Database: creating {} partitions of {} table".format(len(missing), table))
+            self._execute(self._prepare((queries['create'] if len(partitions) == 0 else queries['add']).replace('{partitions}', ", ".join(definitions))), {})
+
+        # Drop partitions only containing entries older than the maximum age
+        # of all items
+        maxages = [self._item_maxage.get(item, self._maxage) for item in list(self._buffer)]
+        if len(maxages) == 0 or min(maxages) <= 0:
+            return
+        expire = self._timestamp(now) - int(max(maxages) * 24 * 3600 * 1000)
+        for bound, partition in sorted(existing.items()):
+            if bound <= expire:
+                self.logger.info("Database: dropping partition {} of {} table".format(partition, table))
+                self._execute(self._prepare(queries['drop'].replace('{partition}', partition)), {})
+
+    def _missing_rollups(self):
+        """ Returns the ids of the numeric items having log entries but no
+            rollups yet, e.g. when the rollup tables were added to an
+            existing database
+        """
+        if self._dialect is None:
+            return set()
+
+        missing = set()
+        for item in list(self._buffer):
+            id = self._item_ids.get(str(item.id()))
+            if id is None or item.type() not in ('num', 'bool'):
+                continue
+            first = self._fetchone("SELECT (SELECT MIN(time) FROM {log} WHERE item_id = :id), (SELECT MIN(time) FROM {" + self._rollups[0][0] + "} WHERE item_id = :id);", {'id':id})
+            if first is not None and first[0] is not None and first[1] is None:
+                missing.add(id)
+        return missing
+
+    def _build_rollups(self):
+        # Build the missing rollups item by item to only lock the database for
+        # the log entries of one item at once
+        self.logger.info("Database: building rollups of {} items".format(len(self._rollups_pending)))
+        for id in sorted(self._rollups_pending):
+            if not self.alive:
+                return
+            if not self._db.lock(300):
+                self.logger.error("Database: can't build rollups due to fail to acquire lock")
+                return
+            cur = self._db.cursor()
+            try:
+                self.buildRollups(id, cur=cur)
+                self._db.commit()
+                self._rollups_pending.discard(id)
+            except Exception as e:
+                self.logger.error("Database: building rollups of item {} failed: {}".format(id, e))
+                self._db.rollback()
+            finally:
+                cur.close()
+                self._db.release()
+        self.logger.info("Database: building rollups completed")
+
+    def _rollup_logs(self, rollups, id, logs, until):
+        """ Add log entries (time, duration, val_num, val_bool) to rollups
+
+            Only the part of the log entries after `until` will be added (the
+            part before was already added by previous dumps) and the new
+            `until` is returned.
+        """
+        for (time, duration, val_num, val_bool) in logs:
+            if duration is None or val_num is None:
+                continue
+            end = time + duration
+            duration = end - max(time, until)
+            if duration < 0:
+                continue
+            until = max(until, end)
+            for rollup, resolution in self._rollups:
+                key = (rollup, id, time - time % resolution)
+                if key not in rollups:
+                    rollups[key] = [0, 0.0, val_num, val_num, 0.0]
+                value = rollups[key]
+                value[0] += duration
+                value[1] += val_num * duration
+                value[2] = min(value[2], val_num)
+                value[3] = max(value[3], val_num)
+                value[4] += val_bool * duration
+        return until
+
+    def _rollup_start(self, id, cur=None):
+        if id not in self._rollup_until:
+            until = self._fetchone("SELECT MAX(time + duration) FROM {log} WHERE item_id = :id;", {'id':id}, cur=cur)
+            self._rollup_until[id] = 0 if until is None or until[0] is None else int(until[0])
+        return self._rollup_until[id]
+
+    def _param_key(self, i):
+        # Parameter names only consist of letters and underscores, so encode
+        # the row index using letters (0 = a, 1 = b, ..., 26 = ba, ...)
+        key = ''
+        while True:
+            key = chr(ord('a') + i % 26) + key
+            i = i // 26
+            if i == 0:
+                return key
+
     def _dump(self, finalize=False, items=None):
         if self._dump_lock.acquire(timeout=60) == False:
             self.logger.warning('Skipping dump, since other dump running!')
             return
+        try:
+            self._dump_items(finalize, items)
+        finally:
+            self._dump_lock.release()
 
+    def _dump_items(self, finalize, items):
         self.logger.debug('Starting dump')
+        self._drain()
+        flush = time.time()
 
         if items == None:
             self._buffer_lock.acquire()
             items = list(self._buffer.keys())
             self._buffer_lock.release()
 
+        # Take buffered tuples of all items at once
+        dumps = {}
+        self._buffer_lock.acquire()
         for item in items:
-            self._buffer_lock.acquire()
             tuples = self._buffer[item]
-            self._buffer[item] = self._buffer[item][len(tuples):]
-            self._buffer_lock.release()
-
+            self._buffer[item] = []
             if len(tuples) or finalize:
+                dumps[item] = tuples
+        self._buffer_lock.release()
 
-                # Test connectivity
-                if self._db.verify(5) == 0:
-                    self.logger.error("Database: Connection not recovered, skipping dump");
-                    self._dump_lock.release()
-                    return
+        if len(dumps) == 0 and not self._journaled():
+            self.logger.debug('Dump completed')
+            return
 
-                # Can't lock, restore data
-                if not self._db.lock(300):
-                    self._buffer_lock.acquire()
-                    if item in self._buffer:
-                        self._buffer[item] = tuples + self._buffer[item]
-                    else:
-                        self._buffer[item] = tuples
-                    self._buffer_lock.release()
-                    if finalize:
-                        self.logger.error("Database: can't dump {} items due to fail to acquire lock!".format(len(self._buffer)))
-                    else:
-                        self.logger.error("Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(len(self._buffer)))
-                    self._dump_lock.release()
-                    return
+        # Test connectivity
+        if self._db.verify(5) == 0:
+            self._spill(dumps)
+            self.logger.error("Database: Connection not recovered, skipping dump");
+            return
 
-                cur = None
-                try:
-                    changed = self._timestamp(self._sh.now())
+        # Can't lock, restore data
+        if not self._db.lock(300):
+            self._spill(dumps)
+            if finalize:
+                self.logger.error("Database: can't dump {} items due to fail to acquire lock!".format(len(dumps)))
+            else:
+                self.logger.error("Database: can't dump {} items due to fail to acquire lock - will try on next dump".format(len(dumps)))
+            return
 
-                    # Get current values of item
-                    start = self._timestamp(item.last_change())
-                    end = changed
-                    val = item()
+        # Replay tuples spilled to the journal in front of the buffered ones,
+        # only the taken tuples are spilled again if the dump fails
+        taken = {item: list(tuples) for item, tuples in dumps.items()}
+        journaled = self._replay(dumps)
 
-                    # When finalizing (e.g. plugin shutdown) add current value to item and log
-                    if finalize:
-                        _update = (end, val, changed)
+        cur = None
+        committed = False
+        try:
+            changed = self._timestamp(self._sh.now())
+            cur = self._db.cursor()
+            self._transaction = cur
+
+            logs = []
+            updates = []
+            rollups = {}
+            rollup_until = {}
+            for item, tuples in dumps.items():
+
+                # Get current values of item
+                start = self._timestamp(item.last_change())
+                end = changed
+                val = item()
+
+                # When finalizing (e.g. plugin shutdown) add current value to item and log
+                if finalize:
+                    _update = (end, val, changed)
+
+                    current = (start, end - start, val)
+                    tuples.append(current)
+
+                else:
+                    _update = (start, val, changed)
+
+                # Skip values which can't be stored instead of failing the
+                # transaction of all items
+                values = []
+                valid = []
+                for t in tuples:
+                    try:
+                        (ts, duration, val) = t
+                        values.append(self._item_value_tuple(item.type(), val))
+                        valid.append(t)
+                    except Exception as e:
+                        self.logger.warning("Database: skipping value {} of item {}: {}".format(t, item.id(), e))
+                tuples = valid
+                try:
+                    self._item_value_tuple(item.type(), _update[1])
+                except Exception as e:
+                    self.logger.warning("Database: not updating item {} with value {}: {}".format(item.id(), _update[1], e))
+                    _update = None
 
-                        current = (start, end - start, val)
-                        tuples.append(current)
+                id = self.id(item, cur=cur)
+                logs.extend([(id, t[0], t[1], t[2], item.type(), changed) for t in tuples])
+                if _update is not None:
+                    updates.append((id, item.type(), _update))
 
-                    else:
-                        _update = (start, val, changed)
+                # Items without rollups get them built from all log entries
+                if self._dialect is not None and item.type() in ('num', 'bool') and id not in self._rollups_pending:
+                    rollup_until[id] = self._rollup_logs(rollups, id, [(t[0], t[1], v['val_num'], v['val_bool']) for t, v in zip(tuples, values)], self._rollup_start(id, cur))
 
-                    cur = self._db.cursor()
-                    id = self.id(item, cur=cur)
+            # Dump tuples of all items within one transaction
+            self.logger.debug('Dumping {} items with {} values'.format(len(updates), len(logs)))
 
-                    # Dump tuples
-                    self.logger.debug('Dumping {}/{} with {} values'.format(item.id(), id, len(tuples)))
+            self.upsertLogs(logs, cur)
+            self.upsertRollups(rollups, cur)
 
-                    for t in tuples:
-                        if len(self.readLog(id, t[0], cur)):
-                            self.updateLog(id, t[0], t[1], t[2], item.type(), changed, cur)
-                        else:
-                            self.insertLog(id, t[0], t[1], t[2], item.type(), changed, cur)
+            for (id, it, _update) in updates:
+                self.updateItem(id, _update[0], None, _update[1], it, _update[2], cur)
 
-                    self.updateItem(id, _update[0], None, _update[1], item.type(), _update[2], cur)
+            self._transaction = None
+            cur.close()
+            cur = None
 
-                    cur.close()
-                    cur = None
+            self._db.commit()
+            committed = True
+            self._item_ids_inserted = []
+            self._rollup_until.update(rollup_until)
 
-                    self._db.commit()
-                except Exception as e:
-                    self.logger.warning("Database: problem updating {}: {}".format(item.id(), e))
-                    self._db.rollback()
-                finally:
-                    if cur is not None:
-                        cur.close()
-                self._db.release()
+            flush = time.time() - flush
+            self._metrics['flushes'] += 1
+            self._metrics['flush_latency'] = flush
+            self._metrics['flush_latency_max'] = max(flush, self._metrics['flush_latency_max'])
+        except Exception as e:
+            self.logger.warning("Database: problem dumping {} items, keeping values for next dump: {}".format(len(dumps), e))
+            self._db.rollback()
+            # The rows of inserted items are gone, their ids are read or
+            # inserted again by the next dump
+            for name in self._item_ids_inserted:
+                self._item_ids.pop(name, None)
+            self._item_ids_inserted = []
+            self._spill(taken)
+        finally:
+            self._transaction = None
+            if cur is not None:
+                cur.close()
+
+        # The journal is only removed when its values are stored, it is kept
+        # for the next dump when any statement failed
+        if journaled and committed:
+            try:
+                os.remove(self._journal)
+            except Exception as e:
+                self.logger.error("Database: can't remove journal {}, its values are stored again by the next dump: {}".format(self._journal, e))
+        self._db.release()
         self.logger.debug('Dump completed')
-        self._dump_lock.release()
+
+    def _spill(self, dumps):
+        # Append tuples to the journal to not keep them in memory while the
+        # database is not available, fall back to the buffer on errors
+        if self._journal is None:
+            self._restore(dumps)
+            return
+        try:
+            with open(self._journal, 'a') as f:
+                f.write(''.join(json.dumps({'item':item.id(), 'tuples':tuples}) + "\n" for item, tuples in dumps.items() if len(tuples)))
+        except Exception as e:
+            self.logger.error("Database: can't write journal {}, keeping values in memory: {}".format(self._journal, e))
+            self._restore(dumps)
+
+    def _journaled(self):
+        return self._journal is not None and os.path.exists(self._journal)
+
+    def _replay(self, dumps):
+        if not self._journaled():
+            return False
+        journal = {}
+        rejected = []
+        try:
+            with open(self._journal, 'r') as f:
+                for line in f:
+                    # Entries which can't be stored would fail every following
+                    # dump, so they are moved to the rejected journal
+                    try:
+                        entry = json.loads(line)
+                        item = self._sh.return_item(entry['item'])
+                        if item is None or item not in self._buffer:
+                            self.logger.warning("Database: skipping journaled values of unknown item {}".format(entry['item']))
+                            continue
+                        tuples = [tuple(t) for t in entry['tuples']]
+                        for (ts, duration, val) in tuples:
+                            self._item_value_tuple(item.type(), val)
+                    except Exception as e:
+                        self.logger.warning("Database: rejecting journal entry {}: {}".format(line.strip(), e))
+                        rejected.append(line if line.endswith("\n") else line + "\n")
+                        continue
+                    journal.setdefault(item, []).extend(tuples)
+        except Exception as e:
+            self.logger.error("Database: can't read journal {}: {}".format(self._journal, e))
+            return False
+        if rejected:
+            try:
+                with open(self._journal + '.rejected', 'a') as f:
+                    f.write(''.join(rejected))
+            except Exception as e:
+                self.logger.error("Database: can't write rejected journal entries: {}".format(e))
+        for item, tuples in journal.items():
+            dumps[item] = tuples + dumps.get(item, [])
+        self.logger.info("Database: replaying {} journaled values of {} items".format(sum(len(tuples) for tuples in journal.values()), len(journal)))
+        return True
+
+    def _restore(self, dumps):
+        self._buffer_lock.acquire()
+        for item, tuples in dumps.items():
+            if item in self._buffer:
+                self._buffer[item] = tuples + self._buffer[item]
+            else:
+                self._buffer[item] = tuples
+        self._buffer_lock.release()
 
     def _series(self, func, start, end='now', count=100, ratio=1, update=False, step=None, sid=None, item=None):
         init = not update
@@ -393,11 +978,19 @@ class Database(SmartPlugin):
             'on'  : 'MIN(time), ROUND(SUM(val_bool * duration) / SUM(duration), 2)',
             'on.order' : 'ORDER BY time ASC'
         }
+        rollups = {
+            'avg' : 'MIN(time), ROUND(SUM(val_sum) / SUM(duration), 2)',
+            'min' : 'MIN(time), MIN(val_min)',
+            'max' : 'MIN(time), MAX(val_max)',
+            'on'  : 'MIN(time), ROUND(SUM(bool_sum) / SUM(duration), 2)'
+        }
         if func not in queries:
             raise NotImplementedError
 
         order = '' if func+'.order' not in queries else queries[func+'.order']
-        logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group="GROUP BY ROUND(time / :step)", order=order)
+        logs = self._fetch_rollup(item, rollups[func], start, end, step=step, count=count, group="GROUP BY ROUND(time / :step)", order="ORDER BY MIN(time) ASC", value='val_bool' if func == 'on' else 'val_num')
+        if logs is None:
+            logs = self._fetch_log(item, queries[func], start, end, step=step, count=count, group="GROUP BY ROUND(time / :step)", order=order)
         tuples = logs['tuples']
         if tuples:
             if logs['istart'] > tuples[0][0]:
@@ -437,13 +1030,67 @@ class Database(SmartPlugin):
             return
         return logs['tuples'][0][0]
 
-    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order=''):
+    def _fetch_rollup(self, item, columns, start, end, step=None, count=100, group='', order='', value='val_num'):
+        """ Fetch values from the coarsest rollup table still having a
+            resolution of the requested step - returns None if none matches
+
+            Rollup rows are only added for the period a log entry starts in,
+            so the `value` of the log entry in effect at the start is added
+            like the log query does.
+        """
+        if self._dialect is None:
+            return None
+
+        istart, iend, inow, step = self._fetch_range(start, end, step, count)
+        rollup = None
+        for table, resolution in self._rollups:
+            if resolution <= step:
+                rollup = (table, resolution)
+        if rollup is None:
+            return None
+
+        # Only numeric items have rollups
         _item = self._sh.return_item(item)
+        id = self.id(_item, create=False)
+        if _item.type() not in ('num', 'bool') or id in self._rollups_pending:
+            return None
+
+        self._drain()
+        if self._buffer[_item] != []:
+            self._dump(items=[_item])
+
+        params = {'id':id, 'time_start':istart - rollup[1], 'time_end':iend, 'step':step}
+        query = (
+            "SELECT " + columns + " FROM {" + rollup[0] + "} WHERE "
+            "item_id = :id AND "
+            "time > :time_start AND "
+            "time <= :time_end "
+            "" + group + " " + order
+        )
+        logs = self._fetchall(query, params)
+        if logs is not None and (not logs or logs[0][0] > istart):
+            params = {'id':id, 'time_start':istart, 'inow':inow}
+            first = self._fetchone(
+                "SELECT " + value + " FROM {log} WHERE "
+                "item_id = :id AND "
+                "time = (SELECT MAX(time) FROM {log} WHERE item_id = :id AND time < :time_start) AND "
+                "time + COALESCE(duration, :inow - time) > :time_start;", params)
+            if first is not None and first[0] is not None:
+                logs.insert(0, (istart, first[0]))
+
+        return {
+            'tuples' : logs,
+            'item'   : _item,
+            'istart' : istart,
+            'iend'   : iend,
+            'step'   : step,
+            'count'  : count
+        }
 
+    def _fetch_range(self, start, end, step, count):
         istart = self._parse_ts(start)
         iend = self._parse_ts(end)
         inow = self._parse_ts('now')
-        id = self.id(_item, create=False)
 
         if inow > iend:
             inow = iend
@@ -454,6 +1101,15 @@ class Database(SmartPlugin):
             else:
                 step = iend - istart
 
+        return (istart, iend, inow, step)
+
+    def _fetch_log(self, item, columns, start, end, step=None, count=100, group='', order=''):
+        _item = self._sh.return_item(item)
+
+        istart, iend, inow, step = self._fetch_range(start, end, step, count)
+        id = self.id(_item, create=False)
+
+        self._drain()
         if self._buffer[_item] != []:
             self._dump(items=[_item])
 
@@ -531,6 +1187,8 @@ class Database(SmartPlugin):
             tuples = func(self._prepare(query), params, cur=cur)
         except Exception as e:
             self.logger.warning("Database: Running query {}: {}".format(query_readable, e))
+            if cur is not None and cur is self._transaction:
+                raise
         if cur is None:
             self._db.release()
         self.logger.debug("Fetch {}: {}".format(query_readable, tuples))
@@ -1,6 +1,8 @@
 import os
+import sys
 import datetime
 import tempfile
+from unittest import mock
 
 from plugins.database import Database
 from plugins.database.tests.base import TestDatabaseBase
@@ -23,6 +25,33 @@ class TestDatabaseBasic(TestDatabaseBase):
         plugin = self.plugin()
         self.assertEqual(1, plugin.insertItem('manually.inserted'))
 
+    def test_insertItem_allocates_next_id(self):
+        plugin = self.plugin()
+        plugin._execute("INSERT INTO {item}(id, name) VALUES(:id, :name);", {'id':5, 'name':'manually.inserted'})
+        self.assertEqual(6, plugin.insertItem('manually.inserted2'))
+
+    def test_id_uses_cache(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        id = plugin.id(item, True)
+        self.assertEqual({'main.num':id}, plugin._item_ids)
+        plugin._execute("DELETE FROM {item};", {})
+        self.assertEqual(id, plugin.id(item, False))
+
+    def test_id_reads_items_not_in_cache(self):
+        plugin = self.plugin()
+        plugin._execute("INSERT INTO {item}(id, name) VALUES(:id, :name);", {'id':5, 'name':'main.num'})
+        self.assertEqual(5, plugin.id(self.sh.return_item('main.num'), False))
+        self.assertEqual({'main.num':5}, plugin._item_ids)
+
+    def test_load_item_ids(self):
+        plugin = self.plugin()
+        plugin.insertItem('main.num')
+        plugin.insertItem('main.str')
+        plugin._item_ids = {}
+        plugin._load_item_ids()
+        self.assertEqual({'main.num':1, 'main.str':2}, plugin._item_ids)
+
     def test_readItem_reads_unknown_as_none(self):
         plugin = self.plugin()
         res = plugin.readItem(1)
@@ -48,6 +77,7 @@ class TestDatabaseBasic(TestDatabaseBase):
         item = self.sh.return_item('main.num')
         plugin.deleteItem(plugin.id(item, True))
         self.assertIsNone(plugin.id(item, False))
+        self.assertEqual({}, plugin._item_ids)
 
     def test_readItems(self):
         plugin = self.plugin()
@@ -248,6 +278,67 @@ class TestDatabaseBasic(TestDatabaseBase):
           self.read_tmpfile(name)
         )
 
+    def test_dump_log_chunks(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=   0, duration=3600, val=10, it='num', changed=0)
+        plugin.insertLog(id, time=3600, duration=3600, val=20, it='num', changed=3600)
+        plugin.insertLog(id, time=7200, duration=3600, val=15, it='num', changed=7200)
+        progress = []
+        plugin.dump(name, size=2, progress=lambda item, items, logs: progress.append((item, items, logs)))
+        self.assertLines(
+          "item_id;item_name;time;duration;val_str;val_num;val_bool;changed;time_date;changed_date\n"
+          "1;main.num;0;3600;;10.0;1;0;1970-01-01 01:00:00;1970-01-01 01:00:00\n"
+          "1;main.num;3600;3600;;20.0;1;3600;1970-01-01 01:00:03.600000;1970-01-01 01:00:03.600000\n"
+          "1;main.num;7200;3600;;15.0;1;7200;1970-01-01 01:00:07.200000;1970-01-01 01:00:07.200000\n",
+          self.read_tmpfile(name)
+        )
+        self.assertEqual([(0, 1, 2), (0, 1, 3)], progress)
+
+    def test_dump_log_partial(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=   0, duration=3600, val=10, it='num', changed=0)
+        plugin.insertLog(id, time=3600, duration=3600, val=20, it='num', changed=3600)
+        fetchall = plugin._fetchall
+        chunks = []
+        def fail(query, params={}, cur=None):
+            if 'LIMIT' in query:
+                chunks.append(query)
+                if len(chunks) > 1:
+                    return None
+            return fetchall(query, params, cur)
+        plugin._fetchall = fail
+        self.assertFalse(plugin.dump(name, size=1))
+        self.assertEqual(2, len(self.read_tmpfile(name).splitlines()))
+        plugin._fetchall = fetchall
+        self.assertTrue(plugin.dump(name, size=1))
+        self.assertEqual(3, len(self.read_tmpfile(name).splitlines()))
+
+    def test_dump_fails_without_writer(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        self.assertIs(False, plugin.dump(name, format='xml'))
+        with mock.patch.dict(sys.modules, {'pyarrow' : None, 'pyarrow.parquet' : None}):
+            self.assertIs(False, plugin.dump(name, format='parquet'))
+        os.unlink(name)
+
+    def test_dump_log_name(self):
+        name = self.create_tmpfile()
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=   0, duration=3600, val=10, it='num', changed=0)
+        id = self.create_item(plugin, 'main.str')
+        plugin.insertLog(id, time=   0, duration=3600, val='test', it='str', changed=0)
+        plugin.dump(name, name='main.s*')
+        self.assertLines(
+          "item_id;item_name;time;duration;val_str;val_num;val_bool;changed;time_date;changed_date\n"
+          "2;main.str;0;3600;test;;1;0;1970-01-01 01:00:00;1970-01-01 01:00:00\n",
+          self.read_tmpfile(name)
+        )
+
     def test_cleanup_empty(self):
         plugin = self.plugin()
         plugin.cleanup()
@@ -262,3 +353,55 @@ class TestDatabaseBasic(TestDatabaseBase):
         items = plugin.readItems()
         self.assertEqual(1, len(items))
         self.assertEqual("main.num", items[0][1])
+
+    def test_expire(self):
+        plugin = self.plugin()
+        now = plugin._timestamp(self.sh.now())
+        for name in ['main.num', 'main.maxage']:
+            id = self.create_item(plugin, name)
+            plugin.insertLog(id, time=now - 2 * 24 * 3600 * 1000, duration=3600, val=10, it='num')
+            plugin.insertLog(id, time=now - 3600 * 1000, duration=3600, val=20, it='num')
+        plugin.expire()
+        self.assertEqual(2, len(plugin.readLogs(plugin.id(self.sh.return_item('main.num'), False))))
+        self.assertEqual(1, len(plugin.readLogs(plugin.id(self.sh.return_item('main.maxage'), False))))
+
+    def test_expire_plugin_maxage(self):
+        plugin = self.plugin()
+        plugin._maxage = 3
+        now = plugin._timestamp(self.sh.now())
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=now - 4 * 24 * 3600 * 1000, duration=3600, val=10, it='num')
+        plugin.insertLog(id, time=now - 2 * 24 * 3600 * 1000, duration=3600, val=20, it='num')
+        plugin.expire()
+        self.assertEqual(1, len(plugin.readLogs(id)))
+
+    def test_expire_rollups(self):
+        plugin = self.plugin()
+        plugin._maxage = 3
+        plugin._maxage_day = 10
+        now = plugin._timestamp(self.sh.now())
+        id = self.create_item(plugin, 'main.num')
+        for days in [20, 5, 1]:
+            plugin.upsertRollups({(rollup, id, now - days * 24 * 3600 * 1000): [3600, 36000.0, 10.0, 10.0, 3600.0] for rollup, resolution in plugin._rollups})
+        plugin.expire()
+        rollups = {rollup: len(plugin._fetchall("SELECT time FROM {" + rollup + "} WHERE item_id = :id;", {'id':id})) for rollup, resolution in plugin._rollups}
+        self.assertEqual({'log_minute': 1, 'log_hour': 1, 'log_day': 2}, rollups)
+        # day rollups are kept without maxage_day
+        plugin._maxage_day = 0
+        plugin._maxage = 0.5
+        plugin.expire()
+        self.assertEqual(2, len(plugin._fetchall("SELECT time FROM {log_day} WHERE item_id = :id;", {'id':id})))
+        self.assertEqual(0, len(plugin._fetchall("SELECT time FROM {log_minute} WHERE item_id = :id;", {'id':id})))
+
+    def test_maintain_partitions_of_rollups(self):
+        plugin = self.plugin()
+        plugin._dialect = 'mysql'
+        plugin._maxage = 30
+        queries = []
+        plugin._fetchall = lambda query, params={}, cur=None: [('log_200001', '946684800000'), ('log_max', 'MAXVALUE')]
+        plugin._execute = lambda query, params, cur=None: queries.append(query)
+        plugin._maintain_partitions()
+        for table in ['log', 'log_minute', 'log_hour']:
+            self.assertIn("ALTER TABLE {0} DROP PARTITION log_200001;".format(table), queries)
+            self.assertTrue([query for query in queries if query.startswith("ALTER TABLE {0} REORGANIZE PARTITION {0}_max INTO (PARTITION {0}_".format(table))])
+        self.assertFalse([query for query in queries if 'log_day' in query])
@@ -0,0 +1,279 @@
+import os
+import queue
+import time
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseDump(TestDatabaseBase):
+
+    def test_upsertLogs_inserts_logs(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.upsertLogs([
+          (id,    0, 3600, 10, 'num', 0),
+          (id, 3600, 3600, 20, 'num', 3600)
+        ])
+        res = plugin.readLogs(id)
+        self.assertEqual(2, len(res))
+        self.assertEqual(10, res[0][4])
+        self.assertEqual(20, res[1][4])
+
+    def test_upsertLogs_updates_existing_logs(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=0, duration=None, val=10, it='num')
+        plugin.upsertLogs([
+          (id,    0, 3600, 10, 'num', 3600),
+          (id, 3600, None, 20, 'num', 3600)
+        ])
+        res = plugin.readLogs(id)
+        self.assertEqual(2, len(res))
+        self.assertEqual(3600, res[0][2])
+        self.assertEqual(None, res[1][2])
+
+    def test_upsertLogs_uses_last_duplicate_log(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.upsertLogs([
+          (id, 0, None, 10, 'num', 0),
+          (id, 0, 3600, 20, 'num', 0)
+        ])
+        res = plugin.readLogs(id)
+        self.assertEqual(1, len(res))
+        self.assertEqual(20, res[0][4])
+
+    def test_upsertLogs_more_logs_than_upsert_rows(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.upsertLogs([(id, t, 1, t, 'num', t) for t in range(Database._upsert_rows * 2 + 1)])
+        self.assertEqual(Database._upsert_rows * 2 + 1, len(plugin.readLogs(id)))
+
+    def test_upsertLogs_unknown_driver(self):
+        plugin = self.plugin()
+        plugin._dialect = None
+        id = self.create_item(plugin, 'main.num')
+        plugin.insertLog(id, time=0, duration=None, val=10, it='num')
+        plugin.upsertLogs([
+          (id,    0, 3600, 10, 'num', 3600),
+          (id, 3600, None, 20, 'num', 3600)
+        ])
+        res = plugin.readLogs(id)
+        self.assertEqual(2, len(res))
+        self.assertEqual(3600, res[0][2])
+
+    def test_dump_all_items(self):
+        plugin = self.plugin()
+        for name, value in [('main.num', 42), ('main.str', 'test'), ('main.bool', True)]:
+            item = self.sh.return_item(name)
+            item(value)
+            plugin.update_item(item)
+        plugin._dump()
+        for name in ['main.num', 'main.str', 'main.bool']:
+            self.assertEqual(2, len(plugin.readLogs(plugin.id(self.sh.return_item(name), False))))
+            self.assertEqual([], plugin._buffer[self.sh.return_item(name)])
+
+    def test_dump_skips_invalid_values(self):
+        plugin = self.plugin()
+        num = self.sh.return_item('main.num')
+        num(None)
+        plugin._buffer[num] = [(0, 60000, 10), (60000, None, None)]
+        plugin._buffer[self.sh.return_item('main.str')] = [(0, None, 'test')]
+        plugin._dump()
+        self.assertEqual([10], [log[4] for log in plugin.readLogs(plugin.id(num, False))])
+        self.assertEqual(1, len(plugin.readLogs(plugin.id(self.sh.return_item('main.str'), False))))
+
+    def test_dump_keeps_values_on_statement_error(self):
+        plugin = self.plugin()
+        num = self.sh.return_item('main.num')
+        text = self.sh.return_item('main.str')
+        plugin._buffer[num] = [(0, 60000, 10), (60000, None, 20)]
+        plugin._buffer[text] = [(0, None, 'test')]
+        plugin._upsert = {'sqlite' : "INSERT INTO {log}_missing VALUES {values};"}
+        plugin._dump()
+        self.assertEqual([(0, 60000, 10), (60000, None, 20)], plugin._buffer[num])
+        self.assertEqual([(0, None, 'test')], plugin._buffer[text])
+        self.assertEqual(0, plugin.metrics()['flushes'])
+        del plugin._upsert
+        plugin._dump()
+        self.assertEqual([10, 20], [log[4] for log in plugin.readLogs(plugin.id(num, False))])
+        self.assertEqual(['test'], [log[3] for log in plugin.readLogs(plugin.id(text, False))])
+
+    def test_dump_forgets_ids_of_rolled_back_items(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        item(20)
+        plugin._buffer[item] = [(0, None, 10)]
+        plugin._upsert = {'sqlite' : "INSERT INTO {log}_missing VALUES {values};"}
+        plugin._dump()
+        self.assertIsNone(plugin.readItem('main.num'))
+        self.assertNotIn('main.num', plugin._item_ids)
+        del plugin._upsert
+        plugin._dump()
+        id = plugin.readItem('main.num')[0]
+        self.assertEqual(id, plugin._item_ids['main.num'])
+        self.assertEqual(20, plugin.readItem(id)[4])
+        self.assertEqual([id], [log[1] for log in plugin.readLogs(id)])
+
+    def test_update_item_queues_values(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        item(42)
+        plugin.update_item(item)
+        self.assertEqual(1, plugin.metrics()['queue_depth'])
+        self.assertEqual([], plugin._buffer[item])
+        plugin._drain()
+        self.assertEqual(0, plugin.metrics()['queue_depth'])
+        self.assertEqual(2, len(plugin._buffer[item]))
+
+    def test_update_item_queue_overflow(self):
+        plugin = self.plugin()
+        plugin._queue = queue.Queue(maxsize=1)
+        item = self.sh.return_item('main.num')
+        for value in [1, 2, 3]:
+            item(value)
+            plugin.update_item(item)
+        self.assertEqual(2, plugin.metrics()['overflows'])
+        self.assertEqual(1, plugin.metrics()['queue_depth'])
+        plugin._drain()
+        self.assertEqual([2, 3], [t[2] for t in plugin._buffer[item][-2:]])
+
+    def test_writer_flushes_by_size(self):
+        plugin = self.plugin({'database' : ':memory:', 'check_same_thread' : False})
+        plugin._flush_size = 2
+        item = self.sh.return_item('main.num')
+        plugin.run()
+        try:
+            for value in [1, 2]:
+                item(value)
+                plugin.update_item(item)
+            for i in range(50):
+                if plugin.metrics()['flushes'] > 0:
+                    break
+                time.sleep(0.1)
+        finally:
+            plugin.alive = False
+            plugin._flush.set()
+            plugin._writer.join()
+        self.assertEqual(1, plugin.metrics()['flushes'])
+        self.assertEqual(0, plugin.metrics()['queue_depth'])
+        self.assertEqual(2, plugin.readLogs(plugin.id(item, False))[-1][4])
+
+    def test_writer_survives_dump_errors(self):
+        plugin = self.plugin({'database' : ':memory:', 'check_same_thread' : False})
+        item = self.sh.return_item('main.num')
+        dump = plugin._dump_items
+        calls = []
+        def fail(finalize, items):
+            calls.append(items)
+            if len(calls) == 1:
+                raise KeyError('item')
+            dump(finalize, items)
+        plugin._dump_items = fail
+        plugin.run()
+        try:
+            for value in [1, 2]:
+                item(value)
+                plugin.update_item(item)
+                plugin._flush.set()
+                for i in range(50):
+                    if len(calls) == value and not plugin._flush.is_set():
+                        break
+                    time.sleep(0.1)
+            for i in range(50):
+                if plugin.metrics()['flushes'] > 0:
+                    break
+                time.sleep(0.1)
+        finally:
+            plugin.alive = False
+            plugin._flush.set()
+            plugin._writer.join()
+        self.assertEqual(1, plugin.metrics()['flushes'])
+        self.assertFalse(plugin._dump_lock.locked())
+        self.assertEqual(2, plugin.readLogs(plugin.id(item, False))[-1][4])
+
+    def test_update_item_queue_overflow_starts_dump(self):
+        plugin = self.plugin()
+        plugin._queue = queue.Queue(maxsize=1)
+        item = self.sh.return_item('main.num')
+        for value in [1, 2]:
+            item(value)
+            plugin.update_item(item)
+        self.assertTrue(plugin._flush.is_set())
+
+    def test_dump_spills_to_journal(self):
+        plugin = self.plugin()
+        plugin._journal = self.create_tmpfile()
+        os.unlink(plugin._journal)
+        item = self.sh.return_item('main.num')
+        plugin._buffer[item] = [(0, 60000, 10), (60000, None, 20)]
+        verify = plugin._db.verify
+        plugin._db.verify = lambda timeout: 0
+        plugin._dump()
+        self.assertTrue(os.path.exists(plugin._journal))
+        self.assertEqual([], plugin._buffer[item])
+        plugin._db.verify = verify
+        plugin._buffer[item] = [(60000, 60000, 20), (120000, None, 30)]
+        plugin._dump()
+        self.assertFalse(os.path.exists(plugin._journal))
+        res = plugin.readLogs(plugin.id(item, False))
+        self.assertEqual([0, 60000, 120000], [log[0] for log in res])
+        self.assertEqual([10, 20, 30], [log[4] for log in res])
+
+    def test_dump_replays_journal_without_buffered_values(self):
+        plugin = self.plugin()
+        plugin._journal = self.create_tmpfile()
+        item = self.sh.return_item('main.num')
+        with open(plugin._journal, 'w') as f:
+            f.write('{"item": "main.num", "tuples": [[0, 60000, 10]]}\n{"item": "unknown", "tuples": [[0, 60000, 10]]}\n')
+        plugin._dump()
+        self.assertFalse(os.path.exists(plugin._journal))
+        self.assertEqual(1, len(plugin.readLogs(plugin.id(item, False))))
+
+    def test_dump_keeps_journal_on_statement_error(self):
+        plugin = self.plugin()
+        plugin._journal = self.create_tmpfile()
+        item = self.sh.return_item('main.num')
+        with open(plugin._journal, 'w') as f:
+            f.write('{"item": "main.num", "tuples": [[0, 60000, 10]]}\n')
+        plugin._buffer[item] = [(60000, None, 20)]
+        plugin._upsert = {'sqlite' : "INSERT INTO {log}_missing VALUES {values};"}
+        plugin._dump()
+        # the journal is kept and the buffered values are appended once
+        with open(plugin._journal, 'r') as f:
+            self.assertEqual(2, len(f.read().splitlines()))
+        self.assertEqual([], plugin._buffer[item])
+        del plugin._upsert
+        plugin._dump()
+        self.assertFalse(os.path.exists(plugin._journal))
+        self.assertEqual([10, 20], [log[4] for log in plugin.readLogs(plugin.id(item, False))])
+
+    def test_dump_rejects_invalid_journal_entries(self):
+        plugin = self.plugin()
+        plugin._journal = self.create_tmpfile()
+        item = self.sh.return_item('main.num')
+        with open(plugin._journal, 'w') as f:
+            f.write('{"item": "main.num", "tuples": [[0, 60000, null]]}\n{"item": "main.num", "tuples"\n{"item": "main.num", "tuples": [[60000, 60000, 20]]}\n')
+        plugin._dump()
+        self.assertFalse(os.path.exists(plugin._journal))
+        self.assertEqual([20], [log[4] for log in plugin.readLogs(plugin.id(item, False))])
+        self.assertEqual(2, len(self.read_tmpfile(plugin._journal + '.rejected').splitlines()))
+        # following dumps are not affected
+        plugin._buffer[item] = [(120000, None, 30)]
+        plugin._dump()
+        self.assertEqual([20, 30], [log[4] for log in plugin.readLogs(plugin.id(item, False))])
+
+    def test_upsertLogs_bulk_like_single_rows(self):
+        """ Bulk upserts write the same rows as single row inserts
+        """
+        items = 200
+        values = 10
+        rows = {}
+        for dialect in [None, 'sqlite']:
+            plugin = self.plugin()
+            plugin._dialect = dialect
+            logs = [(plugin.insertItem('bench.{}'.format(i)), t, 1, t, 'num', t) for i in range(items) for t in range(values)]
+            plugin.upsertLogs(logs)
+            rows[dialect] = plugin._fetchall("SELECT {log_columns} FROM {log} ORDER BY item_id, time;")
+            self.assertEqual(items * values, len(rows[dialect]))
+        self.assertEqual(rows[None], rows['sqlite'])
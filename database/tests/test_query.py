@@ -0,0 +1,43 @@
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseQuery(TestDatabaseBase):
+
+    # Condition as generated before only adding conditions for given parameters
+    FLAG_CONDITION = "(item_id = :id) AND (time > :time_start OR 1 = :time_start_flag) AND (time < :time_end OR 1 = :time_end_flag);"
+
+    def test_slice_condition_only_given_parameters(self):
+        plugin = self.plugin()
+        condition, params = plugin._slice_condition(1, time_start=10, changed_end=20)
+        self.assertEqual("item_id = :id AND time > :time_start AND changed < :changed_end", condition)
+        self.assertEqual({'id':1, 'time_start':10, 'changed_end':20}, params)
+
+    def test_slice_condition_uses_index(self):
+        plugin = self.plugin()
+        condition, params = plugin._slice_condition(1, time_start=10, time_end=20)
+        plan = plugin._fetchall("EXPLAIN QUERY PLAN SELECT {log_columns} FROM {log} WHERE " + condition, params)
+        self.assertIn("(item_id=? AND time>? AND time<?)", plan[0][3])
+
+    def test_iterLogs(self):
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        for t in range(10):
+            plugin.insertLog(id, time=t * 3600, duration=3600, val=t, it='num')
+        logs = plugin.iterLogs(id, time_start=3600, size=3)
+        self.assertNotIsInstance(logs, list)
+        self.assertEqual([t * 3600 for t in range(2, 10)], [log[0] for log in logs])
+
+    def test_given_conditions_use_index(self):
+        """ Time range queries with given conditions only use the (item_id, time)
+            index and return the same logs as flag based conditions
+        """
+        plugin = self.plugin()
+        id = self.create_item(plugin, 'main.num')
+        plugin.upsertLogs([(id, t, 1, t, 'num', t) for t in range(50000)])
+        condition, params = plugin._slice_condition(id, time_start=40000, time_end=40100)
+        plan = plugin._fetchall("EXPLAIN QUERY PLAN SELECT {log_columns} FROM {log} WHERE " + condition, params)
+        self.assertIn("USING INDEX log_item_id_time (item_id=? AND time>? AND time<?)", plan[0][3])
+        logs = plugin._fetchall("SELECT {log_columns} FROM {log} WHERE " + condition + " ORDER BY time", params)
+        self.assertEqual(list(range(40001, 40100)), [log[0] for log in logs])
+        flags = plugin._fetchall("SELECT {log_columns} FROM {log} WHERE " + self.FLAG_CONDITION[:-1] + " ORDER BY time", {'id':id, 'time_start':40000, 'time_start_flag':0, 'time_end':40100, 'time_end_flag':0})
+        self.assertEqual(logs, flags)
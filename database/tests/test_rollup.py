@@ -0,0 +1,124 @@
+
+from plugins.database import Database
+from plugins.database.tests.base import TestDatabaseBase
+
+class TestDatabaseRollup(TestDatabaseBase):
+
+    def read_rollup(self, plugin, rollup, name):
+        return plugin._fetchall("SELECT item_id, time, duration, val_sum, val_min, val_max, bool_sum FROM {" + rollup + "} WHERE item_id = :id ORDER BY time;", {'id':plugin.id(self.sh.return_item(name), False)})
+
+    def test_rollup_logs(self):
+        plugin = self.plugin()
+        rollups = {}
+        until = plugin._rollup_logs(rollups, 1, [(0, 1000, 10.0, 1), (1000, None, 20.0, 1)], 0)
+        self.assertEqual(1000, until)
+        self.assertEqual([1000, 10000.0, 10.0, 10.0, 1000.0], rollups[('log_minute', 1, 0)])
+        self.assertEqual([1000, 10000.0, 10.0, 10.0, 1000.0], rollups[('log_hour', 1, 0)])
+        self.assertEqual([1000, 10000.0, 10.0, 10.0, 1000.0], rollups[('log_day', 1, 0)])
+
+    def test_rollup_logs_adds_only_new_part(self):
+        plugin = self.plugin()
+        rollups = {}
+        until = plugin._rollup_logs(rollups, 1, [(0, 1000, 10.0, 1)], 0)
+        until = plugin._rollup_logs(rollups, 1, [(0, 3000, 10.0, 1)], until)
+        self.assertEqual(3000, until)
+        self.assertEqual([3000, 30000.0, 10.0, 10.0, 3000.0], rollups[('log_minute', 1, 0)])
+
+    def test_dump_updates_rollups(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.num')
+        plugin._buffer[item] = [(0, 60000, 10), (60000, None, 20)]
+        plugin._dump()
+        id = plugin.id(item, False)
+        self.assertEqual([(id, 0, 60000, 600000.0, 10.0, 10.0, 60000.0)], self.read_rollup(plugin, 'log_minute', 'main.num'))
+        plugin._buffer[item] = [(60000, 60000, 20), (120000, None, 30)]
+        plugin._dump()
+        self.assertEqual([(id, 0, 60000, 600000.0, 10.0, 10.0, 60000.0), (id, 60000, 60000, 1200000.0, 20.0, 20.0, 60000.0)], self.read_rollup(plugin, 'log_minute', 'main.num'))
+        self.assertEqual([(id, 0, 120000, 1800000.0, 10.0, 20.0, 120000.0)], self.read_rollup(plugin, 'log_hour', 'main.num'))
+
+    def test_buildRollups(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (0, 60, 10),
+          (60, 120, 20),
+          (120, None, 30)
+        ])
+        plugin.buildRollups()
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        self.assertEqual([(id, 0, 120000, 1800000.0, 10.0, 20.0, 120000.0)], self.read_rollup(plugin, 'log_hour', 'main.num'))
+        self.assertEqual(120000, plugin._rollup_until[id])
+
+    def test_deleteItem_deletes_rollups(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (0, 60, 10)
+        ])
+        plugin.buildRollups()
+        plugin.deleteItem(plugin.id(self.sh.return_item('main.num'), False))
+        self.assertEqual(0, plugin._fetchone("SELECT COUNT(*) FROM {log_minute};")[0])
+
+    def test_series_avg_uses_rollup(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', self.log_slice(0, 3600, self.log_slice_values_delta(10, 100, 10)))
+        plugin.buildRollups()
+        plugin._execute("DELETE FROM {log};", {})
+        res = plugin._series('avg', start=self.t(0), end=self.t(36000), item='main.num', count=5)
+        self.assertSeries([(0, 15.0), (7200, 35.0), (14400, 55.0), (21600, 75.0), (28800, 95.0), (36000, 95.0)], res)
+
+    def test_series_max_uses_rollup(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', self.log_slice(0, 3600, self.log_slice_values_delta(10, 100, 10)))
+        plugin.buildRollups()
+        res = plugin._series('max', start=self.t(0), end=self.t(36000), item='main.num', count=5)
+        self.assertSeries([(0, 20.0), (7200, 40.0), (14400, 60.0), (21600, 80.0), (28800, 100.0), (36000, 100.0)], res)
+
+    def test_series_rollup_keeps_value_at_start(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (0, 36000, 50),
+          (36000, 72000, 70)
+        ])
+        plugin.buildRollups()
+        res = plugin._series('avg', start=self.t(18000), end=self.t(54000), item='main.num', step=self.t(3600))
+        self.assertSeries([(18000, 50.0), (36000, 70.0), (54000, 70.0)], res)
+        # same as the log query
+        plugin._rollups = []
+        self.assertEqual(res['series'], plugin._series('avg', start=self.t(18000), end=self.t(54000), item='main.num', step=self.t(3600))['series'])
+
+    def test_buildRollups_sorts_logs(self):
+        plugin = self.plugin()
+        self.create_log(plugin, 'main.num', [
+          (60, 120, 20),
+          (0, 60, 10)
+        ])
+        plugin.buildRollups()
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        self.assertEqual([(id, 0, 120000, 1800000.0, 10.0, 20.0, 120000.0)], self.read_rollup(plugin, 'log_hour', 'main.num'))
+
+    def test_missing_rollups_built_after_start(self):
+        plugin = self.plugin({'database' : ':memory:', 'check_same_thread' : False})
+        self.create_log(plugin, 'main.num', self.log_slice(0, 3600, self.log_slice_values_delta(10, 100, 10)))
+        id = plugin.id(self.sh.return_item('main.num'), False)
+        plugin.run()
+        try:
+            self.assertEqual({id}, plugin._rollups_pending)
+            # series are read from the log table until the rollups are built
+            self.assertIsNone(plugin._fetch_rollup('main.num', 'MIN(time), MAX(val_max)', self.t(0), self.t(36000), count=5))
+            (job, kw) = self.sh.scheduler.jobs['Database rollups ' + plugin._name]
+            job()
+        finally:
+            plugin.alive = False
+            plugin._flush.set()
+            plugin._writer.join()
+        self.assertEqual(set(), plugin._rollups_pending)
+        self.assertEqual(10, len(self.read_rollup(plugin, 'log_hour', 'main.num')))
+        self.assertIsNotNone(plugin._fetch_rollup('main.num', 'MIN(time), MAX(val_max)', self.t(0), self.t(36000), count=5))
+
+    def test_no_rollups_for_str_items(self):
+        plugin = self.plugin()
+        item = self.sh.return_item('main.str')
+        plugin._buffer[item] = [(0, 60000, 'a'), (60000, None, 'b')]
+        plugin._dump()
+        self.assertEqual([], self.read_rollup(plugin, 'log_minute', 'main.str'))
+        self.assertIsNone(plugin._fetch_rollup('main.str', 'MIN(time), MAX(val_max)', self.t(0), self.t(36000), count=5))
+        self.assertEqual(set(), plugin._missing_rollups())
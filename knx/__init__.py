@@ -24,15 +24,7 @@
 #  along with SmartHomeNG.py. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
-# dict for statistic functions:
-# stats_pa = { ga1 : { 'read' : n-read,
-#                      'write' : n-write,
-#                      'response' : n-response,
-#                      'last_read' : datetime,
-#                      'last_write' : datetime,
-#                      'last_response' : datetime },
-#              ga2 : {...} }
-
+import collections
 import logging
 import threading
 import struct
@@ -44,6 +36,7 @@ import lib.connection
 from lib.model.smartplugin import SmartPlugin
 from datetime import timedelta
 from . import dpts
+from . import stats
 
 # types from knxd\src\include\eibtypes.h
 KNXD_OPEN_GROUPCON  = 38     # 0x26
@@ -52,13 +45,15 @@ KNXD_CACHE_ENABLE   = 112    # 0x70
 KNXD_CACHE_DISABLE  = 113    # 0x71
 KNXD_CACHE_READ     = 116    # 0x74 
 
-KNXD_CACHEREAD_DELAY  = 0.35
-KNXD_CACHEREAD_DELAY  = 0.0
-
 KNXREAD = 0x00
 KNXRESP = 0x40
 KNXWRITE = 0x80
 
+_ADDRESSES = struct.Struct('>HH')
+
+# lanes of the send queue in order of their priority
+SEND_LANES = ['response', 'read', 'write']
+
 # deprecated due to the new smartplugin model
 # KNX_INSTANCE = 'knx_instance'     # which instance of plugin to use for a given item (deprecated!)
 KNX_DPT      = 'knx_dpt'          # data point type
@@ -77,6 +72,8 @@ ITEMS = 'items'
 LOGIC = 'logic'
 LOGICS = 'logics'
 DPT='dpt'
+DECODE='decode'
+ENCODE='encode'
 
 class KNX(lib.connection.Client,SmartPlugin):
     ALLOW_MULTIINSTANCE = True
@@ -89,7 +86,8 @@ class KNX(lib.connection.Client,SmartPlugin):
     ITEM_TAG_PLUS = [KNX_DTP]
 
     def __init__(self, smarthome, time_ga=None, date_ga=None, send_time=False, busmonitor=False, host='127.0.0.1',
-                 port=6720, readonly=False, instance='default', enable_stats = True):
+                 port=6720, readonly=False, instance='default', enable_stats = True, send_rate=0,
+                 cache_window=10, cache_timeout=2, cache_retries=1):
         lib.connection.Client.__init__(self, host, port, monitor=True)
         self.logger = logging.getLogger(__name__)
         self.logger.debug("init knx")        
@@ -97,8 +95,18 @@ class KNX(lib.connection.Client,SmartPlugin):
         self.gal = {}                   # group addresses to listen to {DPT: dpt, ITEMS: [item 1, item 2, ..., item n], LOGICS: [ logic 1, logic 2, ..., logic n]}
         self.gar = {}                   # group addresses to reply if requested from knx, {DPT: dpt, ITEM: item, LOGIC: None}
         self._init_ga = []
+        self._encoders = {}             # encoders of the items to send, {item id: encoder}
         self._cache_ga = []             # group addresses which should be initalized by the knxd cache
-        self._cache_ga_response_pending = []
+        self._cache_ga_response_pending = set()
+        self._cache_window = int(cache_window)      # cache reads waiting for a response from knxd
+        self._cache_timeout = float(cache_timeout)
+        self._cache_retries = int(cache_retries)
+        self._cache_inflight = collections.OrderedDict()    # {ga: time of the cache read}
+        self._cache_misses = []
+        self._cache_cond = threading.Condition()
+        self._held = None               # telegrams sent while the group socket is not open yet
+        self._held_lock = threading.Lock()
+        self.stats_cache = {}
         self.time_ga = time_ga
         self.date_ga = date_ga
         self._instance = instance
@@ -106,13 +114,18 @@ class KNX(lib.connection.Client,SmartPlugin):
         self._bm_separatefile = False
         self._bm_format= "KNX[{0}]: {1} set {2} to {3}"
         # following needed for statistics
-        self.enable_stats = enable_stats
-        self.stats_ga = {}              # statistics for used group addresses on the BUS
-        self.stats_pa = {}              # statistics for used group addresses on the BUS
+        self._stats_enabled = self.to_bool(enable_stats)
+        self._stats = stats.BusStats()  # statistics for used group and physical addresses on the BUS
         self.stats_last_read = None     # last read request from KNX
         self.stats_last_write = None    # last write from KNX
         self.stats_last_response = None # last response from KNX
         self.stats_last_action = None   # the newes
+        # send queue with one lane per telegram type, {lane: {ga: telegram}}
+        self._send_rate = float(send_rate)
+        self._send_lanes = collections.OrderedDict((lane, collections.OrderedDict()) for lane in SEND_LANES)
+        self._send_cond = threading.Condition()
+        self._send_thread = None
+        self.stats_queue = {lane: {'queued': 0, 'sent': 0, 'coalesced': 0, 'max_depth': 0} for lane in SEND_LANES}
 
         if self.to_bool(busmonitor,default=busmonitor):
             self._busmonitor = self.logger.info
@@ -151,7 +164,56 @@ class KNX(lib.connection.Client,SmartPlugin):
         send.extend(data)
         self.send(send)
 
-    def groupwrite(self, ga, payload, dpt, flag='write'):
+    def _queue(self, lane, ga, pkt):
+        """
+        sends a telegram via the send queue if a send_rate is given, a telegram
+        for the same ga still waiting in the lane is replaced by the new one.
+        During the cache warm-up telegrams are held until the group socket is open.
+        """
+        with self._held_lock:
+            if self._held is not None:
+                self._held.append((lane, ga, pkt))
+                return
+        if self._send_rate <= 0:
+            self._send(pkt)
+            return
+        with self._send_cond:
+            queue = self._send_lanes[lane]
+            stats = self.stats_queue[lane]
+            if ga in queue:
+                stats['coalesced'] += 1
+            else:
+                stats['queued'] += 1
+            queue[ga] = pkt
+            stats['max_depth'] = max(stats['max_depth'], len(queue))
+            self._send_cond.notify()
+
+    def _send_lane(self):
+        for lane, queue in self._send_lanes.items():
+            if queue:
+                return lane
+        return None
+
+    def _sender(self):
+        interval = 1.0 / self._send_rate
+        next = time.time()
+        while self.alive:
+            with self._send_cond:
+                lane = self._send_lane()
+                while self.alive and lane is None:
+                    self._send_cond.wait()
+                    lane = self._send_lane()
+                if lane is None:
+                    return
+                ga, pkt = self._send_lanes[lane].popitem(last=False)
+                self.stats_queue[lane]['sent'] += 1
+            self._send(pkt)
+            next = max(next + interval, time.time())
+            delay = next - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def groupwrite(self, ga, payload, dpt, flag='write', encoder=None):
         pkt = bytearray([0, KNXD_GROUP_PACKET])
         try:
             pkt.extend(self.encode(ga, 'ga'))
@@ -159,7 +221,10 @@ class KNX(lib.connection.Client,SmartPlugin):
             self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.get_instance_name(), ga))
             return
         pkt.extend([0])
-        pkt.extend(self.encode(payload, dpt))
+        if encoder is None:
+            pkt.extend(self.encode(payload, dpt))
+        else:
+            pkt.extend(encoder(payload))
         if flag == 'write':
             flag = KNXWRITE
         elif flag == 'response':
@@ -173,7 +238,7 @@ class KNX(lib.connection.Client,SmartPlugin):
         if self.readonly:
             self.logger.info("KNX[{2}]: groupwrite telegram for: {0} - Value: {1} not send. Plugin in READONLY mode. ".format(ga,payload,self.get_instance_name()))
         else:
-            self._send(pkt)
+            self._queue('response' if flag == KNXRESP else 'write', ga, pkt)
 
     def _cacheread(self, ga):
         pkt = bytearray([0, KNXD_CACHE_READ])
@@ -194,7 +259,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             self.logger.warning('KNX[{0}]: problem encoding ga: {1}'.format(self.get_instance_name(), ga))
             return
         pkt.extend([0, KNXREAD])
-        self._send(pkt)
+        self._queue('read', ga, pkt)
 
     def _poll(self, **kwargs):
         if ITEM in kwargs:
@@ -230,22 +295,29 @@ class KNX(lib.connection.Client,SmartPlugin):
         enable_cache = bytearray([0, KNXD_CACHE_ENABLE])
         self._send(enable_cache)
         self.found_terminator = self.parse_length
-        if self._cache_ga != []:
-            if self.connected:
-                self.logger.debug('KNX[{0}]: reading knxd cache'.format(self.get_instance_name()))
-                for ga in self._cache_ga:
-                    self._cache_ga_response_pending.append(ga)
-                for ga in self._cache_ga:
-                    self._cacheread(ga)
-                    # wait a little to not overdrive the knxd unless there is a fix
-                    time.sleep(KNXD_CACHEREAD_DELAY)
-                self._cache_ga = []
-                self.logger.debug('KNX[{0}]: finished reading knxd cache'.format(self.get_instance_name()))
+        self.terminator = 2
+        if self._cache_ga != [] and self.connected:
+            # the group socket is opened when all cache reads are answered, telegrams are held until then
+            with self._held_lock:
+                if self._held is None:
+                    self._held = []
+            warmup = threading.Thread(target=self._cache_warmup, name='KNX[{0}] cache warm-up'.format(self.get_instance_name()))
+            warmup.daemon = True
+            warmup.start()
+        else:
+            self._open_groupcon()
 
+    def _open_groupcon(self):
         self.logger.debug('KNX[{0}]: enable group monitor'.format(self.get_instance_name()))
         init = bytearray([0, KNXD_OPEN_GROUPCON, 0, 0, 0])
         self._send(init)
-        self.terminator = 2
+        with self._held_lock:
+            held = self._held or []
+            self._held = None
+        if held:
+            self.logger.debug('KNX[{0}]: sending {1} telegrams held during the cache warm-up'.format(self.get_instance_name(), len(held)))
+        for lane, ga, pkt in held:
+            self._queue(lane, ga, pkt)
         if self._init_ga != []:
             if self.connected:
                 self.logger.debug('KNX[{0}]: knxd init read for {1} ga'.format(self.get_instance_name(),len(self._init_ga)))
@@ -254,6 +326,69 @@ class KNX(lib.connection.Client,SmartPlugin):
                 self._init_ga = []
                 self.logger.debug('KNX[{0}]: finished knxd init read'.format(self.get_instance_name()))
 
+    def _cache_warmup(self):
+        """
+        reads the values of the knx_cache group addresses from the knxd cache with
+        cache_window reads in flight. Reads without response are retried after
+        cache_timeout seconds, group addresses not in the cache are read from the bus
+        """
+        start = time.time()
+        self.logger.debug('KNX[{0}]: reading knxd cache'.format(self.get_instance_name()))
+        queue = collections.deque(self._cache_ga)
+        retries = collections.Counter()
+        with self._cache_cond:
+            self._cache_ga_response_pending = set(self._cache_ga)
+            self._cache_inflight.clear()
+            self._cache_misses = []
+            while (queue or self._cache_inflight) and self.connected:
+                now = time.time()
+                for ga, sent in list(self._cache_inflight.items()):
+                    if now - sent < self._cache_timeout:
+                        break
+                    del self._cache_inflight[ga]
+                    if retries[ga] < self._cache_retries:
+                        retries[ga] += 1
+                        queue.append(ga)
+                    else:
+                        self._cache_misses.append(ga)
+                while queue and len(self._cache_inflight) < self._cache_window:
+                    ga = queue.popleft()
+                    self._cache_inflight[ga] = now
+                    self._cacheread(ga)
+                if self._cache_inflight:
+                    timeout = next(iter(self._cache_inflight.values())) + self._cache_timeout - time.time()
+                    self._cache_cond.wait(max(timeout, 0.01))
+            if not self.connected:
+                return
+            misses = self._cache_misses
+            self._cache_misses = []
+        duration = time.time() - start
+        self.stats_cache = {'count': len(self._cache_ga), 'unsatisfied': len(misses), 'retries': sum(retries.values()),
+                            'duration': duration, 'last': self._sh.now()}
+        self.logger.info('KNX[{0}]: cache warm-up of {1} ga completed in {2:.2f} s, {3} unsatisfied'.format(
+            self.get_instance_name(), len(self._cache_ga), duration, len(misses)))
+        # group addresses not satisfied by the cache are read from the bus
+        self._init_ga.extend(ga for ga in misses if ga not in self._init_ga)
+        self._open_groupcon()
+
+    def _cache_response(self, ga, satisfied):
+        """
+        a cache read was answered by knxd, ga is None if the response does not tell the
+        group address. knxd answers in order, so it belongs to the oldest read in flight.
+        """
+        with self._cache_cond:
+            if ga is None:
+                if not self._cache_inflight:
+                    return
+                ga = next(iter(self._cache_inflight))
+            if self._cache_inflight.pop(ga, None) is None:
+                return
+            if satisfied:
+                self._cache_ga_response_pending.discard(ga)
+            else:
+                self._cache_misses.append(ga)
+            self._cache_cond.notify()
+
 #   def collect_incoming_data(self, data):
 #       print('#  bin   h  d')
 #       for i in data:
@@ -275,6 +410,15 @@ class KNX(lib.connection.Client,SmartPlugin):
     def decode(self, data, dpt):
         return dpts.decode[str(dpt)](data)
 
+    def decode_batch(self, payloads, dpt):
+        """
+        decodes a list of payloads of the same dpt at once
+        :param payloads: list of payloads (bytes or bytearray)
+        :param dpt: data point type of the payloads
+        :return: list of decoded values
+        """
+        return dpts.decode_batch(payloads, dpt)
+
     def parse_telegram(self, data):
         """
         inspects a received eibd/knxd compatible telegram
@@ -291,15 +435,23 @@ class KNX(lib.connection.Client,SmartPlugin):
         self.found_terminator = self.parse_length  # reset parser and terminator
         self.terminator = 2
         typ = struct.unpack(">H", data[0:2])[0]
+        if typ == KNXD_CACHE_READ and len(data) < 8:
+            # group address not in the knxd cache, knxd does not echo the group address of a miss
+            dst = data[4:6] if len(data) >= 6 else b''
+            self._cache_response(dpts.dega(dst) if any(dst) else None, False)
+            return
         if (typ != KNXD_GROUP_PACKET and typ != KNXD_CACHE_READ) or len(data) < 8:
             # self.logger.debug("Ignore telegram.")
             return
         if (data[6] & 0x03 or (data[7] & 0xC0) == 0xC0):
             self.logger.debug("KNX[{0}]: Unknown APDU".format(self.get_instance_name()))
             return
-        src = self.decode(data[2:4], 'pa')
-        dst = self.decode(data[4:6], 'ga')
         flg = data[7] & 0xC0
+        if self._stats_enabled:
+            src, dst = _ADDRESSES.unpack_from(data, 2)
+            self._stats.record(src, dst, flg >> 6, len(data) - 6)
+        src = dpts.depa(data[2:4])
+        dst = dpts.dega(data[4:6])
         if flg == KNXWRITE:
             flg = 'write'
         elif flg == KNXREAD:
@@ -314,25 +466,6 @@ class KNX(lib.connection.Client,SmartPlugin):
         else:
             payload = data[8:]
 
-        if self.enable_stats:
-            # update statistics on used group addresses
-            if not dst in self.stats_ga:
-                self.stats_ga[dst] = {}
-
-            if not flg in self.stats_ga[dst]:
-                self.stats_ga[dst][flg] = 1
-            else:
-                self.stats_ga[dst][flg] = self.stats_ga[dst][flg] + 1
-
-            # update statistics on used group addresses
-            if not src in self.stats_pa:
-                self.stats_pa[src] = {}
-
-            if not flg in self.stats_pa[src]:
-                self.stats_pa[src][flg] = 1
-            else:
-                self.stats_pa[src][flg] = self.stats_pa[src][flg] + 1
-
         # further inspect what to do next
         if flg == 'write' or flg == 'response':
             if dst not in self.gal:  # update item/logic
@@ -340,7 +473,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                 return
             dpt = self.gal[dst][DPT]
             try:
-                val = self.decode(payload, dpt)
+                val = self.gal[dst][DECODE](payload)
             except Exception as e:
                 self.logger.exception("KNX[{0}]: Problem decoding frame from {1} to {2} with '{3}' and DPT {4}. Exception: {5}".format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode(), dpt, e))
                 return
@@ -354,8 +487,7 @@ class KNX(lib.connection.Client,SmartPlugin):
 
                 # remove all ga that came from a cache read request
                 if typ == KNXD_CACHE_READ:
-                    if dst in self._cache_ga_response_pending:
-                        self._cache_ga_response_pending.remove(dst)
+                    self._cache_response(dst, True)
                 way = "" if typ != KNXD_CACHE_READ else " (from knxd Cache)"
                 self.logger.debug("KNX[{0}]: {5} request from {1} to {2} with '{3}' and DPT {4}{6}".format(self.get_instance_name(), src, dst, binascii.hexlify(payload).decode(), dpt, flg, way))
                 for item in self.gal[dst][ITEMS]:
@@ -364,27 +496,36 @@ class KNX(lib.connection.Client,SmartPlugin):
                     logic.trigger('KNX', src, val, dst)
             else:
                 self.logger.warning("KNX[{0}]: Wrong payload '{3}' for ga '{2}' with dpt '{1}'.".format(self.get_instance_name(), dpt, dst, binascii.hexlify(payload).decode()))
-            if self.enable_stats:
+            if self._stats_enabled:
                 if flg == 'write':
                     self.stats_last_write = self._sh.now()
                 else:
                     self.stats_last_response = self._sh.now()
         elif flg == 'read':
             self.logger.debug("KNX[{0}]: {1} read {2}".format(self.get_instance_name(), src, dst))
-            if self.enable_stats:
+            if self._stats_enabled:
                 self.stats_last_read = self._sh.now()
             if dst in self.gar:  # read item
                 if self.gar[dst][ITEM] is not None:
                     item = self.gar[dst][ITEM]
-                    self.groupwrite(dst, item(), self.get_iattr_value(item.conf,KNX_DPT), 'response')
+                    self.groupwrite(dst, item(), self.get_iattr_value(item.conf,KNX_DPT), 'response', self.gar[dst][ENCODE])
                 if self.gar[dst][LOGIC] is not None:
                     self.gar[dst][LOGIC].trigger('KNX', src, None, dst)
 
     def run(self):
         self.alive = True
+        if self._send_rate > 0:
+            self._send_thread = threading.Thread(target=self._sender, name='KNX[{0}] sender'.format(self.get_instance_name()))
+            self._send_thread.daemon = True
+            self._send_thread.start()
 
     def stop(self):
         self.alive = False
+        if self._send_thread is not None:
+            with self._send_cond:
+                self._send_cond.notify()
+            self._send_thread.join()
+            self._send_thread = None
         self.handle_close()
 
     def parse_item(self, item):
@@ -425,7 +566,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             for ga in knx_listen:
                 self.logger.debug("KNX[{0}]: {1} listen on {2}".format(self.get_instance_name(), item, ga))
                 if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
+                    self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: [], DECODE: dpts.decode[str(dpt)]}
                 else:
                     if not item in self.gal[ga][ITEMS]:
                         self.gal[ga][ITEMS].append(item)
@@ -434,7 +575,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             ga = self.get_iattr_value(item.conf, KNX_INIT)
             self.logger.debug("KNX[{0}]: {1} listen on and init with {2}".format(self.get_instance_name(), item, ga))
             if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
+                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: [], DECODE: dpts.decode[str(dpt)]}
             else:
                 if not item in self.gal[ga][ITEMS]:
                     self.gal[ga][ITEMS].append(item)
@@ -444,7 +585,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             ga = self.get_iattr_value(item.conf, KNX_CACHE)
             self.logger.debug("KNX[{0}]: {1} listen on and init with cache {2}".format(self.get_instance_name(), item, ga))
             if not ga in self.gal:
-                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: []}
+                self.gal[ga] = {DPT: dpt, ITEMS: [item], LOGICS: [], DECODE: dpts.decode[str(dpt)]}
             else:
                 if not item in self.gal[ga][ITEMS]:
                     self.gal[ga][ITEMS].append(item)
@@ -457,7 +598,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             for ga in knx_reply:
                 self.logger.debug("KNX[{0}]: {1} reply to {2}".format(self.get_instance_name(), item, ga))
                 if ga not in self.gar:
-                    self.gar[ga] = {DPT: dpt, ITEM: item, LOGIC: None}
+                    self.gar[ga] = {DPT: dpt, ITEM: item, LOGIC: None, ENCODE: dpts.codec(dpt)[0]}
                 else:
                     self.logger.warning(
                         "KNX[{0}]: {1} knx_reply ({2}) already defined for {3}".format(self.get_instance_name(), item.id(), ga,
@@ -474,6 +615,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                 #item.conf['knx_status'] = [self.get_iattr_value(item.conf,'knx_status'), ]
 
         if self.has_iattr(item.conf, KNX_STATUS) or self.has_iattr(item.conf, KNX_SEND):
+            self._encoders[item.id()] = dpts.codec(dpt)[0]
             return self.update_item
 
         if self.has_iattr(item.conf, KNX_POLL):
@@ -524,7 +666,7 @@ class KNX(lib.connection.Client,SmartPlugin):
             for ga in knx_listen:
                 self.logger.debug("KNX[{0}]: {1} listen on {2}".format(self.get_instance_name(), logic, ga))
                 if not ga in self.gal:
-                    self.gal[ga] = {DPT: dpt, ITEMS: [], LOGICS: [logic]}
+                    self.gal[ga] = {DPT: dpt, ITEMS: [], LOGICS: [logic], DECODE: dpts.decode[str(dpt)]}
                 else:
                     self.gal[ga][LOGICS].append(logic)
 
@@ -541,7 +683,7 @@ class KNX(lib.connection.Client,SmartPlugin):
                         obj = self.gar[ga][LOGIC]
                     self.logger.warning("KNX[{0}]: {1} knx_reply ({2}) already defined for {3}".format(self.get_instance_name(), logic, ga, obj))
                 else:
-                    self.gar[ga] = {DPT: dpt, ITEM: None, LOGIC: logic}
+                    self.gar[ga] = {DPT: dpt, ITEM: None, LOGIC: logic, ENCODE: dpts.codec(dpt)[0]}
 
     def update_item(self, item, caller=None, source=None, dest=None):
         """
@@ -549,14 +691,15 @@ class KNX(lib.connection.Client,SmartPlugin):
         :param item: the item with its attributes
         :param caller: a hint to the originator of the values change
         """
+        encoder = self._encoders.get(item.id())
         if self.has_iattr(item.conf, KNX_SEND):
             if caller != 'KNX':
                 for ga in self.get_iattr_value(item.conf, KNX_SEND):
-                    self.groupwrite(ga, item(), self.get_iattr_value(item.conf, KNX_DPT))
+                    self.groupwrite(ga, item(), self.get_iattr_value(item.conf, KNX_DPT), encoder=encoder)
         if self.has_iattr(item.conf, KNX_STATUS):
             for ga in self.get_iattr_value(item.conf, KNX_STATUS):  # send status update
                 if ga != dest:
-                    self.groupwrite(ga, item(), self.get_iattr_value(item.conf, KNX_DPT))
+                    self.groupwrite(ga, item(), self.get_iattr_value(item.conf, KNX_DPT), encoder=encoder)
 
     """
     The statistics functions were introduced to watch what is happening on the KNX.
@@ -574,18 +717,18 @@ class KNX(lib.connection.Client,SmartPlugin):
     - adresses that do not react upon requests
     - adresses that can't satisfy cache requests
     """
-    def enable_stats(sef):
+    def enable_stats(self):
         """
         Enables the tracking of KNX telegrams during runtime of SmartHomeNG
         """
-        self.enable_stats = True
+        self._stats_enabled = True
 
-    def disable_stats(sef):
+    def disable_stats(self):
         """
         Disables the tracking of KNX telegrams during runtime of SmartHomeNG
         It might be a good idea to clear your stats afterwards with clear_stats()
         """
-        self.enable_stats = False
+        self._stats_enabled = False
 
     def clear_stats(self):
         """
@@ -598,17 +741,13 @@ class KNX(lib.connection.Client,SmartPlugin):
         """
         clear statistic values for group addresses
         """
-        if len(self.stats_ga):
-            for ga in self.stats_ga:
-                self.stats_ga[ga] = {}
+        self._stats.ga.clear()
 
     def clear_stats_pa(self):
         """
         clear statistic values for physical addresses
         """
-        if len(self.stats_pa):
-            for ga in self.stats_pa:
-                self.stats_pa[ga] = {}
+        self._stats.pa.clear()
 
     def get_stats_ga(self):
         """
@@ -616,15 +755,12 @@ class KNX(lib.connection.Client,SmartPlugin):
         ```
         stats_ga = { ga1 : { 'read' : n-read,               # counter of read requests from KNX
                              'write' : n-write,             # counter of write operations from KNX
-                             'response' : n-response,       # counter of response operations from KNX
-                             'last_read' : datetime,        # the respective datetime object of read,
-                             'last_write' : datetime,       # write
-                             'last_response' : datetime },  # and response
+                             'response' : n-response },     # counter of response operations from KNX
                      ga2 : {...} }
         ```
         :return: dict
         """
-        return self.stats_ga
+        return self._stats.ga.dict()
 
     def get_stats_pa(self):
         """
@@ -632,15 +768,38 @@ class KNX(lib.connection.Client,SmartPlugin):
         ```
         stats_pa = { pa1 : { 'read' : n-read,               # counter of read requests from KNX
                              'write' : n-write,             # counter of write operations from KNX
-                             'response' : n-response,       # counter of response operations from KNX
-                             'last_read' : datetime,        # the respective datetime object of read,
-                             'last_write' : datetime,       # write
-                             'last_response' : datetime },  # and response
+                             'response' : n-response },     # counter of response operations from KNX
                      pa2 : {...} }
         ```
         :return: dict
         """
-        return self.stats_pa
+        return self._stats.pa.dict()
+
+    def get_stats_rate(self, window='minute'):
+        """
+        return the telegrams per second received from KNX
+        :param window: 'minute' for the last minute or 'hour' for the last hour
+        :return: float
+        """
+        return self._stats.rate(window)
+
+    def get_stats_bus_load(self, window='minute'):
+        """
+        return the estimated load of the bus by the received telegrams
+        :param window: 'minute' for the last minute or 'hour' for the last hour
+        :return: percentage of the TP1 bit rate as float
+        """
+        return self._stats.load(window)
+
+    def get_stats_top(self, n=10, window='minute', kind='ga'):
+        """
+        return the addresses with the most telegrams
+        :param n: number of addresses
+        :param window: 'minute' for the running minute or 'hour' for the last hour
+        :param kind: 'ga' for group addresses or 'pa' for the physical addresses of the senders
+        :return: list of (address, number of telegrams) tuples
+        """
+        return self._stats.top(n, window, kind)
 
     def get_stats_last_read(self):
         """
@@ -673,6 +832,27 @@ class KNX(lib.connection.Client,SmartPlugin):
             ar.remove(None)
         return max(ar)
 
+    def get_stats_queue(self):
+        """
+        returns a dict with the statistics of the send queue (plugin attribute send_rate)
+        ```
+        stats_queue = { 'response' : { 'depth' : n,         # telegrams waiting to be sent
+                                       'max_depth' : n,     # maximum of waiting telegrams
+                                       'queued' : n,        # counter of queued telegrams
+                                       'coalesced' : n,     # counter of telegrams replaced by a newer one for the same ga
+                                       'sent' : n },        # counter of sent telegrams
+                        'read' : {...},
+                        'write' : {...} }
+        ```
+        :return: dict
+        """
+        with self._send_cond:
+            stats = {}
+            for lane, queue in self._send_lanes.items():
+                stats[lane] = dict(self.stats_queue[lane])
+                stats[lane]['depth'] = len(queue)
+            return stats
+
     def get_unsatisfied_cache_read_ga(self):
         """
         At start all items that have a knx_cache attribute will be queried to knxd
@@ -681,6 +861,20 @@ class KNX(lib.connection.Client,SmartPlugin):
         So ideally no reminding ga should be left after a delay time of startup
         :return: list of group addresses that did not receive a cache read response
         """
-        return self._cache_ga_response_pending
+        return sorted(self._cache_ga_response_pending)
+
+    def get_stats_cache(self):
+        """
+        returns a dict with the result of the last knxd cache warm-up
+        ```
+        stats_cache = { 'count' : n,            # group addresses with knx_cache attribute
+                        'unsatisfied' : n,      # group addresses not found in the knxd cache (read from the bus instead)
+                        'retries' : n,          # cache reads repeated after cache_timeout
+                        'duration' : seconds,   # duration of the warm-up
+                        'last' : datetime }     # end of the warm-up
+        ```
+        :return: dict
+        """
+        return self.stats_cache
 
 
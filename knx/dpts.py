@@ -22,6 +22,23 @@
 import struct
 import datetime
 
+# precompiled structs of the fixed size DPTs
+_H = struct.Struct('>H')
+_h = struct.Struct('>h')
+_I = struct.Struct('>I')
+_i = struct.Struct('>i')
+_f = struct.Struct('>f')
+
+# DPT 5.001 values of all possible payloads
+_de5001 = [round(i * 100.0 / 255, 1) for i in range(256)]
+
+
+def _en(fmt, value):
+    # payload with leading APCI byte
+    ret = bytearray(1 + fmt.size)
+    fmt.pack_into(ret, 1, value)
+    return ret
+
 
 def en1(value):
     return [int(value) & 0x01]
@@ -81,7 +98,7 @@ def en5(value):
 def de5(payload):
     if len(payload) != 1:
         return None
-    return round(struct.unpack('>B', payload)[0], 1)
+    return payload[0]
 
 
 def en5001(value):
@@ -95,7 +112,7 @@ def en5001(value):
 def de5001(payload):
     if len(payload) != 1:
         return None
-    return round(struct.unpack('>B', payload)[0] * 100.0 / 255, 1)
+    return _de5001[payload[0]]
 
 
 def en6(value):
@@ -103,25 +120,23 @@ def en6(value):
         value = -128
     elif value > 127:
         value = 127
-    return [0, struct.pack('b', int(value))[0]]
+    return [0, int(value) & 0xff]
 
 
 def de6(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('b', payload)[0]
+    return (payload[0] ^ 0x80) - 0x80
 
 
 def en7(value):
-    ret = bytearray([0])
-    ret.extend(struct.pack('>H', int(value)))
-    return ret
+    return _en(_H, int(value))
 
 
 def de7(payload):
     if len(payload) != 2:
         return None
-    return struct.unpack('>H', payload)[0]
+    return _H.unpack(payload)[0]
 
 
 def en8(value):
@@ -129,15 +144,13 @@ def en8(value):
         value = -32768
     elif value > 32767:
         value = 32767
-    ret = bytearray([0])
-    ret.extend(struct.pack('>h', int(value)))
-    return ret
+    return _en(_h, int(value))
 
 
 def de8(payload):
     if len(payload) != 2:
         return None
-    return struct.unpack('>h', payload)[0]
+    return _h.unpack(payload)[0]
 
 
 def en9(value):
@@ -163,7 +176,7 @@ def de9(payload):
     m = (i1 & 0x07) << 8 | i2
     if s == 1:
         s = -1 << 11
-    f = (m | s) * 0.01 * pow(2, e)
+    f = (m | s) * 0.01 * (1 << e)
     return round(f, 2)
 
 
@@ -194,15 +207,13 @@ def en12(value):
         value = 0
     elif value > 4294967295:
         value = 4294967295
-    ret = bytearray([0])
-    ret.extend(struct.pack('>I', int(value)))
-    return ret
+    return _en(_I, int(value))
 
 
 def de12(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>I', payload)[0]
+    return _I.unpack(payload)[0]
 
 
 def en13(value):
@@ -210,27 +221,23 @@ def en13(value):
         value = -2147483648
     elif value > 2147483647:
         value = 2147483647
-    ret = bytearray([0])
-    ret.extend(struct.pack('>i', int(value)))
-    return ret
+    return _en(_i, int(value))
 
 
 def de13(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>i', payload)[0]
+    return _i.unpack(payload)[0]
 
 
 def en14(value):
-    ret = bytearray([0])
-    ret.extend(struct.pack('>f', value))
-    return ret
+    return _en(_f, value)
 
 
 def de14(payload):
     if len(payload) != 4:
         return None
-    return struct.unpack('>f', payload)[0]
+    return _f.unpack(payload)[0]
 
 
 def en16000(value):
@@ -262,7 +269,7 @@ def en17(value):
 def de17(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('>B', payload)[0] & 0x3f
+    return payload[0] & 0x3f
 
 
 def en20(value):
@@ -272,7 +279,7 @@ def en20(value):
 def de20(payload):
     if len(payload) != 1:
         return None
-    return struct.unpack('>B', payload)[0]
+    return payload[0]
 
 
 def en24(value):
@@ -293,13 +300,13 @@ def en232(value):
 def de232(payload):
     if len(payload) != 3:
         return None
-    return list(struct.unpack('>BBB', payload))
+    return list(payload)
 
 
 def depa(string):
     if len(string) != 2:
         return None
-    pa = struct.unpack(">H", string)[0]
+    pa = _H.unpack(string)[0]
     return "{0}.{1}.{2}".format((pa >> 12) & 0x0f, (pa >> 8) & 0x0f, (pa) & 0xff)
 
 
@@ -311,7 +318,7 @@ def enga(ga):
 def dega(string):
     if len(string) != 2:
         return None
-    ga = struct.unpack(">H", string)[0]
+    ga = _H.unpack(string)[0]
     return "{0}/{1}/{2}".format((ga >> 11) & 0x1f, (ga >> 8) & 0x07, (ga) & 0xff)
 
 
@@ -374,3 +381,34 @@ encode = {
     'ga': enga
 }
 # DPT: 19, 28
+
+# structs to decode several payloads of the same DPT at once
+_batch = {
+    '7': _H,
+    '8': _h,
+    '12': _I,
+    '13': _i,
+    '14': _f
+}
+
+
+def codec(dpt):
+    """
+    Returns the encoder and decoder function of the DPT (the encoder is None
+    for decode only DPTs), raises KeyError for unknown DPTs
+    """
+    dpt = str(dpt)
+    return encode.get(dpt), decode[dpt]
+
+
+def decode_batch(payloads, dpt):
+    """
+    Decodes a list of payloads of the same DPT, returns the list of values
+    """
+    dpt = str(dpt)
+    if dpt in _batch:
+        fmt = _batch[dpt]
+        if all(len(payload) == fmt.size for payload in payloads):
+            return [value[0] for value in fmt.iter_unpack(b''.join(payloads))]
+    decoder = decode[dpt]
+    return [decoder(payload) for payload in payloads]
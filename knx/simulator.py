@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+knxd stand-in to run the KNX plugin under load without a bus
+
+The simulator speaks the part of the knxd protocol used by the plugin (group
+socket, group packets, cache) and replays recorded or synthetic telegrams at
+a configurable rate. With --probe every written group address is read back,
+the reply of the plugin (knx_reply) measures the end-to-end latency of the
+item update. Writes without a matching reply are counted as dropped.
+
+Run it from the SmartHomeNG base directory and point the plugin to its port:
+
+    python3 -m plugins.knx.simulator --port 6720 --synthetic 50000 --gas 5000 --rate 200 --probe
+    python3 -m plugins.knx.simulator --port 6720 --record bus.log
+    python3 -m plugins.knx.simulator --port 6720 --replay bus.log --speed 10
+
+Recorded telegrams are stored one per line as 'time source destination apdu',
+e.g. '0.250000 1.1.1 1/2/3 0080' with the APDU in hex.
+"""
+
+import argparse
+import binascii
+import collections
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from . import dpts
+
+# types from knxd\src\include\eibtypes.h
+KNXD_OPEN_GROUPCON  = 38     # 0x26
+KNXD_GROUP_PACKET   = 39     # 0x27
+KNXD_CACHE_ENABLE   = 112    # 0x70
+KNXD_CACHE_DISABLE  = 113    # 0x71
+KNXD_CACHE_READ     = 116    # 0x74
+
+KNXREAD = 0x00
+KNXRESP = 0x40
+KNXWRITE = 0x80
+
+FLAGS = {'read': KNXREAD, 'response': KNXRESP, 'write': KNXWRITE}
+
+Telegram = collections.namedtuple('Telegram', ['time', 'src', 'dst', 'apdu'])
+
+
+def enpa(pa):
+    pa = pa.split('.')
+    return [int(pa[0]) << 4 | int(pa[1]), int(pa[2])]
+
+
+def telegram(dst, value=None, dpt=None, flag='write', src='1.1.1', time=0.0):
+    """
+    Returns the telegram writing value with the given dpt to the group address dst
+    """
+    apdu = bytearray([0, FLAGS[flag]])
+    if flag != 'read':
+        data = dpts.encode[str(dpt)](value)
+        apdu[1] |= data[0]
+        apdu.extend(data[1:])
+    return Telegram(time, src, dst, bytes(apdu))
+
+
+def addresses(count, types=('1', '5001', '9', '14')):
+    """
+    Returns count group addresses (starting at 1/0/0) with the dpts assigned in turn
+    """
+    gas = collections.OrderedDict()
+    for i in range(count):
+        gas['{0}/{1}/{2}'.format(1 + i // 2048, (i // 256) % 8, i % 256)] = types[i % len(types)]
+    return gas
+
+
+_values = {
+    '1': lambda: random.randint(0, 1),
+    '5': lambda: random.randint(0, 255),
+    '5001': lambda: random.randint(0, 100),
+    '6': lambda: random.randint(-128, 127),
+    '7': lambda: random.randint(0, 65535),
+    '8': lambda: random.randint(-32768, 32767),
+    '9': lambda: random.randint(-3000, 6000) / 100,
+    '12': lambda: random.randint(0, 4294967295),
+    '13': lambda: random.randint(-2147483648, 2147483647),
+    '14': lambda: random.randint(-100000, 100000) / 4,
+    '17': lambda: random.randint(0, 63),
+    '20': lambda: random.randint(0, 255),
+    '232': lambda: [random.randint(0, 255) for i in range(3)],
+}
+
+
+def synthetic(count, gas, rate=10.0, seed=None):
+    """
+    Returns count random write telegrams to the group addresses gas ({ga: dpt}),
+    timed at the given rate (telegrams/s)
+    """
+    if seed is not None:
+        random.seed(seed)
+    gas = [(ga, dpt) for ga, dpt in gas.items() if dpt in _values]
+    telegrams = []
+    for i in range(count):
+        ga, dpt = random.choice(gas)
+        telegrams.append(telegram(ga, _values[dpt](), dpt, src='1.1.{0}'.format(1 + i % 250), time=i / rate))
+    return telegrams
+
+
+def load(filename):
+    telegrams = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            t, src, dst, apdu = line.split()
+            telegrams.append(Telegram(float(t), src, dst, binascii.unhexlify(apdu)))
+    return telegrams
+
+
+def save(telegrams, filename):
+    with open(filename, 'w') as f:
+        for t in telegrams:
+            f.write(line(t) + '\n')
+
+
+def line(t):
+    return '{0:.6f} {1} {2} {3}'.format(t.time, t.src, t.dst, binascii.hexlify(t.apdu).decode())
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    """
+    Returns the given percentiles (nearest rank) of values, None if there are no values
+    """
+    if not values:
+        return {p: None for p in points}
+    values = sorted(values)
+    return {p: values[max(0, -(-p * len(values) // 100) - 1)] for p in points}
+
+
+class _handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.lock = threading.Lock()
+        self.groupcon = False
+        self.server.simulator._connect(self)
+
+    def finish(self):
+        self.server.simulator._disconnect(self)
+
+    def handle(self):
+        while True:
+            length = self._read(2)
+            if length is None:
+                return
+            data = self._read(struct.unpack('>H', length)[0])
+            if data is None or len(data) < 2:
+                return
+            self.server.simulator._handle(self, data)
+
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            try:
+                chunk = self.request.recv(size - len(data))
+            except OSError:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def send(self, data):
+        with self.lock:
+            try:
+                self.request.sendall(struct.pack('>H', len(data)) + data)
+            except OSError:
+                return False
+        return True
+
+
+class _server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Simulator:
+    """
+    knxd stand-in serving the group socket of the KNX plugin on a TCP port
+
+    Telegrams sent by the clients are passed to the listeners (callback(telegram))
+    and forwarded to the other clients like on a bus.
+    """
+
+    def __init__(self, host='127.0.0.1', port=6720, src='0.0.250'):
+        self.src = src
+        self.cache = {}
+        self.connections = []
+        self.dropped = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._connected = threading.Condition(self._lock)
+        self._server = _server((host, port), _handler, bind_and_activate=True)
+        self._server.simulator = self
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='knxd simulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def listen(self, callback):
+        self._listeners.append(callback)
+
+    def wait_connected(self, timeout=None):
+        """
+        Waits for a client with an open group socket, returns False on timeout
+        """
+        with self._connected:
+            return self._connected.wait_for(lambda: any(c.groupcon for c in self.connections), timeout)
+
+    def send(self, t):
+        """
+        Sends the telegram to all clients with an open group socket
+        """
+        data = bytearray([0, KNXD_GROUP_PACKET])
+        data.extend(enpa(t.src or self.src))
+        data.extend(dpts.enga(t.dst))
+        data.extend(t.apdu)
+        data = bytes(data)
+        if t.apdu[1] & 0xc0 != KNXREAD:
+            self.cache[t.dst] = t
+        sent = False
+        for connection in list(self.connections):
+            if connection.groupcon:
+                if connection.send(data):
+                    sent = True
+                else:
+                    self.dropped += 1
+        return sent
+
+    def _connect(self, connection):
+        with self._lock:
+            self.connections.append(connection)
+
+    def _disconnect(self, connection):
+        with self._lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def _handle(self, connection, data):
+        typ = struct.unpack('>H', data[0:2])[0]
+        if typ == KNXD_OPEN_GROUPCON:
+            connection.send(bytes([0, KNXD_OPEN_GROUPCON]))
+            with self._connected:
+                connection.groupcon = True
+                self._connected.notify_all()
+        elif typ in (KNXD_CACHE_ENABLE, KNXD_CACHE_DISABLE):
+            if typ == KNXD_CACHE_DISABLE:
+                self.cache = {}
+            connection.send(bytes([0, typ]))
+        elif typ == KNXD_CACHE_READ and len(data) >= 4:
+            dst = dpts.dega(data[2:4])
+            reply = bytearray([0, KNXD_CACHE_READ])
+            if dst in self.cache:
+                t = self.cache[dst]
+                reply.extend(enpa(t.src or self.src))
+                reply.extend(data[2:4])
+                reply.extend(t.apdu)
+                reply[7] = reply[7] & 0x3f | KNXRESP
+            else:
+                reply.extend([0, 0, 0, 0])  # like knxd a miss does not echo the group address
+            connection.send(bytes(reply))
+        elif typ == KNXD_GROUP_PACKET and len(data) >= 6:
+            t = Telegram(time.time(), self.src, dpts.dega(data[2:4]), bytes(data[4:]))
+            if t.apdu[1] & 0xc0 != KNXREAD:
+                self.cache[t.dst] = t
+            for listener in self._listeners:
+                listener(t)
+            for other in list(self.connections):
+                if other is not connection and other.groupcon:
+                    other.send(bytes([0, KNXD_GROUP_PACKET]) + bytes(enpa(self.src)) + bytes(data[2:]))
+
+
+def replay(simulator, telegrams, rate=None, speed=1.0):
+    """
+    Sends the telegrams with their recorded timing (divided by speed) or at a
+    fixed rate (telegrams/s, 0 for as fast as possible). Returns the send times.
+    """
+    sent = []
+    if not telegrams:
+        return sent
+    start = time.time()
+    first = telegrams[0].time
+    for i, t in enumerate(telegrams):
+        if rate is None:
+            due = start + (t.time - first) / speed
+        elif rate > 0:
+            due = start + i / rate
+        else:
+            due = 0
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent.append(time.time())
+        simulator.send(t)
+    return sent
+
+
+class Probe:
+    """
+    Measures the latency from a group write until the plugin answers a
+    following group read with the written value (items with knx_listen and
+    knx_reply on the group address). With the dpts of the group addresses
+    ({ga: dpt}) the written values are compared as the plugin decodes them.
+    """
+
+    def __init__(self, simulator, gas=None):
+        self.simulator = simulator
+        self.gas = gas or {}
+        self.latencies = []
+        self.dropped = 0
+        self._pending = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        simulator.listen(self._response)
+
+    def send(self, t):
+        expected = t.apdu
+        if t.dst in self.gas:
+            expected = telegram(t.dst, dpts.decode[self.gas[t.dst]](self._payload(t.apdu)), self.gas[t.dst]).apdu
+        with self._lock:
+            self._pending[t.dst].append((time.time(), expected[1] & 0x3f, expected[2:]))
+        if not self.simulator.send(t) or not self.simulator.send(Telegram(t.time, t.src, t.dst, bytes([0, KNXREAD]))):
+            self.dropped += 1
+
+    def _payload(self, apdu):
+        if len(apdu) == 2:
+            return bytes([apdu[1] & 0x3f])
+        return apdu[2:]
+
+    def pending(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for the outstanding replies, the missing ones are dropped
+        """
+        end = time.time() + timeout
+        while self.pending() and time.time() < end:
+            time.sleep(0.01)
+        with self._lock:
+            for queue in self._pending.values():
+                self.dropped += len(queue)
+            self._pending.clear()
+
+    def _response(self, t):
+        if t.apdu[1] & 0xc0 != KNXRESP:
+            return
+        now = time.time()
+        with self._lock:
+            queue = self._pending.get(t.dst)
+            # replies are in order, unanswered writes before a matching reply are lost
+            while queue:
+                sent, small, data = queue.popleft()
+                if small == t.apdu[1] & 0x3f and data == t.apdu[2:]:
+                    self.latencies.append(now - sent)
+                    return
+                self.dropped += 1
+
+    def report(self):
+        result = percentiles(self.latencies)
+        result['count'] = len(self.latencies)
+        result['dropped'] = self.dropped
+        return result
+
+
+def items(gas, filename):
+    """
+    Writes an items.conf with one item per group address listening and replying to it
+    """
+    with open(filename, 'w') as f:
+        f.write('[knxsim]\n')
+        for i, (ga, dpt) in enumerate(gas.items()):
+            f.write('    [[ga{0}]]\n'.format(i))
+            f.write('        type = {0}\n'.format('bool' if dpt == '1' else 'list' if dpt == '232' else 'num'))
+            f.write('        knx_dpt = {0}\n'.format(dpt))
+            f.write('        knx_listen = {0}\n'.format(ga))
+            f.write('        knx_reply = {0}\n'.format(ga))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='knxd stand-in to run the KNX plugin under load')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6720)
+    parser.add_argument('--replay', metavar='FILE', help='replay recorded telegrams')
+    parser.add_argument('--synthetic', type=int, metavar='N', help='send N random telegrams')
+    parser.add_argument('--gas', type=int, default=5000, help='number of group addresses of the synthetic telegrams')
+    parser.add_argument('--dpts', default='1,5001,9,14', help='dpts of the synthetic group addresses')
+    parser.add_argument('--items', metavar='FILE', help='write an items.conf for the synthetic group addresses and exit')
+    parser.add_argument('--rate', type=float, help='telegrams/s, 0 for as fast as possible (default: recorded timing)')
+    parser.add_argument('--speed', type=float, default=1.0, help='speed up the recorded timing')
+    parser.add_argument('--record', metavar='FILE', help='record the telegrams sent by the plugin')
+    parser.add_argument('--probe', action='store_true', help='read back written values to measure the latency')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for the plugin')
+    args = parser.parse_args(args)
+
+    gas = addresses(args.gas, args.dpts.split(','))
+    if args.items:
+        items(gas, args.items)
+        return
+
+    simulator = Simulator(args.host, args.port)
+    simulator.start()
+    if args.record:
+        record = open(args.record, 'a')
+        start = time.time()
+        simulator.listen(lambda t: record.write(line(t._replace(time=t.time - start)) + '\n'))
+    print('knxd simulator listening on {0}:{1}'.format(args.host, simulator.port))
+    try:
+        telegrams = []
+        if args.replay:
+            telegrams = load(args.replay)
+        elif args.synthetic:
+            telegrams = synthetic(args.synthetic, gas, rate=args.rate or 10.0)
+        if not telegrams:
+            while True:
+                time.sleep(1)
+        while not simulator.wait_connected(1):
+            pass
+        probe = Probe(simulator, gas if args.synthetic else None) if args.probe else None
+        start = time.time()
+        replay(probe or simulator, telegrams, args.rate, args.speed)
+        duration = time.time() - start
+        print('sent {0} telegrams in {1:.1f}s ({2:.0f} telegrams/s)'.format(len(telegrams), duration, len(telegrams) / max(duration, 1e-9)))
+        if probe:
+            probe.wait(args.timeout)
+            result = probe.report()
+            print('replies {0}, dropped {1}'.format(result['count'], result['dropped'] + simulator.dropped))
+            for p in (50, 90, 99, 100):
+                if result[p] is not None:
+                    print('  p{0:<3} {1:8.1f} ms'.format(p, result[p] * 1000))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
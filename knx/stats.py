@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# vim: set encoding=utf-8 tabstop=4 softtabstop=4 shiftwidth=4 expandtab
+#########################################################################
+#  This file is part of SmartHomeNG.
+#
+#  SmartHomeNG is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  SmartHomeNG is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
+#########################################################################
+
+import array
+import collections
+import heapq
+import time
+
+FLAGS = ['read', 'response', 'write']   # index is the APCI flag >> 6
+
+TP_BITRATE = 9600
+
+
+def ga(address):
+    return "{0}/{1}/{2}".format((address >> 11) & 0x1f, (address >> 8) & 0x07, address & 0xff)
+
+
+def pa(address):
+    return "{0}.{1}.{2}".format((address >> 12) & 0x0f, (address >> 8) & 0x0f, address & 0xff)
+
+
+class _counters:
+    """
+    Counters of the group or physical addresses, the totals per flag and the
+    telegrams of the running minute and the last 60 minutes
+    """
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.index = {}                 # {address: slot}
+        self.addresses = []
+        self.total = array.array('L')   # 3 counters (FLAGS) per slot
+        self.minute = array.array('L')
+        self.hour = collections.deque(maxlen=60)
+
+    def add(self, address):
+        self.addresses.append(address)
+        self.total.extend((0, 0, 0))
+        self.minute.append(0)
+        i = self.index[address] = len(self.addresses) - 1
+        return i
+
+    def rotate(self, minutes):
+        for i in range(min(minutes, 60)):
+            self.hour.append(self.minute)
+            self.minute = array.array('L', bytes(len(self.minute) * self.minute.itemsize))
+
+    def top(self, n, window, minutes):
+        """
+        minutes passed since the last rotation
+        """
+        if window == 'minute':
+            windows = [self.minute] if minutes == 0 else []
+        else:
+            windows = (list(self.hour) + [self.minute] + [None] * minutes)[-60:]
+        counts = collections.Counter()
+        for minute in windows:
+            if minute is not None:
+                for i, count in enumerate(minute):
+                    if count:
+                        counts[i] += count
+        return [(self.formatter(self.addresses[i]), count) for i, count in heapq.nlargest(n, counts.items(), key=lambda c: c[1])]
+
+    def dict(self):
+        result = {}
+        for i in range(len(self.total) // 3):
+            counts = {flag: self.total[i * 3 + f] for f, flag in enumerate(FLAGS) if self.total[i * 3 + f]}
+            if counts:
+                result[self.formatter(self.addresses[i])] = counts
+        return result
+
+    def clear(self):
+        for i in range(len(self.total)):
+            self.total[i] = 0
+
+
+class BusStats:
+    """
+    Statistics of the telegrams received from the bus. The telegrams and bus
+    bits are counted per second for the last minute and per minute for the
+    last hour, the telegrams of each group and physical address per minute.
+    Only record() changes the windows, so the statistics can be read from
+    other threads.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self.ga = _counters(ga)
+        self.pa = _counters(pa)
+        self._second = int(clock())
+        self._telegrams = 0             # of the running second
+        self._bits = 0
+        self._seconds = collections.deque([(0, 0)] * 60, maxlen=60)
+        self._minutes = collections.deque([(0, 0)] * 60, maxlen=60)
+        self._minute = (0, 0)           # telegrams and bits of the running minute
+
+    def record(self, src, dst, flag, apdu):
+        """
+        counts a telegram from physical address src to group address dst (both
+        as int), flag is the index in FLAGS and apdu the length of the APDU
+        """
+        now = int(self._clock())
+        if now != self._second:
+            self._tick(now)
+        i = self.ga.index.get(dst)
+        if i is None:
+            i = self.ga.add(dst)
+        j = self.pa.index.get(src)
+        if j is None:
+            j = self.pa.add(src)
+        self.ga.total[i * 3 + flag] += 1
+        self.ga.minute[i] += 1
+        self.pa.total[j * 3 + flag] += 1
+        self.pa.minute[j] += 1
+        self._telegrams += 1
+        # bit times on TP1: 50 bit idle, 13 bit per octet (11 bit character and 2 bit pause),
+        # 15 bit pause and 11 bit ack. The telegram has 7 octets besides the APDU.
+        self._bits += 76 + (7 + apdu) * 13
+
+    def _tick(self, now):
+        elapsed = now - self._second
+        self._seconds.append((self._telegrams, self._bits))
+        self._seconds.extend([(0, 0)] * min(elapsed - 1, 60))
+        self._minute = (self._minute[0] + self._telegrams, self._minute[1] + self._bits)
+        minutes = now // 60 - self._second // 60
+        if minutes > 0:
+            self._minutes.append(self._minute)
+            self._minutes.extend([(0, 0)] * min(minutes - 1, 60))
+            self._minute = (0, 0)
+            self.ga.rotate(minutes)
+            self.pa.rotate(minutes)
+        self._second = now
+        self._telegrams = 0
+        self._bits = 0
+
+    def _buckets(self, window):
+        now = int(self._clock())
+        if window == 'minute':
+            elapsed = now - self._second
+            buckets = list(self._seconds)
+            if elapsed > 0:
+                buckets.append((self._telegrams, self._bits))
+                buckets.extend([(0, 0)] * min(elapsed - 1, 60))
+            return buckets[-60:], 60
+        elif window == 'hour':
+            minutes = now // 60 - self._second // 60
+            buckets = list(self._minutes)
+            if minutes > 0:
+                buckets.append((self._minute[0] + self._telegrams, self._minute[1] + self._bits))
+                buckets.extend([(0, 0)] * min(minutes - 1, 60))
+            return buckets[-60:], 3600
+        raise ValueError("unknown window '{0}', use 'minute' or 'hour'".format(window))
+
+    def rate(self, window='minute'):
+        """
+        telegrams per second in the last minute or hour
+        """
+        buckets, seconds = self._buckets(window)
+        return sum(telegrams for telegrams, bits in buckets) / seconds
+
+    def load(self, window='minute'):
+        """
+        estimated bus load in percent of the TP1 bit rate in the last minute or hour
+        """
+        buckets, seconds = self._buckets(window)
+        return 100.0 * sum(bits for telegrams, bits in buckets) / seconds / TP_BITRATE
+
+    def top(self, n=10, window='minute', kind='ga'):
+        """
+        list of (address, telegrams) of the n group (kind 'ga') or physical
+        addresses (kind 'pa') with the most telegrams in the running minute
+        or the last hour
+        """
+        if window not in ('minute', 'hour'):
+            raise ValueError("unknown window '{0}', use 'minute' or 'hour'".format(window))
+        minutes = int(self._clock()) // 60 - self._second // 60
+        return getattr(self, kind).top(n, window, minutes)
+
+    def clear(self):
+        self.ga.clear()
+        self.pa.clear()
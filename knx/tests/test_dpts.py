@@ -0,0 +1,94 @@
+import datetime
+import random
+import unittest
+
+import common
+from plugins.knx import dpts
+
+class TestKnxDpts(unittest.TestCase):
+
+    def roundtrip(self, dpt, value):
+        encode, decode = dpts.codec(dpt)
+        return decode(bytes(encode(value))[1:])
+
+    def test_codec(self):
+        self.assertEqual((dpts.en9, dpts.de9), dpts.codec(9))
+        self.assertEqual((None, dpts.depa), dpts.codec('pa'))
+        self.assertRaises(KeyError, dpts.codec, '99')
+
+    def test_roundtrip(self):
+        self.assertEqual(1, self.roundtrip('5', 1))
+        self.assertEqual(255, self.roundtrip('5', 300))
+        self.assertEqual(50.2, self.roundtrip('5001', 50.2))
+        self.assertEqual(100.0, self.roundtrip('5.001', 120))
+        self.assertEqual(-5, self.roundtrip('6', -5))
+        self.assertEqual(-128, self.roundtrip('6', -200))
+        self.assertEqual(65535, self.roundtrip('7', 65535))
+        self.assertEqual(-32768, self.roundtrip('8', -40000))
+        self.assertEqual(21.5, self.roundtrip('9', 21.5))
+        self.assertEqual(-12.0, self.roundtrip('9', -12))
+        self.assertEqual(4294967295, self.roundtrip('12', 4294967295))
+        self.assertEqual(-2147483648, self.roundtrip('13', -2147483648))
+        self.assertEqual(1.5, self.roundtrip('14', 1.5))
+        self.assertEqual(63, self.roundtrip('17', 63))
+        self.assertEqual(7, self.roundtrip('20', 7))
+        self.assertEqual([1, 2, 3], self.roundtrip('232', [1, 2, 3]))
+
+    def test_decode_short_payload(self):
+        for dpt in ['5', '5001', '6', '7', '8', '9', '12', '13', '14', '17', '20', '232']:
+            self.assertIsNone(dpts.decode[dpt](b''))
+
+    def test_addresses(self):
+        self.assertEqual('1.2.3', dpts.depa(b'\x12\x03'))
+        self.assertEqual('1/2/3', dpts.dega(bytes(dpts.enga('1/2/3'))))
+        self.assertEqual('31/7/255', dpts.dega(b'\xff\xff'))
+
+    def test_decode_batch(self):
+        payloads = [bytes(dpts.en14(value))[1:] for value in [0.5, 1.5, -2.0]]
+        self.assertEqual([0.5, 1.5, -2.0], dpts.decode_batch(payloads, 14))
+        self.assertEqual([1, None], dpts.decode_batch([b'\x00\x01', b''], '7'))
+        self.assertEqual([21.5], dpts.decode_batch([b'\x0c\x33'], '9'))
+
+    def test_decode_dump(self):
+        """ Decode a synthetic busmonitor dump over the common DPTs """
+        values = {
+            '1': [0, 1],
+            '5': range(0, 256, 5),
+            '5001': range(0, 101, 5),
+            '6': range(-128, 128, 5),
+            '7': range(0, 65536, 997),
+            '9': [x / 10.0 for x in range(-300, 600, 7)],
+            '12': range(0, 100000, 997),
+            '13': range(-50000, 50000, 997),
+            '14': [x / 3.0 for x in range(-300, 300, 7)],
+            '16': ['Hello', 'World'],
+            '17': range(64),
+            '232': [[1, 2, 3], [255, 128, 0]],
+        }
+        # resolution of the lossy DPTs
+        delta = {'5001': 0.5, '9': 0.05, '14': 1e-4}
+        random.seed(0)
+        dump = []
+        for i in range(10000):
+            dpt = random.choice(list(values))
+            value = random.choice(values[dpt])
+            payload = bytes(dpts.encode[dpt](value))
+            if dpt != '1':
+                payload = payload[1:]
+            dump.append((dpt, value, payload))
+
+        for dpt, value, payload in dump:
+            decoded = dpts.decode[dpt](payload)
+            if dpt in delta:
+                self.assertAlmostEqual(value, decoded, delta=delta[dpt])
+            elif dpt == '16':
+                self.assertEqual(value, decoded.rstrip('\x00'))
+            else:
+                self.assertEqual(value, decoded)
+
+        for dpt, value, payload in dump:
+            ga = payload[:2].ljust(2, b'\x00')
+            self.assertEqual("{}/{}/{}".format(ga[0] >> 3, ga[0] & 7, ga[1]), dpts.dega(ga))
+
+        payloads = [payload for dpt, value, payload in dump if dpt == '14']
+        self.assertEqual([dpts.decode['14'](payload) for payload in payloads], dpts.decode_batch(payloads, '14'))
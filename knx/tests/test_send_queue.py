@@ -0,0 +1,80 @@
+import time
+import unittest
+
+import common
+from plugins.knx import KNX
+from plugins.knx import dpts
+from tests.mock.core import MockSmartHome
+
+class Item:
+
+    def __init__(self, path, value, conf):
+        self.path = path
+        self.value = value
+        self.conf = conf
+
+    def __call__(self):
+        return self.value
+
+    def id(self):
+        return self.path
+
+class TestKnxSendQueue(unittest.TestCase):
+
+    def plugin(self, send_rate):
+        plugin = KNX(MockSmartHome(), send_rate=send_rate)
+        self.sent = []
+        plugin.send = lambda data: self.sent.append((time.time(), dpts.dega(data[4:6]), bytes(data[6:])))
+        return plugin
+
+    def test_unlimited_sends_directly(self):
+        plugin = self.plugin(0)
+        plugin.groupwrite('1/1/1', 1, '1')
+        self.assertEqual([('1/1/1', b'\x00\x81')], [sent[1:] for sent in self.sent])
+
+    def test_coalesce_writes(self):
+        plugin = self.plugin(10)
+        for value in range(10):
+            plugin.groupwrite('1/1/1', value, '5')
+        plugin.groupwrite('1/1/2', 1, '1')
+        plugin.groupread('1/1/3')
+        plugin.groupread('1/1/3')
+        self.assertEqual([], self.sent)
+        stats = plugin.get_stats_queue()
+        self.assertEqual({'queued': 2, 'sent': 0, 'coalesced': 9, 'max_depth': 2, 'depth': 2}, stats['write'])
+        self.assertEqual({'queued': 1, 'sent': 0, 'coalesced': 1, 'max_depth': 1, 'depth': 1}, stats['read'])
+        self.assertEqual(b'\x00\x80\x09', plugin._send_lanes['write']['1/1/1'][4:])
+
+    def test_priority_and_rate(self):
+        plugin = self.plugin(50)
+        plugin.groupwrite('1/1/1', 1, '1')
+        plugin.groupwrite('1/1/2', 1, '1')
+        plugin.groupread('1/1/3')
+        plugin.groupwrite('1/1/4', 1, '1', 'response')
+        plugin.run()
+        for i in range(100):
+            if len(self.sent) == 4:
+                break
+            time.sleep(0.01)
+        plugin.alive = False
+        with plugin._send_cond:
+            plugin._send_cond.notify()
+        plugin._send_thread.join()
+        self.assertEqual(['1/1/4', '1/1/3', '1/1/1', '1/1/2'], [sent[1] for sent in self.sent])
+        self.assertGreaterEqual(self.sent[-1][0] - self.sent[0][0], 3 / 50 * 0.9)
+        self.assertEqual(0, plugin.get_stats_queue()['write']['depth'])
+        self.assertEqual(2, plugin.get_stats_queue()['write']['sent'])
+
+    def test_update_item_uses_bound_encoder(self):
+        plugin = self.plugin(0)
+        item = Item('test.knx', 21.5, {'knx_dpt': '9', 'knx_send': '1/1/1', 'knx_status': '1/1/2', 'knx_reply': '1/1/3'})
+        self.assertEqual(plugin.update_item, plugin.parse_item(item))
+        self.assertIs(dpts.en9, plugin._encoders['test.knx'])
+        self.assertIs(dpts.en9, plugin.gar['1/1/3']['encode'])
+        # the encoder is not looked up again per telegram
+        encode = dpts.encode.pop('9')
+        try:
+            plugin.update_item(item, caller='Logic')
+        finally:
+            dpts.encode['9'] = encode
+        self.assertEqual([('1/1/1', b'\x00\x80\x0c\x33'), ('1/1/2', b'\x00\x80\x0c\x33')], [sent[1:] for sent in self.sent])
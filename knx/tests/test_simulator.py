@@ -0,0 +1,171 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import common
+from plugins.knx import KNX, KNXD_OPEN_GROUPCON
+from plugins.knx import simulator
+from tests.mock.core import MockSmartHome
+
+class Bus:
+    """ Connects the plugin to the simulator like lib.connection.Client """
+
+    def __init__(self, plugin, port):
+        self.plugin = plugin
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        plugin.send = self.sock.sendall
+        plugin.terminator = 2
+        plugin.found_terminator = plugin.parse_length
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+        plugin._send(bytearray([0, KNXD_OPEN_GROUPCON, 0, 0, 0]))
+
+    def read(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while len(buffer) >= self.plugin.terminator:
+                data = buffer[:self.plugin.terminator]
+                buffer = buffer[self.plugin.terminator:]
+                self.plugin.found_terminator(data)
+
+    def close(self):
+        self.sock.close()
+
+class TestKnxSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.gas = simulator.addresses(200, ('1', '5001', '9', '14', '232'))
+        (fd, name) = tempfile.mkstemp()
+        os.close(fd)
+        simulator.items(self.gas, name)
+        self.sh = MockSmartHome()
+        self.sh.with_items_from(name)
+        os.unlink(name)
+        self.plugin = KNX(self.sh, enable_stats=False)
+        for item in self.sh.return_items():
+            self.plugin.parse_item(item)
+        self.sim = simulator.Simulator(port=0)
+        self.sim.start()
+        self.bus = Bus(self.plugin, self.sim.port)
+        self.assertTrue(self.sim.wait_connected(5))
+
+    def tearDown(self):
+        self.bus.close()
+        self.sim.stop()
+
+    def test_telegram(self):
+        self.assertEqual(b'\x00\x81', simulator.telegram('1/0/0', 1, '1').apdu)
+        self.assertEqual(b'\x00\x80\x0c\x33', simulator.telegram('1/0/0', 21.5, '9').apdu)
+        self.assertEqual(b'\x00\x00', simulator.telegram('1/0/0', flag='read').apdu)
+
+    def test_save_load(self):
+        telegrams = simulator.synthetic(10, self.gas, seed=1)
+        (fd, name) = tempfile.mkstemp()
+        os.close(fd)
+        simulator.save(telegrams, name)
+        self.assertEqual(telegrams, simulator.load(name))
+        os.unlink(name)
+
+    def test_percentiles(self):
+        self.assertEqual({50: 50, 90: 90, 99: 99, 100: 100}, simulator.percentiles(list(range(100, 0, -1))))
+        self.assertEqual({50: None}, simulator.percentiles([], (50,)))
+
+    def warmup(self, gas):
+        sent = []
+        self.sim.listen(sent.append)
+        self.plugin._cache_ga = gas
+        self.plugin.connected = True
+        self.plugin._cache_warmup()
+        for i in range(100):
+            if len(sent) >= self.plugin.stats_cache['unsatisfied']:
+                break
+            time.sleep(0.01)
+        return [t.dst for t in sent if t.apdu == b'\x00\x00']
+
+    def test_cache_warmup(self):
+        gas = list(self.gas)[:50]
+        values = {'1': 1, '5001': 5.0, '9': 5.0, '14': 5.0, '232': [5, 5, 5]}
+        for ga in gas[:40]:
+            self.sim.cache[ga] = simulator.telegram(ga, values[self.gas[ga]], self.gas[ga])
+        reads = self.warmup(gas)
+        self.assertEqual(gas[40:], self.plugin.get_unsatisfied_cache_read_ga())
+        self.assertEqual(sorted(gas[40:]), sorted(reads))
+        self.assertEqual(50, self.plugin.stats_cache['count'])
+        self.assertEqual(10, self.plugin.stats_cache['unsatisfied'])
+        self.assertEqual(5.0, self.sh.return_item('knxsim.ga2')())
+        # warm-up is repeated on reconnect
+        self.sim.cache[gas[45]] = simulator.telegram(gas[45], values[self.gas[gas[45]]], self.gas[gas[45]])
+        self.warmup(gas)
+        self.assertEqual(9, self.plugin.stats_cache['unsatisfied'])
+
+    def test_cache_warmup_timeout(self):
+        handle = self.sim._handle
+        def drop(connection, data):
+            if data[1] != simulator.KNXD_CACHE_READ or data[2:4] != b'\x08\x01':
+                handle(connection, data)
+        self.sim._handle = drop
+        self.plugin._cache_timeout = 0.1
+        reads = self.warmup(['1/0/0', '1/0/1', '1/0/2'])
+        self.assertEqual(['1/0/0', '1/0/1', '1/0/2'], self.plugin.get_unsatisfied_cache_read_ga())
+        self.assertEqual(1, self.plugin.stats_cache['retries'])
+        self.assertEqual(3, self.plugin.stats_cache['unsatisfied'])
+        self.assertEqual(['1/0/0', '1/0/1', '1/0/2'], sorted(reads))
+
+    def test_cache_warmup_holds_sends(self):
+        """ The warm-up starts on connect before run(), telegrams are sent after the group socket is open """
+        handle = self.sim._handle
+        received = []
+        def record(connection, data):
+            received.append(bytes(data[:2]))
+            handle(connection, data)
+        self.sim._handle = record
+        self.plugin._cache_timeout = 0.2
+        self.plugin._cache_retries = 0
+        self.plugin._cache_ga = ['1/0/0']
+        self.plugin.connected = True
+        self.plugin.discard_buffers = lambda: None
+        self.assertFalse(getattr(self.plugin, 'alive', False))
+        self.plugin.handle_connect()
+        self.plugin.groupwrite('1/1/1', 1, '1')
+        for i in range(100):
+            if self.plugin._held is None:
+                break
+            time.sleep(0.01)
+        self.assertIsNone(self.plugin._held)
+        time.sleep(0.1)
+        types = [t[1] for t in received]
+        self.assertIn(simulator.KNXD_CACHE_READ, types)
+        # open group socket, the held write and the read of the cache miss
+        self.assertEqual([KNXD_OPEN_GROUPCON, simulator.KNXD_GROUP_PACKET, simulator.KNXD_GROUP_PACKET], types[-3:])
+        self.assertEqual(['1/0/0'], self.plugin.get_unsatisfied_cache_read_ga())
+        # the miss is answered without group address and resolved before the timeout
+        self.assertLess(self.plugin.stats_cache['duration'], 0.2)
+
+    def test_replay_probe(self):
+        """ Replay 2000 synthetic telegrams to 200 group addresses and report
+            the latency from the write until the plugin replies the new value
+        """
+        probe = simulator.Probe(self.sim, self.gas)
+        telegrams = simulator.synthetic(2000, self.gas, seed=1)
+        simulator.replay(probe, telegrams, rate=0)
+        probe.wait(10)
+        result = probe.report()
+        print("replies {0}, dropped {1}, p50 {2:.1f} ms, p99 {3:.1f} ms".format(result['count'], result['dropped'], result[50] * 1000, result[99] * 1000))
+        self.assertEqual(2000, result['count'])
+        self.assertEqual(0, result['dropped'])
+        last = {}
+        for t in telegrams:
+            last[t.dst] = t
+        item = self.sh.return_item('knxsim.ga3')
+        self.assertEqual(simulator.telegram('1/0/3', item(), '14').apdu, last['1/0/3'].apdu)
@@ -0,0 +1,86 @@
+import unittest
+
+import common
+from plugins.knx import KNX
+from plugins.knx import stats
+from tests.mock.core import MockSmartHome
+
+class Clock:
+
+    def __init__(self, now=6000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class TestKnxStats(unittest.TestCase):
+
+    def test_counters(self):
+        bus = stats.BusStats(Clock())
+        bus.record(0x1101, 0x0801, 2, 2)
+        bus.record(0x1101, 0x0801, 0, 2)
+        bus.record(0x1102, 0x0802, 1, 3)
+        self.assertEqual({'1/0/1': {'read': 1, 'write': 1}, '1/0/2': {'response': 1}}, bus.ga.dict())
+        self.assertEqual({'1.1.1': {'read': 1, 'write': 1}, '1.1.2': {'response': 1}}, bus.pa.dict())
+        bus.clear()
+        self.assertEqual({}, bus.ga.dict())
+
+    def test_rate_and_load(self):
+        clock = Clock()
+        bus = stats.BusStats(clock)
+        for second in range(30):
+            for i in range(4):
+                bus.record(0x1101, 0x0801, 2, 2)
+            clock.now += 1
+        self.assertEqual(2.0, bus.rate('minute'))
+        # 193 bit per telegram with 2 byte APDU
+        self.assertAlmostEqual(100.0 * 120 * 193 / 60 / 9600, bus.load('minute'))
+        self.assertEqual(0, bus.rate('hour'))
+        clock.now += 60
+        self.assertEqual(0, bus.rate('minute'))
+        self.assertEqual(120 / 3600, bus.rate('hour'))
+        clock.now += 3600
+        self.assertEqual(0, bus.rate('hour'))
+        self.assertRaises(ValueError, bus.rate, 'day')
+
+    def test_top(self):
+        clock = Clock()
+        bus = stats.BusStats(clock)
+        for i in range(10):
+            bus.record(0x1101, 0x0801, 2, 2)
+        clock.now += 60
+        for i in range(3):
+            bus.record(0x1102, 0x0802, 2, 2)
+        bus.record(0x1103, 0x0803, 2, 2)
+        self.assertEqual([('1/0/2', 3), ('1/0/3', 1)], bus.top(5, 'minute'))
+        self.assertEqual([('1/0/1', 10), ('1/0/2', 3)], bus.top(2, 'hour'))
+        self.assertEqual([('1.1.1', 10)], bus.top(1, 'hour', 'pa'))
+        clock.now += 60
+        self.assertEqual([], bus.top(5, 'minute'))
+        clock.now += 3600
+        self.assertEqual([], bus.top(5, 'hour'))
+
+    def test_plugin(self):
+        plugin = KNX(MockSmartHome(), enable_stats='False')
+        telegram = bytearray([0, 0x27, 0x11, 0x01, 0x08, 0x01, 0, 0x81])
+        plugin.parse_telegram(telegram)
+        self.assertEqual({}, plugin.get_stats_ga())
+        plugin.enable_stats()
+        plugin.parse_telegram(telegram)
+        self.assertEqual({'1/0/1': {'write': 1}}, plugin.get_stats_ga())
+        self.assertEqual([('1.1.1', 1)], plugin.get_stats_top(kind='pa'))
+        plugin.disable_stats()
+        plugin.parse_telegram(telegram)
+        plugin.clear_stats()
+        self.assertEqual({}, plugin.get_stats_pa())
+
+    def test_record_many(self):
+        """ Count 10000 telegrams to 5000 group addresses """
+        bus = stats.BusStats()
+        for i in range(10000):
+            bus.record(0x1100 + i % 250, 0x0800 + i % 5000, 2, 2)
+        self.assertEqual(5000, len(bus.ga.dict()))
+        self.assertEqual({'write': 2}, bus.ga.dict()['1/0/1'])
+        self.assertEqual(250, len(bus.pa.dict()))
+        self.assertEqual({'write': 40}, bus.pa.dict()['1.1.1'])
+        self.assertEqual(10000, sum(count for address, count in bus.top(5000, 'minute')))
@@ -19,6 +19,7 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import collections
 import logging
 import socket
 import threading
@@ -37,10 +38,15 @@ class owexpath(Exception):
 
 class OwBase():
 
-    def __init__(self, host='127.0.0.1', port=4304):
+    def __init__(self, host='127.0.0.1', port=4304, connections=1):
         self.host = host
         self.port = int(port)
-        self._lock = threading.Lock()
+        self._lock = threading.Lock()  # guards the pool of owserver connections
+        self._available = threading.Condition(self._lock)
+        self._connections = max(1, int(connections))
+        self._idle = []       # connections ready for a request
+        self._opened = 0      # connections of the pool, idle or in use
+        self._generation = 0  # increased by close() to drop the connections in use
         self._flag = 0x00000100   # ownet
         self._flag += 0x00000004  # persistence
         self._flag += 0x00000002  # list special directories
@@ -49,28 +55,68 @@ class OwBase():
         self._connection_errorlog = 60
 
     def connect(self):
-        self._lock.acquire()
         try:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.settimeout(2)
-            self._sock.connect((self.host, self.port))
+            sock = self._open()
         except Exception as e:
             self._connection_attempts -= 1
             if self._connection_attempts <= 0:
                 logger.error('1-Wire: could not connect to {0}:{1}: {2}'.format(self.host, self.port, e))
                 self._connection_attempts = self._connection_errorlog
-            self._lock.release()
             return
-        else:
+        with self._lock:
+            self._idle.append(sock)
+            self._opened = 1
             self.connected = True
-            logger.info('1-Wire: connected to {0}:{1}'.format(self.host, self.port))
-            self._connection_attempts = 0
-            self._lock.release()
+        logger.info('1-Wire: connected to {0}:{1}'.format(self.host, self.port))
+        self._connection_attempts = 0
         try:
             self.read('/system/process/pid')  # workaround read to avoid owserver timeout
         except Exception as e:
             pass
 
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(2)
+        try:
+            sock.connect((self.host, self.port))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _acquire(self):
+        """
+        returns an idle connection of the pool or opens a new one up to the
+        number of connections, otherwise waits for a connection to be released
+        """
+        with self._lock:
+            while not self._idle:
+                if not self.connected:
+                    raise owex("No connection to owserver.")
+                if self._opened < self._connections:
+                    self._opened += 1
+                    generation = self._generation
+                    break
+                self._available.wait()
+            else:
+                return self._idle.pop(), self._generation
+        try:
+            return self._open(), generation
+        except Exception as e:
+            self._release(None, generation, False)
+            raise owex("error connecting: {0}".format(e))
+
+    def _release(self, sock, generation, reuse=True):
+        with self._lock:
+            if generation == self._generation:
+                if reuse:
+                    self._idle.append(sock)
+                    self._available.notify()
+                    return
+                self._opened -= 1
+                self._available.notify()
+        self._close(sock)
+
     def read(self, path):
         return self._request(path, cmd=2)
 
@@ -104,29 +150,36 @@ class OwBase():
         header[16:20] = data.to_bytes(4, byteorder='big')
         if not self.connected:
             raise owex("No connection to owserver.")
-        self._lock.acquire()
+        sock, generation = self._acquire()
         try:
-            data = header + payload.encode()
-            self._sock.sendall(data)
-        except Exception as e:
+            ret, payload = self._transfer(sock, header + payload.encode())
+        except owex:
+            self._release(sock, generation, False)
             self.close()
-            self._lock.release()
+            raise
+        self._release(sock, generation)
+        if ret == 4294967295:  # unknown path
+            raise owexpath("path '{0}' not found.".format(path))
+        if payload is None:
+            if cmd != 3:
+                raise owex('no payload for {0}'.format(path))
+            return
+        return payload
+
+    def _transfer(self, sock, data):
+        try:
+            sock.sendall(data)
+        except Exception as e:
             raise owex("error sending request: {0}".format(e))
         while True:
             header = bytearray()
             try:
-                header = self._sock.recv(24)
+                header = sock.recv(24)
             except socket.timeout:
-                self.close()
-                self._lock.release()
                 raise owex("error receiving header: timeout")
             except Exception as e:
-                self.close()
-                self._lock.release()
                 raise owex("error receiving header: {0}".format(e))
             if len(header) != 24:
-                self.close()
-                self._lock.release()
                 raise owex("error receiving header: no data")
 #           version = int.from_bytes(data[0:4], byteorder='big')
             length = int.from_bytes(header[4:8], byteorder='big')
@@ -136,35 +189,36 @@ class OwBase():
 #           offset = int.from_bytes(data[20:24], byteorder='big')
             if not length == 4294967295:
                 break
-        if ret == 4294967295:  # unknown path
-            self._lock.release()
-            raise owexpath("path '{0}' not found.".format(path))
-        if length == 0:
-            self._lock.release()
-            if cmd != 3:
-                raise owex('no payload for {0}'.format(path))
-            return
+        if ret == 4294967295 or length == 0:
+            return ret, None
         try:
-            payload = self._sock.recv(length)
+            payload = sock.recv(length)
         except socket.timeout:
-            self.close()
-            self._lock.release()
             raise owex("error receiving payload: timeout")
         except Exception as e:
-            self.close()
-            self._lock.release()
             raise owex("error receiving payload: {0}".format(e))
-        self._lock.release()
-        return payload
+        return ret, payload
 
     def close(self):
-        self.connected = False
+        with self._lock:
+            self.connected = False
+            self._generation += 1
+            idle = self._idle
+            self._idle = []
+            self._opened = 0
+            self._available.notify_all()
+        for sock in idle:
+            self._close(sock)
+
+    def _close(self, sock):
+        if sock is None:
+            return
         try:
-            self._sock.shutdown(socket.SHUT_RDWR)
+            sock.shutdown(socket.SHUT_RDWR)
         except:
             pass
         try:
-            self._sock.close()
+            sock.close()
         except:
             pass
 
@@ -242,12 +296,15 @@ class OneWire(OwBase):
     _flip = {0: '1', False: '1', 1: '0', True: '0', '0': True, '1': False}
     _supported = {'T': 'Temperature', 'H': 'Humidity', 'V': 'Voltage', 'BM': 'Busmaster', 'B': 'iButton', 'L': 'Light/Lux', 'IA': 'Input A', 'IB': 'Input B', 'OA': 'Output A', 'OB': 'Output B', 'I0': 'Input 0', 'I1': 'Input 1', 'I2': 'Input 2', 'I3': 'Input 3', 'I4': 'Input 4', 'I5': 'Input 5', 'I6': 'Input 6', 'I7': 'Input 7', 'O0': 'Output 0', 'O1': 'Output 1', 'O2': 'Output 2', 'O3': 'Output 3', 'O4': 'Output 4', 'O5': 'Output 5', 'O6': 'Output 6', 'O7': 'Output 7', 'T9': 'Temperature 9Bit', 'T10': 'Temperature 10Bit', 'T11': 'Temperature 11Bit', 'T12': 'Temperature 12Bit', 'VOC': 'VOC'}
 
-    def __init__(self, smarthome, cycle=300, io_wait=5, button_wait=0.5, host='127.0.0.1', port=4304):
-        OwBase.__init__(self, host, port)
+    def __init__(self, smarthome, cycle=300, io_wait=5, button_wait=0.5, host='127.0.0.1', port=4304, connections=1, simultaneous=False):
+        OwBase.__init__(self, host, port, connections)
         self._sh = smarthome
         self._io_wait = float(io_wait)
         self._button_wait = float(button_wait)
         self._cycle = int(cycle)
+        self._simultaneous = smarthome.string2bool(simultaneous)
+        self._cycle_items = []
+        self.stats_cycle = {'cycles': 0, 'last': None, 'max': None, 'buses': {}}
         smarthome.connections.monitor(self)
 
     def wrapper(self, bus):  # dummy method not needed right now
@@ -373,7 +430,43 @@ class OneWire(OwBase):
         if not self.connected:
             return
         start = time.time()
+        sensor_buses = {addr: bus for bus in self._buses for addr in self._buses[bus]}
+        buses = collections.OrderedDict()  # {bus: [addr, ...]}
         for addr in self._sensors:
+            buses.setdefault(sensor_buses.get(addr, ''), []).append(addr)
+        times = {}
+        if self._connections > 1 and len(buses) > 1:
+            workers = [threading.Thread(target=self._bus_cycle, args=(bus, addrs, times), name='1w-' + (bus or 'sen')) for bus, addrs in buses.items()]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            for bus, addrs in buses.items():
+                self._bus_cycle(bus, addrs, times)
+        cycletime = time.time() - start
+        logger.debug("1-Wire: sensor cycle takes {0} seconds".format(cycletime))
+        stats = self.stats_cycle
+        stats['cycles'] += 1
+        stats['last'] = cycletime
+        stats['max'] = cycletime if stats['max'] is None else max(stats['max'], cycletime)
+        stats['buses'] = times
+        for item in self._cycle_items:
+            item(round(cycletime, 3), '1-Wire')
+
+    def _bus_cycle(self, bus, addrs, times):
+        """
+        reads the sensors of one bus, after a simultaneous temperature
+        conversion of all sensors of the bus if enabled. owserver then reads
+        the temperatures without converting each sensor again.
+        """
+        start = time.time()
+        if self._simultaneous and bus and any(key.startswith('T') for addr in addrs for key in self._sensors[addr]):
+            try:
+                self.write('/' + bus + '/simultaneous/temperature', 1)
+            except Exception as e:
+                logger.info("1-Wire: problem starting simultaneous conversion on {}: {}".format(bus, e))
+        for addr in addrs:
             if not self.alive:
                 break
             for key in self._sensors[addr]:
@@ -391,6 +484,7 @@ class OneWire(OwBase):
                 except Exception as e:
                     logger.warning("1-Wire: problem reading {} {}: {}".format(addr, path, e))
                     if not self.connected:
+                        times[bus] = time.time() - start
                         return
                     else:
                         self.close()
@@ -403,8 +497,14 @@ class OneWire(OwBase):
                 elif key == 'VOC':
                     value = value * 310 + 450
                 item(value, '1-Wire', path)
-        cycletime = time.time() - start
-        logger.debug("1-Wire: sensor cycle takes {0} seconds".format(cycletime))
+        times[bus] = time.time() - start
+
+    def get_stats_cycle(self):
+        """
+        returns the number of sensor cycles, the duration of the last and the
+        longest cycle and of the last cycle per bus in seconds
+        """
+        return {'cycles': self.stats_cycle['cycles'], 'last': self.stats_cycle['last'], 'max': self.stats_cycle['max'], 'buses': dict(self.stats_cycle['buses'])}
 
     def _discovery(self):
         self._intruders = []  # reset intrusion detection
@@ -465,6 +565,10 @@ class OneWire(OwBase):
         self._discovered = True
 
     def parse_item(self, item):
+        if 'ow_cycle_time' in item.conf:
+            if self._sh.string2bool(item.conf['ow_cycle_time']):
+                self._cycle_items.append(item)
+            return
         if 'ow_addr' not in item.conf:
             return
         if 'ow_sensor' not in item.conf:
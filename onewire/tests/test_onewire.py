@@ -0,0 +1,142 @@
+import socketserver
+import threading
+import time
+import unittest
+
+import common
+from plugins.onewire import OneWire
+from tests.mock.core import MockSmartHome
+
+BUSES = {'bus.0': ['28.000000000001', '28.000000000002', '28.000000000003'], 'bus.1': ['28.000000000004', '28.000000000005', '28.000000000006']}
+
+class Owserver(socketserver.ThreadingTCPServer):
+    """ Answers the requests of the plugin like an owserver with the sensors of BUSES """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.writes = []
+        self.clients = 0
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def reply(self, cmd, path, value):
+        if cmd == 9:
+            if path == '/':
+                return ','.join('/' + bus + '/' for bus in BUSES).encode()
+            bus = path.strip('/')
+            return ','.join('/' + bus + '/' + addr + '/' for addr in BUSES[bus]).encode()
+        if cmd == 3:
+            self.writes.append((path, value))
+            return b''
+        if path.endswith('/type'):
+            return b'DS18B20'
+        if path.endswith('/temperature'):
+            time.sleep(self.delay)
+            return '{:12.4f}'.format(int(path.split('/')[-2][-1])).encode()
+        return b'1'
+
+class Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        with self.server.lock:
+            self.server.clients += 1
+        while True:
+            header = self.request.recv(24)
+            if len(header) != 24:
+                return
+            length = int.from_bytes(header[4:8], byteorder='big')
+            cmd = int.from_bytes(header[8:12], byteorder='big')
+            path, sep, value = self.request.recv(length).decode().strip('\x00').partition('\x00')
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active, self.server.active)
+            payload = self.server.reply(cmd, path, value.strip('\x00'))
+            with self.server.lock:
+                self.server.active -= 1
+            reply = bytearray(24)
+            reply[4:8] = len(payload).to_bytes(4, byteorder='big')
+            reply[8:12] = len(payload).to_bytes(4, byteorder='big')
+            self.request.sendall(reply + payload)
+
+class Connections:
+
+    def monitor(self, connection):
+        pass
+
+class TestOneWire(unittest.TestCase):
+
+    def setUp(self):
+        self.owserver = Owserver(delay=0.05)
+
+    def tearDown(self):
+        self.owserver.shutdown()
+        self.owserver.server_close()
+
+    def plugin(self, **kwargs):
+        sh = MockSmartHome()
+        sh.connections = Connections()
+        plugin = OneWire(sh, port=self.owserver.server_address[1], **kwargs)
+        # the tables are class attributes
+        plugin._buses = {}
+        plugin._sensors = {}
+        self.items = {addr: Item(addr) for bus in BUSES for addr in BUSES[bus]}
+        for item in self.items.values():
+            plugin.parse_item(item)
+        self.cycle = Item('cycle', {'ow_cycle_time': 'yes'})
+        plugin.parse_item(self.cycle)
+        plugin.connect()
+        plugin._discovery()
+        return plugin
+
+    def test_sequential(self):
+        plugin = self.plugin()
+        plugin._sensor_cycle()
+        self.assertEqual({addr: float(addr[-1]) for addr in self.items}, {addr: item() for addr, item in self.items.items()})
+        self.assertEqual(1, self.owserver.clients)
+        self.assertEqual([], self.owserver.writes)
+        plugin.close()
+
+    def test_parallel_buses(self):
+        plugin = self.plugin(connections=2, simultaneous='yes')
+        plugin._sensor_cycle()
+        self.assertEqual({addr: float(addr[-1]) for addr in self.items}, {addr: item() for addr, item in self.items.items()})
+        self.assertEqual(2, self.owserver.clients)
+        self.assertEqual(2, self.owserver.max_active)
+        self.assertEqual([('/bus.0/simultaneous/temperature', '1'), ('/bus.1/simultaneous/temperature', '1')], sorted(self.owserver.writes))
+        stats = plugin.get_stats_cycle()
+        self.assertEqual(1, stats['cycles'])
+        self.assertEqual(['bus.0', 'bus.1'], sorted(stats['buses']))
+        # both buses are read at the same time
+        self.assertLess(stats['last'], sum(stats['buses'].values()))
+        self.assertEqual(round(stats['last'], 3), self.cycle())
+        plugin.close()
+
+    def test_close_drops_pool(self):
+        plugin = self.plugin(connections=2)
+        plugin._sensor_cycle()
+        plugin.close()
+        self.assertEqual(0, plugin._opened)
+        self.assertRaises(Exception, plugin.read, '/bus.0/28.000000000001/temperature')
+        plugin.connect()
+        self.assertEqual(b'DS18B20', plugin.read('/bus.0/28.000000000001/type'))
+
+class Item:
+
+    def __init__(self, addr, conf=None):
+        self._id = addr
+        self.conf = conf if conf is not None else {'ow_addr': addr, 'ow_sensor': 'T'}
+        self.value = None
+
+    def id(self):
+        return self._id
+
+    def __call__(self, value=None, caller=None, source=None):
+        if value is not None:
+            self.value = value
+        return self.value
@@ -19,10 +19,14 @@
 #  along with SmartHomeNG.  If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import array
+import collections
 import datetime
 import functools
 import logging
 import os
+import threading
+import time
 
 import rrdtool
 
@@ -31,13 +35,27 @@ logger = logging.getLogger('')
 
 class RRD():
 
-    def __init__(self, smarthome, step=300, rrd_dir=None):
+    def __init__(self, smarthome, step=300, rrd_dir=None, rrdcached=None, write_behind=0, journal=None, fetch_cache=16):
         self._sh = smarthome
         if rrd_dir is None:
             rrd_dir = smarthome.base_dir + '/var/rrd/'
         self._rrd_dir = rrd_dir
         self._rrds = {}
         self.step = int(step)
+        # updates are written by rrdcached or kept write_behind seconds to write them in bulk
+        self._daemon = [] if rrdcached is None else ['--daemon', rrdcached]
+        self._write_behind = 0 if rrdcached is not None else int(write_behind)
+        self._journal = journal
+        self._pending = collections.OrderedDict()  # {rrdb: ['time:value', ...]}
+        self._pending_lock = threading.Lock()
+        self._file_locks = collections.defaultdict(threading.Lock)  # {rrdb: lock} to write the updates of a file in order
+        self._flushed = time.time()
+        # fetched values per file, valid until the file is updated or the next step begins
+        self._fetch_cache_size = int(fetch_cache)
+        self._fetch_cache = {}  # {rrdb: OrderedDict({(cf, start, end, resolution, slot): (meta, values)})}
+        self._fetch_cache_lock = threading.Lock()
+        self._updates = collections.defaultdict(int)  # {rrdb: updates} to not cache values read during an update
+        self._init_items = []  # items with rrd = init, set in run()
 
     def run(self):
         self.alive = True
@@ -46,27 +64,120 @@ class RRD():
             rrd = self._rrds[itempath]
             if not os.path.isfile(rrd['rrdb']):
                 self._create(rrd)
+        self._replay()
+        # the last values are read after the replay of the journal
+        for item in self._init_items:
+            self._init(item)
+        self._init_items = []
         offset = 100  # wait 100 seconds for 1-Wire to update values
         self._sh.scheduler.add('RRDtool', self._update_cycle, cycle=self.step, offset=offset, prio=5)
 
     def stop(self):
         self.alive = False
+        self._flush()
 
     def _update_cycle(self):
+        now = int(time.time())
+        pending = []
         for itempath in self._rrds:
             rrd = self._rrds[itempath]
             if rrd['type'] == 'GAUGE':
-                value = 'N:' + str(float(rrd['item']()))
+                value = str(float(rrd['item']()))
             else:  # 'COUNTER'
-                value = 'N:' + str(int(rrd['step'] * rrd['item']()))
+                value = str(int(rrd['step'] * rrd['item']()))
+            if self._write_behind > 0:
+                pending.append((rrd['rrdb'], "{}:{}".format(now, value)))
+                continue
             try:
-                rrdtool.update(
-                    rrd['rrdb'],
-                    value
-                )
+                rrdtool.update(*self._daemon + [rrd['rrdb'], 'N:' + value])
             except Exception as e:
                 logger.warning("RRD: error updating {}: {}".format(itempath, e))
+            finally:
+                self._invalidate(rrd['rrdb'])
+        if pending:
+            # the journal is written under the same lock to keep it in the order of the queued values
+            with self._pending_lock:
+                for rrdb, value in pending:
+                    self._pending.setdefault(rrdb, []).append(value)
+                if self._journal is not None:
+                    try:
+                        with open(self._journal, 'a') as f:
+                            f.write(''.join("{} {}\n".format(rrdb, value) for rrdb, value in pending))
+                    except Exception as e:
+                        logger.error("RRD: can't write journal {}: {}".format(self._journal, e))
+        if self._write_behind > 0 and now - self._flushed >= self._write_behind:
+            self._flush()
+
+    def _flush(self, rrdb=None):
+        """
+        writes the pending updates of all files or of the file rrdb with one update per file.
+        The updates of a file are taken and written under its lock, so a flush of the
+        scheduler and a flush of a reader can't write them out of order.
+        """
+        with self._pending_lock:
+            if rrdb is None:
+                filenames = list(self._pending)
+                self._flushed = time.time()
+            else:
+                filenames = [rrdb]
+            locks = [(filename, self._file_locks[filename]) for filename in filenames]
+        written = False
+        for filename, lock in locks:
+            # a reader waits here for a running update of the file
+            with lock:
+                with self._pending_lock:
+                    values = self._pending.pop(filename, None)
+                if not values:
+                    continue
+                written = True
+                try:
+                    rrdtool.update(filename, *values)
+                except Exception as e:
+                    logger.warning("RRD: error updating {}: {}".format(filename, e))
+                finally:
+                    self._invalidate(filename)
+        if written:
+            with self._pending_lock:
+                if not self._pending:
+                    self._remove_journal()
+
+    def _remove_journal(self):
+        if self._journal is not None and os.path.exists(self._journal):
+            try:
+                os.remove(self._journal)
+            except Exception as e:
+                logger.error("RRD: can't remove journal {}: {}".format(self._journal, e))
+
+    def _replay(self):
+        """
+        queues the updates of the journal which are newer than the last update of their file
+        """
+        if self._journal is None or not os.path.exists(self._journal):
+            return
+        journal = collections.OrderedDict()
+        try:
+            with open(self._journal, 'r') as f:
+                for line in f:
+                    rrdb, sep, value = line.strip().rpartition(' ')
+                    if sep:
+                        journal.setdefault(rrdb, []).append(value)
+        except Exception as e:
+            logger.error("RRD: can't read journal {}: {}".format(self._journal, e))
+            return
+        count = 0
+        for rrdb, values in journal.items():
+            try:
+                last = rrdtool.last(rrdb)
+            except Exception as e:
+                logger.warning("RRD: skipping journaled values of {}: {}".format(rrdb, e))
                 continue
+            values = [value for value in values if int(value.partition(':')[0]) > last]
+            count += len(values)
+            with self._pending_lock:
+                self._pending[rrdb] = values + self._pending.get(rrdb, [])
+        logger.info("RRD: replaying {} journaled values of {} files".format(count, len(journal)))
+        if self._write_behind <= 0:
+            self._flush()
 
     def parse_item(self, item):
         if 'rrd' not in item.conf:
@@ -90,9 +201,12 @@ class RRD():
         self._rrds[item.id()] = {'item': item, 'id': item.id(), 'rrdb': rrdb, 'max': rrd_max, 'min': rrd_min, 'step': rrd_step, 'type': rrd_type}
 
         if item.conf['rrd'] == 'init':
-            last = self._single('last', '5d', item=item.id())
-            if last is not None:
-                item.set(last, 'RRDtool')
+            self._init_items.append(item)
+
+    def _init(self, item):
+        last = self._single('last', '5d', item=item.id())
+        if last is not None:
+            item.set(last, 'RRDtool')
 
     def parse_logic(self, logic):
         pass
@@ -103,46 +217,33 @@ class RRD():
         else:
             logger.warning("RRDtool: not enabled for {}".format(item))
             return
-        query = ["{}".format(rrd['rrdb'])]
         if func == 'avg':
-            query.append('AVERAGE')
+            cf = 'AVERAGE'
         elif func == 'max':
             if not rrd['max']:
                 logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
                 return
-            query.append('MAX')
+            cf = 'MAX'
         elif func == 'min':
             if not rrd['min']:
                 logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
                 return
-            query.append('MIN')
+            cf = 'MIN'
         else:
             logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
             return
-        if start.isdigit():
-            query.extend(['--start', "{}".format(start)])
-        else:
-            query.extend(['--start', "now-{}".format(start)])
-        if end != 'now':
-            if end.isdigit():
-                query.extend(['--end', "{}".format(end)])
-            else:
-                query.extend(['--end', "now-{}".format(end)])
-        if step is not None:
-            query.extend(['--resolution', step])
-        try:
-            meta, name, data = rrdtool.fetch(*query)
-        except Exception as e:
-            logger.warning("error reading {0} data: {1}".format(item, e))
+        fetched = self._fetch(rrd, cf, start, end, step)
+        if fetched is None:
             return None
+        meta, values = fetched
         if sid is None:
             sid = item + '|' + func + '|' + start + '|' + end
         reply = {'cmd': 'series', 'series': None, 'sid': sid}
         istart, iend, istep = meta
         mstart = istart * 1000
         mstep = istep * 1000
-        tuples = [(mstart + i * mstep, v[0]) for i, v in enumerate(data)]
-        reply['series'] = sorted(tuples)
+        # the rows are in time order, NaN marks unknown values
+        reply['series'] = [(mstart + i * mstep, v if v == v else None) for i, v in enumerate(values)]
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': str(iend), 'end': str(iend + istep), 'step': str(istep), 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=istep)
         return reply
@@ -153,39 +254,21 @@ class RRD():
         else:
             logger.warning("RRDtool: not enabled for {}".format(item))
             return
-        query = ["{}".format(rrd['rrdb'])]
         if func == 'avg':
-            query.append('AVERAGE')
+            cf = 'AVERAGE'
         elif func == 'max':
-            if rrd['max']:
-                query.append('MAX')
-            else:
-                query.append('AVERAGE')
+            cf = 'MAX' if rrd['max'] else 'AVERAGE'
         elif func == 'min':
-            if rrd['min']:
-                query.append('MIN')
-            else:
-                query.append('AVERAGE')
+            cf = 'MIN' if rrd['min'] else 'AVERAGE'
         elif func == 'last':
-            query.append('AVERAGE')
+            cf = 'AVERAGE'
         else:
             logger.warning("RRDtool: unsupported consolidation function {} for {}".format(func, item))
             return
-        if start.isdigit():
-            query.extend(['--start', "{}".format(start)])
-        else:
-            query.extend(['--start', "now-{}".format(start)])
-        if end != 'now':
-            if end.isdigit():
-                query.extend(['--end', "{}".format(end)])
-            else:
-                query.extend(['--end', "now-{}".format(end)])
-        try:
-            meta, name, data = rrdtool.fetch(*query)
-        except Exception as e:
-            logger.warning("error reading {0} data: {1}".format(item, e))
+        fetched = self._fetch(rrd, cf, start, end)
+        if fetched is None:
             return None
-        values = [v[0] for v in data if v[0] is not None]
+        values = [v for v in fetched[1] if v == v]
         if func == 'avg':
             if len(values) > 0:
                 return sum(values) / len(values)
@@ -199,6 +282,58 @@ class RRD():
             if len(values) > 0:
                 return values[-1]
 
+    def _fetch(self, rrd, cf, start, end, step=None):
+        """
+        returns the meta data (start, end, step) and the values as array('d') of
+        the first data source, cached until the file is updated. Relative times
+        are resolved by rrdtool at the step boundaries, so the values are cached
+        for the running step of the item.
+        """
+        rrdb = rrd['rrdb']
+        self._flush(rrdb)
+        key = (cf, start, end, step, int(time.time()) // rrd['step'])
+        updates = self._updates[rrdb]
+        if self._fetch_cache_size > 0:
+            with self._fetch_cache_lock:
+                cache = self._fetch_cache.get(rrdb)
+                if cache is not None and key in cache:
+                    cache.move_to_end(key)
+                    return cache[key]
+        query = [rrdb, cf]
+        if start.isdigit():
+            query.extend(['--start', "{}".format(start)])
+        else:
+            query.extend(['--start', "now-{}".format(start)])
+        if end != 'now':
+            if end.isdigit():
+                query.extend(['--end', "{}".format(end)])
+            else:
+                query.extend(['--end', "now-{}".format(end)])
+        if step is not None:
+            query.extend(['--resolution', step])
+        query.extend(self._daemon)  # rrdcached flushes the file before reading
+        try:
+            meta, name, data = rrdtool.fetch(*query)
+        except Exception as e:
+            logger.warning("error reading {0} data: {1}".format(rrd['id'], e))
+            return None
+        nan = float('nan')
+        result = (meta, array.array('d', (nan if v[0] is None else v[0] for v in data)))
+        if self._fetch_cache_size > 0:
+            with self._fetch_cache_lock:
+                if updates != self._updates[rrdb]:
+                    return result
+                cache = self._fetch_cache.setdefault(rrdb, collections.OrderedDict())
+                cache[key] = result
+                if len(cache) > self._fetch_cache_size:
+                    cache.popitem(last=False)
+        return result
+
+    def _invalidate(self, rrdb):
+        with self._fetch_cache_lock:
+            self._updates[rrdb] += 1
+            self._fetch_cache.pop(rrdb, None)
+
     def _create(self, rrd):
         args = [rrd['rrdb']]
         item_id = rrd['id'].rpartition('.')[2][:19]
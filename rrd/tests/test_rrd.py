@@ -0,0 +1,230 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import common
+try:
+    import rrdtool
+except ImportError:
+    # the tests replace the binding with FakeRRDtool, the plugin only needs to import it
+    sys.modules['rrdtool'] = types.ModuleType('rrdtool')
+from plugins.rrd import RRD
+from tests.mock.core import MockSmartHome
+
+class FakeRRDtool:
+    """ Records the calls of the plugin and rejects updates not newer than the last one like rrdtool """
+
+    def __init__(self):
+        self.calls = []
+        self.updates = {}
+        self.last_update = {}
+        self.gate = None  # the first update waits for this event
+        self.entered = threading.Event()
+
+    def update(self, *args):
+        self.calls.append(('update',) + args)
+        args = list(args)
+        if args[0] == '--daemon':
+            args = args[2:]
+        rrdb, values = args[0], args[1:]
+        if self.gate is not None:
+            gate, self.gate = self.gate, None
+            self.entered.set()
+            gate.wait(5)
+        for value in values:
+            timestamp = value.partition(':')[0]
+            timestamp = int(time.time()) if timestamp == 'N' else int(timestamp)
+            if timestamp <= self.last_update.get(rrdb, 0):
+                raise Exception("illegal attempt to update using time {} when last update time is {}".format(timestamp, self.last_update[rrdb]))
+            self.last_update[rrdb] = timestamp
+            self.updates.setdefault(rrdb, []).append(value)
+
+    def last(self, rrdb):
+        return self.last_update.get(rrdb, 0)
+
+    def fetch(self, *args):
+        self.calls.append(('fetch',) + args)
+        return (0, 300, 300), ('value',), [(float(len(self.updates.get(args[0], []))),)]
+
+    def create(self, *args):
+        self.calls.append(('create',) + args)
+
+class Item:
+
+    def __init__(self, id, value=0, conf=None):
+        self._id = id
+        self.value = value
+        self.conf = {'rrd': 'yes'} if conf is None else conf
+
+    def __call__(self):
+        return self.value
+
+    def id(self):
+        return self._id
+
+    def set(self, value, caller=None):
+        self.value = value
+
+class TestRRD(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.rrdtool = FakeRRDtool()
+        patcher = mock.patch('plugins.rrd.rrdtool', self.rrdtool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def plugin(self, **kwargs):
+        plugin = RRD(MockSmartHome(), rrd_dir=self.dir + '/', **kwargs)
+        plugin.parse_item(Item('test.rrd', 1))
+        return plugin
+
+    def rrdb(self):
+        return self.dir + '/test.rrd.rrd'
+
+    def test_write_behind_bulk_update(self):
+        plugin = self.plugin(write_behind=3600)
+        plugin._flushed = 1000
+        with mock.patch('time.time', return_value=1000):
+            plugin._update_cycle()
+        plugin._rrds['test.rrd']['item'].value = 2
+        with mock.patch('time.time', return_value=1300):
+            plugin._update_cycle()
+        self.assertEqual({}, self.rrdtool.updates)
+        self.assertEqual(['1000:1.0', '1300:2.0'], plugin._pending[self.rrdb()])
+        plugin._flush()
+        self.assertEqual(1, len([call for call in self.rrdtool.calls if call[0] == 'update']))
+        self.assertEqual(['1000:1.0', '1300:2.0'], self.rrdtool.updates[self.rrdb()])
+
+    def test_write_behind_flushes_in_order(self):
+        plugin = self.plugin(write_behind=3600)
+        plugin._pending[self.rrdb()] = ['100:1.0']
+        # the scheduler flush is writing the older value while a reader flushes a newer one
+        gate = self.rrdtool.gate = threading.Event()
+        scheduler = threading.Thread(target=plugin._flush)
+        scheduler.start()
+        self.assertTrue(self.rrdtool.entered.wait(5))
+        with plugin._pending_lock:
+            plugin._pending[self.rrdb()] = ['200:2.0']
+        reader = threading.Thread(target=plugin._flush, args=(self.rrdb(),))
+        reader.start()
+        time.sleep(0.05)
+        gate.set()
+        scheduler.join(5)
+        reader.join(5)
+        self.assertEqual(['100:1.0', '200:2.0'], self.rrdtool.updates[self.rrdb()])
+        self.assertEqual({}, plugin._pending)
+
+    def test_journal_written_and_removed(self):
+        journal = self.dir + '/journal'
+        plugin = self.plugin(write_behind=3600, journal=journal)
+        plugin._flushed = time.time()
+        plugin._update_cycle()
+        with open(journal) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(["{} {}".format(self.rrdb(), plugin._pending[self.rrdb()][0])], lines)
+        plugin._flush(self.rrdb())
+        self.assertFalse(os.path.exists(journal))
+
+    def test_journal_replay(self):
+        journal = self.dir + '/journal'
+        with open(journal, 'w') as f:
+            f.write("{0} 100:1.0\n{0} 200:2.0\n{0} 300:3.0\n".format(self.rrdb()))
+        self.rrdtool.last_update[self.rrdb()] = 200
+        plugin = self.plugin(journal=journal)
+        plugin._replay()
+        # only the values newer than the last update of the file are written
+        self.assertEqual(['300:3.0'], self.rrdtool.updates[self.rrdb()])
+        self.assertFalse(os.path.exists(journal))
+
+    def test_journal_replay_write_behind(self):
+        journal = self.dir + '/journal'
+        with open(journal, 'w') as f:
+            f.write("{0} 100:1.0\n{0} 200:2.0\n".format(self.rrdb()))
+        self.rrdtool.last_update[self.rrdb()] = 100
+        plugin = self.plugin(write_behind=3600, journal=journal)
+        plugin._pending[self.rrdb()] = ['300:3.0']
+        plugin._replay()
+        self.assertEqual({}, self.rrdtool.updates)
+        self.assertEqual(['200:2.0', '300:3.0'], plugin._pending[self.rrdb()])
+
+    def test_rrdcached(self):
+        plugin = self.plugin(rrdcached='unix:/var/run/rrdcached.sock', write_behind=3600)
+        plugin._update_cycle()
+        self.assertEqual({}, plugin._pending)
+        self.assertEqual(('update', '--daemon', 'unix:/var/run/rrdcached.sock', self.rrdb(), 'N:1.0'), self.rrdtool.calls[0])
+        plugin._single('avg', item='test.rrd')
+        fetch = self.rrdtool.calls[1]
+        self.assertEqual('fetch', fetch[0])
+        self.assertEqual(['--daemon', 'unix:/var/run/rrdcached.sock'], list(fetch[-2:]))
+
+    def fetches(self):
+        return len([call for call in self.rrdtool.calls if call[0] == 'fetch'])
+
+    def test_init_in_run(self):
+        plugin = RRD(MockSmartHome(), rrd_dir=self.dir + '/')
+        item = Item('test.rrd', conf={'rrd': 'init'})
+        self.rrdtool.updates[self.rrdb()] = ['100:1.0', '200:2.0']
+        plugin.parse_item(item)
+        self.assertEqual(0, self.fetches())
+        plugin.run()
+        self.assertEqual(2.0, item.value)
+
+    def test_fetch_cache(self):
+        plugin = self.plugin()
+        self.assertEqual(0.0, plugin._single('avg', item='test.rrd'))
+        self.assertEqual(0.0, plugin._single('max', item='test.rrd'))
+        self.assertEqual(1, self.fetches())
+        plugin._single('avg', '2d', item='test.rrd')
+        self.assertEqual(2, self.fetches())
+
+    def test_fetch_cache_invalidated_by_update(self):
+        plugin = self.plugin()
+        self.assertEqual(0.0, plugin._single('avg', item='test.rrd'))
+        plugin._update_cycle()
+        self.assertEqual(1.0, plugin._single('avg', item='test.rrd'))
+        self.assertEqual(2, self.fetches())
+
+    def test_fetch_cache_invalidated_by_flush(self):
+        plugin = self.plugin(write_behind=3600)
+        plugin._flushed = time.time()
+        self.assertEqual(0.0, plugin._single('avg', item='test.rrd'))
+        plugin._update_cycle()
+        # the pending update is written before the values are read again
+        self.assertEqual(1.0, plugin._single('avg', item='test.rrd'))
+        self.assertEqual(2, self.fetches())
+
+    def test_fetch_cache_step(self):
+        plugin = self.plugin()
+        with mock.patch('time.time', return_value=1000):
+            plugin._single('avg', item='test.rrd')
+        with mock.patch('time.time', return_value=1199):
+            plugin._single('avg', item='test.rrd')
+        self.assertEqual(1, self.fetches())
+        # relative times are resolved again in the next step
+        with mock.patch('time.time', return_value=1200):
+            plugin._single('avg', item='test.rrd')
+        self.assertEqual(2, self.fetches())
+
+    def test_fetch_cache_size(self):
+        plugin = self.plugin(fetch_cache=2)
+        for start in ['1d', '2d', '3d', '1d']:
+            plugin._single('avg', start, item='test.rrd')
+        self.assertEqual(4, self.fetches())
+        self.assertEqual(2, len(plugin._fetch_cache[self.rrdb()]))
+        plugin._single('avg', '3d', item='test.rrd')
+        self.assertEqual(4, self.fetches())
+
+    def test_fetch_cache_disabled(self):
+        plugin = self.plugin(fetch_cache=0)
+        plugin._single('avg', item='test.rrd')
+        plugin._single('avg', item='test.rrd')
+        self.assertEqual(2, self.fetches())
+        self.assertEqual({}, plugin._fetch_cache)
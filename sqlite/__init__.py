@@ -19,14 +19,21 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import collections
 import logging
 import datetime
 import functools
 import time
 import threading
 import sqlite3
+import itertools
 from lib.model.smartplugin import SmartPlugin
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class SQL(SmartPlugin):
 
@@ -38,28 +45,36 @@ class SQL(SmartPlugin):
     # SQL queries
     # time, item, avg, vmin, vmax, power
     _create_db = "CREATE TABLE IF NOT EXISTS history (time INTEGER, item TEXT, avg REAL, vmin REAL, vmax REAL, power REAL);"
-    _create_index = "CREATE INDEX IF NOT EXISTS idy ON history (item);"
-    _pack_query = """
-        SELECT
-        group_concat(rowid),
-        group_concat(time),
-        group_concat(avg),
-        group_concat(power),
-        item,
-        MIN(vmin),
-        MAX(vmax)
-        FROM history
-        WHERE (time < {})
-        GROUP by CAST((time / {}) AS INTEGER), item
-        ORDER BY time DESC;"""
+    _create_index = "CREATE INDEX IF NOT EXISTS idz ON history (item, time);"
+    _prev_query = "SELECT time FROM history WHERE item = :item AND time <= :time ORDER BY time DESC LIMIT 1;"
+    _series_where = " FROM history WHERE item = :item AND time >= :start AND time <= :end GROUP BY CAST((time / :step) AS INTEGER)"
+    _series_queries = {
+        'avg': "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(avg), 2)" + _series_where + " ORDER BY time DESC;",
+        'min': "SELECT CAST(AVG(time) AS INTEGER), MIN(vmin)" + _series_where + ";",
+        'max': "SELECT CAST(AVG(time) AS INTEGER), MAX(vmax)" + _series_where + ";",
+        'on': "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(power), 2)" + _series_where + " ORDER BY time DESC;"
+    }
+    _single_where = " FROM history WHERE item = :item AND time >= :start AND time < :end;"
+    _single_queries = {
+        'avg': "SELECT AVG(avg)" + _single_where,
+        'min': "SELECT MIN(vmin)" + _single_where,
+        'max': "SELECT MAX(vmax)" + _single_where,
+        'on': "SELECT AVG(power)" + _single_where
+    }
+    _journal_modes = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+    _synchronous = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
 
-    def __init__(self, smarthome, cycle=300, path=None):
+    def __init__(self, smarthome, cycle=300, path=None, journal_mode=None, synchronous=None, series_cache=256):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.connected = False
         self._dump_cycle = int(cycle)
         self._buffer = {}
         self._buffer_lock = threading.Lock()
+        self._dump_pending = []     # rows of a dump not written yet
+        self._series_cache = collections.OrderedDict()  # {(item, func, start bucket, end bucket, step): (first, tuples)}
+        self._series_cache_size = int(series_cache)
+        self._series_cache_lock = threading.Lock()
         self.logger.debug("SQLite {0}".format(sqlite3.sqlite_version))
         self._fdb_lock = threading.Lock()
         self._fdb_lock.acquire()
@@ -74,6 +89,21 @@ class SQL(SmartPlugin):
             self._fdb_lock.release()
             return
         self.connected = True
+        if journal_mode is not None:
+            journal_mode = journal_mode.upper()
+            if journal_mode in self._journal_modes:
+                journal_mode = self._fdb.execute("PRAGMA journal_mode={};".format(journal_mode)).fetchone()[0].upper()
+                self.logger.debug("SQLite: journal mode {}".format(journal_mode))
+            else:
+                self.logger.error("SQLite: unknown journal_mode '{}', use one of {}".format(journal_mode, ', '.join(self._journal_modes)))
+        if synchronous is not None:
+            synchronous = synchronous.upper()
+            if synchronous in self._synchronous:
+                self._fdb.execute("PRAGMA synchronous={};".format(synchronous))
+            else:
+                self.logger.error("SQLite: unknown synchronous '{}', use one of {}".format(synchronous, ', '.join(self._synchronous)))
+        # free pages are given back by the pack job with incremental_vacuum (new databases only, existing ones are converted by _pack)
+        self._fdb.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         integrity = self._fdb.execute("PRAGMA integrity_check(10);").fetchone()[0]
         if integrity == 'ok':
             self.logger.debug("SQLite: database integrity ok")
@@ -92,12 +122,22 @@ class SQL(SmartPlugin):
                 self.logger.warning("SQLite: dropping history!")
                 self._fdb.execute("DROP TABLE history;")
         self._fdb.execute("DROP INDEX IF EXISTS idx;")
+        self._fdb.execute("DROP INDEX IF EXISTS idy;")  # replaced by idz
         self._fdb.execute(self._create_db)
         self._fdb.execute(self._create_index)
         if version < self._version:
             self._fdb.execute("UPDATE common SET version=:version;", {'version': self._version})
             # self.query("alter table history add column power INTEGER;")
         self._fdb.commit()
+        # readers do not block the writer in WAL mode, queries get their own connection
+        self._rdb = self._fdb
+        self._rdb_lock = self._fdb_lock
+        if journal_mode == 'WAL':
+            try:
+                self._rdb = sqlite3.connect(self.path, check_same_thread=False)
+                self._rdb_lock = threading.Lock()
+            except Exception as e:
+                self.logger.error("SQLite: Could not open read connection to the database {}: {}".format(self.path, e))
         self._fdb_lock.release()
         minute = 60 * 1000
         hour = 60 * minute
@@ -118,7 +158,7 @@ class SQL(SmartPlugin):
             item.series = functools.partial(self._series, item=item.id())
             item.db = functools.partial(self._single, item=item.id())
             if item.conf['sqlite'] == 'init':
-                last = self._fetchone("SELECT avg from history WHERE item = '{0}' ORDER BY time DESC LIMIT 1".format(item.id()))
+                last = self._fetchone("SELECT avg FROM history WHERE item = :item ORDER BY time DESC LIMIT 1;", {'item': item.id()})
                 if last is not None:
                     last = last[0]
                     item.set(last, 'SQLite')
@@ -136,6 +176,10 @@ class SQL(SmartPlugin):
         self._dump()
         self._fdb_lock.acquire()
         try:
+            if self._rdb is not self._fdb:
+                self._rdb_lock.acquire()
+                self._rdb.close()
+                self._rdb_lock.release()
             self._fdb.close()
         except Exception:
             pass
@@ -169,6 +213,8 @@ class SQL(SmartPlugin):
             return
         items = list(self._buffer.keys())
         self._fdb_lock.release()
+        inserts = self._dump_pending
+        self._dump_pending = []
         for item in items:
             self._buffer_lock.acquire()
             tuples = self._buffer[item]
@@ -177,19 +223,57 @@ class SQL(SmartPlugin):
             self.update_item(item)
             _now = self._timestamp(self._sh.now())
             try:
-                _insert = self.__dump(item.id(), tuples, _now)
+                inserts.append(self.__dump(item.id(), tuples, _now))
             except:
                 continue
-            if not self._fdb_lock.acquire(timeout=10):
-                continue
-            try:
-                # time, item, avg, vmin, vmax, power
-                self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", _insert)
-                self._fdb.commit()
-            except Exception as e:
-                self.logger.warning("SQLite: problem updating {}: {}".format(item.id(), e))
-            finally:
-                self._fdb_lock.release()
+        if not inserts:
+            return
+        if not self._fdb_lock.acquire(timeout=10):
+            self._dump_pending = inserts  # retry with the next dump
+            return
+        try:
+            # time, item, avg, vmin, vmax, power
+            self._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", inserts)
+            self._fdb.commit()
+        except Exception as e:
+            self.logger.warning("SQLite: problem dumping {} items: {}".format(len(inserts), e))
+            self._fdb.rollback()
+            return
+        finally:
+            self._fdb_lock.release()
+        changed = {}
+        for insert in inserts:
+            changed[insert[1]] = min(insert[0], changed.get(insert[1], insert[0]))
+        self._series_cache_invalidate(changed)
+
+    def _series_cache_get(self, key):
+        with self._series_cache_lock:
+            if key not in self._series_cache:
+                return None
+            self._series_cache.move_to_end(key)
+            return self._series_cache[key]
+
+    def _series_cache_put(self, key, value):
+        if self._series_cache_size <= 0:
+            return
+        with self._series_cache_lock:
+            self._series_cache[key] = value
+            while len(self._series_cache) > self._series_cache_size:
+                self._series_cache.popitem(last=False)
+
+    def _series_cache_invalidate(self, changed=None):
+        """
+        removes the cached series of the items {item: time} which end after the
+        time of the first change, all series if changed is None
+        """
+        with self._series_cache_lock:
+            if changed is None:
+                self._series_cache.clear()
+                return
+            for key in list(self._series_cache):
+                item, func, start, end, step = key
+                if item in changed and (end + 1) * step >= changed[item]:
+                    del self._series_cache[key]
 
     def __dump(self, item, tuples, end):
         vsum = 0.0
@@ -231,105 +315,160 @@ class SQL(SmartPlugin):
         return ts
 
     def _fetchone(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
+        if not self._rdb_lock.acquire(timeout=2):
             return
         if not self.connected:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
             return
         try:
-            reply = self._fdb.execute(*query).fetchone()
+            reply = self._rdb.execute(*query).fetchone()
         except Exception as e:
             self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
             reply = None
         finally:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
         return reply
 
     def _fetchall(self, *query):
-        if not self._fdb_lock.acquire(timeout=2):
+        if not self._rdb_lock.acquire(timeout=2):
             return
         if not self.connected:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
             return
         try:
-            reply = self._fdb.execute(*query).fetchall()
+            reply = self._rdb.execute(*query).fetchall()
         except Exception as e:
             self.logger.warning("SQLite: Problem with '{0}': {1}".format(query, e))
             reply = None
         finally:
-            self._fdb_lock.release()
+            self._rdb_lock.release()
         return reply
 
     def _pack(self):
-        insert = []
-        delete = []
-        if not self._fdb_lock.acquire(timeout=2):
+        self.logger.debug("SQLite: pack database")
+        now = self._timestamp(self._sh.now())
+        # (time limit, granularity) of the periods, the oldest first
+        periods = [(int(now - period * 24 * 3600 * 1000), int(granularity * 3600 * 1000)) for period, granularity in self.periods]
+        items = self._fetchall("SELECT DISTINCT item FROM history;")
+        if items is None:
+            return
+        # one transaction per item, queries have to wait for one item only
+        for item, in items:
+            if not self._fdb_lock.acquire(timeout=10):
+                self.logger.warning("SQLite: skipped packing {}, database locked".format(item))
+                continue
+            try:
+                self.__pack_item(item, periods, now)
+            except Exception as e:
+                self.logger.exception("SQLite: problem packing {}: {}".format(item, e))
+                self._fdb.rollback()
+            finally:
+                self._fdb_lock.release()
+        self._series_cache_invalidate()
+        if not self._fdb_lock.acquire(timeout=10):
             return
         try:
-            self.logger.debug("SQLite: pack database")
-            for entry in self.periods:
-                now = self._timestamp(self._sh.now())
-                prev = {}
-                period, granularity = entry
-                period = int(now - period * 24 * 3600 * 1000)
-                granularity = int(granularity * 3600 * 1000)
-                for row in self._fdb.execute(self._pack_query.format(period, granularity)):
-                    gid, gtime, gavg, gpower, item, vmin, vmax = row
-                    gtime = gtime.split(',')
-                    if len(gtime) == 1:  # ignore
-                        prev[item] = gtime[0]
-                        continue
-                    if item not in prev:
-                        upper = now
-                    else:
-                        upper = prev[item]
-                    # pack !!!
-                    delete = gid
-                    gavg = gavg.split(',')
-                    gpower = gpower.split(',')
-                    _time, _avg, _power = self.__pack(gtime, gavg, gpower, upper)
-                    insert = (_time, item, _avg, vmin, vmax, _power)
-                    self._fdb.execute("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
-                    self._fdb.execute("DELETE FROM history WHERE rowid in ({0});".format(delete))
-                    self._fdb.commit()
-                    prev[item] = gtime[0]
-            self._fdb.execute("VACUUM;")
+            if self._fdb.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+                self._fdb.execute("PRAGMA incremental_vacuum;").fetchall()
+            else:
+                self.logger.info("SQLite: converting database to incremental vacuum, this will take a while")
+                self._fdb.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                self._fdb.execute("VACUUM;")
             self._fdb.execute("PRAGMA shrink_memory;")
         except Exception as e:
-            self.logger.exception("problem packing sqlite database: {} period: {} type: {}".format(e, period, type(period)))
-            self._fdb.rollback()
+            self.logger.warning("SQLite: problem vacuum database: {}".format(e))
         finally:
             self._fdb_lock.release()
 
-    def __pack(self, gtime, gavg, gpower, end):
-        asum = 0.0
-        psum = 0.0
-        end = int(end)
-        prev = end
-        tuples = []
-        for i, _time in enumerate(gtime):
-            tuples.append((int(_time), float(gavg[i]), float(gpower[i])))
-        for _time, _avg, _power in sorted(tuples, reverse=True):
-            asum += (prev - _time) * _avg
-            psum += (prev - _time) * _power
-            prev = _time
-        span = end - _time
-        if span != 0:
-            return (_time, asum / span, psum / span)
+    def __pack_item(self, item, periods, now):
+        limit = periods[-1][0]
+        rows = self._fdb.execute("SELECT rowid, time, avg, vmin, vmax, power FROM history WHERE item = ? AND time < ? ORDER BY time;", (item, limit)).fetchall()
+        if len(rows) < 2:
+            return
+        upper = self._fdb.execute("SELECT MIN(time) FROM history WHERE item = ? AND time >= ?;", (item, limit)).fetchone()[0]
+        if upper is None:
+            upper = now
+        if numpy is not None:
+            insert, delete = self._pack_numpy(item, rows, periods, upper)
         else:
-            return (_time, _avg, _power)
+            insert, delete = self._pack_python(item, rows, periods, upper)
+        if not insert:
+            return
+        self._fdb.executemany("DELETE FROM history WHERE rowid = ?;", [(rowid,) for rowid in delete])
+        # time, item, avg, vmin, vmax, power
+        self._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", insert)
+        self._fdb.commit()
+
+    def _pack_python(self, item, rows, periods, upper):
+        """
+        packs the rows (rowid, time, avg, vmin, vmax, power) of an item ordered
+        by time. Each row is grouped by the granularity of the oldest period it
+        belongs to, the rows of a group are replaced by their time weighted
+        average. Returns the rows to insert and the rowids to delete.
+        """
+        def group(row):
+            for limit, granularity in periods:
+                if row[1] < limit:
+                    return granularity, row[1] // granularity
+        insert = []
+        delete = []
+        groups = [list(rows) for key, rows in itertools.groupby(rows, group)]
+        for i, rows in enumerate(groups):
+            if len(rows) == 1:
+                continue
+            end = groups[i + 1][0][1] if i + 1 < len(groups) else upper
+            asum = 0.0
+            psum = 0.0
+            for j, row in enumerate(rows):
+                span = (rows[j + 1][1] if j + 1 < len(rows) else end) - row[1]
+                asum += span * row[2]
+                psum += span * row[5]
+            span = end - rows[0][1]
+            if span != 0:
+                insert.append((rows[0][1], item, asum / span, min(row[3] for row in rows), max(row[4] for row in rows), psum / span))
+            else:
+                insert.append((rows[0][1], item, rows[0][2], min(row[3] for row in rows), max(row[4] for row in rows), rows[0][5]))
+            delete.extend(row[0] for row in rows)
+        return insert, delete
+
+    def _pack_numpy(self, item, rows, periods, upper):
+        """
+        NumPy version of _pack_python
+        """
+        rowid, times, avg, vmin, vmax, power = (numpy.array(column) for column in zip(*rows))
+        times = times.astype(numpy.int64)
+        avg = avg.astype(numpy.float64)
+        power = power.astype(numpy.float64)
+        granularity = numpy.zeros(len(times), dtype=numpy.int64)
+        for limit, g in reversed(periods):
+            granularity[times < limit] = g
+        bucket = times // granularity
+        starts = numpy.flatnonzero(numpy.r_[True, (granularity[1:] != granularity[:-1]) | (bucket[1:] != bucket[:-1])])
+        sizes = numpy.diff(numpy.r_[starts, len(times)])
+        spans = numpy.r_[times[1:], upper] - times
+        asum = numpy.add.reduceat(spans * avg, starts)
+        psum = numpy.add.reduceat(spans * power, starts)
+        span = numpy.add.reduceat(spans, starts)
+        vmin = numpy.minimum.reduceat(vmin.astype(numpy.float64), starts)
+        vmax = numpy.maximum.reduceat(vmax.astype(numpy.float64), starts)
+        insert = []
+        delete = []
+        for i in numpy.flatnonzero(sizes > 1):
+            start = starts[i]
+            if span[i] != 0:
+                insert.append((int(times[start]), item, float(asum[i] / span[i]), float(vmin[i]), float(vmax[i]), float(psum[i] / span[i])))
+            else:
+                insert.append((int(times[start]), item, float(avg[start]), float(vmin[i]), float(vmax[i]), float(power[start])))
+            delete.extend(int(r) for r in rowid[start:start + sizes[i]])
+        return insert, delete
 
     def _series(self, func, start, end='now', count=100, ratio=1, update=False, step=None, sid=None, item=None):
         if sid is None:
             sid = item + '|' + func + '|' + start + '|' + end
         istart = self._get_timestamp(start)
         iend = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item='{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, istart))
-        if not prev:
-            first = istart
-        else:
-            first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time <= {2}".format(item, first, iend)
+        if func not in self._series_queries:
+            raise NotImplementedError
         if step is None:
             if count != 0:
                 step = (iend - istart) / count
@@ -338,18 +477,20 @@ class SQL(SmartPlugin):
         reply = {'cmd': 'series', 'series': None, 'sid': sid}
         reply['params'] = {'update': True, 'item': item, 'func': func, 'start': iend, 'end': end, 'step': step, 'sid': sid}
         reply['update'] = self._sh.now() + datetime.timedelta(seconds=int(step / 1000))
-        where += " GROUP by CAST((time / {0}) AS INTEGER)".format(step)
-        if func == 'avg':
-            query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(avg), 2)" + where + " ORDER BY time DESC"
-        elif func == 'min':
-            query = "SELECT CAST(AVG(time) AS INTEGER), MIN(vmin)" + where
-        elif func == 'max':
-            query = "SELECT CAST(AVG(time) AS INTEGER), MAX(vmax)" + where
-        elif func == 'on':
-            query = "SELECT CAST(AVG(time) AS INTEGER), ROUND(AVG(power), 2)" + where + " ORDER BY time DESC"
+        # the series of the same step interval are the same until the next dump
+        key = (item, func, int(istart // step), int(iend // step), step) if step > 0 else None
+        cached = self._series_cache_get(key) if key else None
+        if cached is not None:
+            first, tuples = cached
         else:
-            raise NotImplementedError
-        tuples = self._fetchall(query)
+            prev = self._fetchone(self._prev_query, {'item': item, 'time': istart})
+            if not prev:
+                first = istart
+            else:
+                first = prev[0]
+            tuples = self._fetchall(self._series_queries[func], {'item': item, 'start': first, 'end': iend, 'step': step})
+            if tuples is not None and key:
+                self._series_cache_put(key, (first, tuples))
         if not tuples:
             if not update:
                 reply['series'] = [(iend, 0)]
@@ -366,24 +507,15 @@ class SQL(SmartPlugin):
     def _single(self, func, start, end='now', item=None):
         start = self._get_timestamp(start)
         end = self._get_timestamp(end)
-        prev = self._fetchone("SELECT time from history WHERE item = '{0}' AND time <= {1} ORDER BY time DESC LIMIT 1".format(item, start))
+        if func not in self._single_queries:
+            self.logger.warning("Unknown export function: {0}".format(func))
+            return
+        prev = self._fetchone(self._prev_query, {'item': item, 'time': start})
         if prev is None:
             first = start
         else:
             first = prev[0]
-        where = " from history WHERE item='{0}' AND time >= {1} AND time < {2}".format(item, first, end)
-        if func == 'avg':
-            query = "SELECT AVG(avg)" + where
-        elif func == 'min':
-            query = "SELECT MIN(vmin)" + where
-        elif func == 'max':
-            query = "SELECT MAX(vmax)" + where
-        elif func == 'on':
-            query = "SELECT AVG(power)" + where
-        else:
-            self.logger.warning("Unknown export function: {0}".format(func))
-            return
-        tuples = self._fetchall(query)
+        tuples = self._fetchall(self._single_queries[func], {'item': item, 'start': first, 'end': end})
         if tuples is None:
             return
         return tuples[0][0]
@@ -0,0 +1,138 @@
+import shutil
+import tempfile
+import unittest
+
+import common
+from plugins.sqlite import SQL
+from tests.mock.core import MockSmartHome
+
+class Connection:
+    """ Counts the commits of a database connection """
+
+    def __init__(self, db):
+        self.db = db
+        self.commits = 0
+        self.queries = 0
+
+    def execute(self, *args):
+        self.queries += 1
+        return self.db.execute(*args)
+
+    def commit(self):
+        self.commits += 1
+        self.db.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+class TestSQLite(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def plugin(self, **kwargs):
+        self.sh = MockSmartHome()
+        self.sh.with_items_from(common.BASE + '/plugins/sqlite/tests/test_items.conf')
+        plugin = SQL(self.sh, path=self.path, **kwargs)
+        for item in self.sh.return_items():
+            plugin.parse_item(item)
+        return plugin
+
+    def test_dump_one_transaction(self):
+        plugin = self.plugin()
+        plugin._fdb = Connection(plugin._fdb)
+        self.sh.return_item('main.num')(42)
+        plugin.update_item(self.sh.return_item('main.num'))
+        plugin._dump()
+        self.assertEqual(1, plugin._fdb.commits)
+        self.assertEqual(3, plugin._fetchone("SELECT COUNT(*) FROM history;")[0])
+        self.assertEqual((42.0,), plugin._fetchone("SELECT vmax FROM history WHERE item = 'main.num';"))
+
+    def test_wal_read_connection(self):
+        plugin = self.plugin(journal_mode='wal', synchronous='normal')
+        self.assertEqual('wal', plugin._fdb.execute("PRAGMA journal_mode;").fetchone()[0])
+        self.assertEqual(1, plugin._fdb.execute("PRAGMA synchronous;").fetchone()[0])
+        self.assertIsNot(plugin._fdb, plugin._rdb)
+        plugin._dump()
+        # queries do not wait for the writer
+        plugin._fdb_lock.acquire()
+        self.assertEqual(3, plugin._fetchone("SELECT COUNT(*) FROM history;")[0])
+        plugin._fdb_lock.release()
+        plugin.stop()
+
+    def test_unknown_journal_mode(self):
+        plugin = self.plugin(journal_mode='foo')
+        self.assertIs(plugin._fdb, plugin._rdb)
+
+    def insert(self, plugin, rows):
+        plugin._fdb.executemany("INSERT INTO history VALUES (?,?,?,?,?,?);", rows)
+        plugin._fdb.commit()
+
+    def pack_rows(self, plugin):
+        now = plugin._timestamp(self.sh.now())
+        minute = 60 * 1000
+        start = (now - 10 * 24 * 60 * minute) // (30 * minute) * 30 * minute
+        rows = [(start + i * 10 * minute, 'main.num', i, i, i, 1) for i in range(7)]
+        rows.append((now, 'main.num', 10, 10, 10, 1))
+        return start, rows
+
+    def test_pack(self):
+        plugin = self.plugin()
+        minute = 60 * 1000
+        start, rows = self.pack_rows(plugin)
+        self.insert(plugin, rows)
+        plugin._pack()
+        self.assertEqual([
+            (start, 1.0, 0.0, 2.0, 1.0),
+            (start + 30 * minute, 4.0, 3.0, 5.0, 1.0),
+            (start + 60 * minute, 6.0, 6.0, 6.0, 1.0),
+            (rows[-1][0], 10.0, 10.0, 10.0, 1.0)
+        ], plugin._fetchall("SELECT time, avg, vmin, vmax, power FROM history WHERE item = 'main.num' ORDER BY time;"))
+        self.assertEqual(2, plugin._fdb.execute("PRAGMA auto_vacuum;").fetchone()[0])
+
+    def test_pack_python_numpy(self):
+        import plugins.sqlite
+        if plugins.sqlite.numpy is None:
+            self.skipTest("NumPy not installed")
+        plugin = self.plugin()
+        now = plugin._timestamp(self.sh.now())
+        periods = [(int(now - period * 24 * 3600 * 1000), int(granularity * 3600 * 1000)) for period, granularity in plugin.periods]
+        step = 37 * 60 * 1000
+        rows = [(i, now - 2000 * 24 * 3600 * 1000 + i * step, 'x', (i * 7) % 13, i % 5, i % 11, i % 2) for i in range(80000)]
+        rows = [(rowid, t, avg, vmin, vmax, power) for rowid, t, item, avg, vmin, vmax, power in rows if t < periods[-1][0]]
+        python = plugin._pack_python('x', rows, periods, now)
+        numpy = plugin._pack_numpy('x', rows, periods, now)
+        self.assertEqual(python[1], numpy[1])
+        self.assertEqual(len(python[0]), len(numpy[0]))
+        for a, b in zip(python[0], numpy[0]):
+            self.assertEqual(a[:2], b[:2])
+            for x, y in zip(a[2:], b[2:]):
+                self.assertAlmostEqual(x, y)
+
+    def test_series(self):
+        plugin = self.plugin()
+        self.insert(plugin, [(i * 1000, 'main.num', i, i, i, 1) for i in range(10)])
+        self.assertEqual([(500, 0.5), (2500, 2.5), (4500, 4.5), (6500, 6.5), (8500, 8.5), (10000, 8.5)], plugin._series('avg', '0', '10000', 5, item='main.num')['series'])
+        self.assertEqual([(500, 1), (2500, 3), (4500, 5), (6500, 7), (8500, 9), (10000, 9)], plugin._series('max', '0', '10000', 5, item='main.num')['series'])
+        self.assertEqual(4.5, plugin._single('avg', 0, 10000, item='main.num'))
+        self.assertIsNone(plugin._single('avg', 0, 10000, item="main.num' OR item LIKE '%"))
+
+    def test_series_cache(self):
+        plugin = self.plugin()
+        self.insert(plugin, [(i * 1000, 'main.num', i, i, i, 1) for i in range(10)])
+        plugin._rdb = Connection(plugin._rdb)
+        series = plugin._series('avg', '0', '10000', 5, item='main.num')['series']
+        queries = plugin._rdb.queries
+        self.assertEqual(series, plugin._series('avg', '0', '10000', 5, item='main.num')['series'])
+        # same step interval
+        self.assertEqual(series[:-1] + [(10100, 8.5)], plugin._series('avg', '100', '10100', 5, item='main.num')['series'])
+        self.assertEqual(queries, plugin._rdb.queries)
+        # a dump of the item invalidates the series
+        plugin._buffer[self.sh.return_item('main.num')] = [(9500, 20.0, 1)]
+        plugin._dump()
+        self.assertEqual(20, plugin._series('max', '0', '10000', 5, item='main.num')['series'][-1][1])
+        self.assertEqual(12.33, plugin._series('avg', '0', '10000', 5, item='main.num')['series'][-1][1])
+        self.assertGreater(plugin._rdb.queries, queries)
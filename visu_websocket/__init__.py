@@ -22,9 +22,12 @@
 #  along with SmartHomeNG. If not, see <http://www.gnu.org/licenses/>.
 #########################################################################
 
+import asyncio
 import base64
+import collections
 import datetime
 import decimal
+import functools
 import hashlib
 import json
 import logging
@@ -32,6 +35,7 @@ import struct
 import ssl
 import struct
 import threading
+import zlib
 
 import lib.connection
 from lib.model.smartplugin import SmartPlugin
@@ -55,7 +59,7 @@ class WebSocket(SmartPlugin):
         return result
 
 
-    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3' ):
+    def __init__(self, smarthome, ip='0.0.0.0', port=2424, tls='no', acl='ro', wsproto='3', update_cycle='50', update_batch='100', json_backend='json', compress_threshold='1024', server='connection', write_buffer='65536' ):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
 
@@ -85,12 +89,53 @@ class WebSocket(SmartPlugin):
             proto = 3
             self.logger.error("WebSocket: Invalid value '"+str(wsproto)+"' configured for attribute wsproto in plugin.conf, using '"+str(proto)+"' instead")
 
-        self.websocket = _websocket(smarthome, ip, port, self.tls, proto)
+        if self.is_int(update_cycle):
+            update_cycle = int(update_cycle)
+        else:
+            update_cycle = 50
+            self.logger.error("WebSocket: Invalid value '"+str(update_cycle)+"' configured for attribute update_cycle in plugin.conf, using '"+str(50)+"' instead")
+
+        if self.is_int(update_batch):
+            update_batch = int(update_batch)
+        else:
+            update_batch = 100
+            self.logger.error("WebSocket: Invalid value '"+str(update_batch)+"' configured for attribute update_batch in plugin.conf, using '"+str(100)+"' instead")
+
+        if self.is_int(compress_threshold):
+            compress_threshold = int(compress_threshold)
+        else:
+            compress_threshold = 1024
+            self.logger.error("WebSocket: Invalid value '"+str(compress_threshold)+"' configured for attribute compress_threshold in plugin.conf, using '"+str(1024)+"' instead")
+
+        dumps = json_dumps
+        if json_backend == 'orjson':
+            try:
+                import orjson
+                # datetimes are serialized by JSONEncoder like the json backend does
+                dumps = functools.partial(orjson.dumps, default=JSONEncoder().default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+            except ImportError:
+                self.logger.error("WebSocket: JSON backend 'orjson' configured for attribute json_backend in plugin.conf is not installed, using 'json' instead")
+        elif json_backend != 'json':
+            self.logger.error("WebSocket: Invalid value '"+str(json_backend)+"' configured for attribute json_backend in plugin.conf, using 'json' instead")
+
+        if self.is_int(write_buffer):
+            write_buffer = int(write_buffer)
+        else:
+            write_buffer = 65536
+            self.logger.error("WebSocket: Invalid value '"+str(write_buffer)+"' configured for attribute write_buffer in plugin.conf, using '"+str(65536)+"' instead")
+
+        if server == 'asyncio':
+            self.websocket = _asynciowebsocket(smarthome, ip, self.port, self.tls, proto, update_cycle, update_batch, dumps, compress_threshold, write_buffer)
+        else:
+            if server != 'connection':
+                self.logger.error("WebSocket: Invalid value '"+str(server)+"' configured for attribute server in plugin.conf, using 'connection' instead")
+            self.websocket = _websocket(smarthome, ip, port, self.tls, proto, update_cycle, update_batch, dumps, compress_threshold)
         
 
     def run(self):
         self.alive = True
         self._sh.scheduler.add('series', self.websocket._update_series, cycle=10, prio=5)
+        self.websocket.run()
 
 
     def stop(self):
@@ -149,19 +194,28 @@ class WebSocket(SmartPlugin):
 
 #########################################################################
 
-class _websocket(lib.connection.Server):
+class _websocketserver:
     """
-    Websocket specific class of the Plugin. Handles the websocket connections
+    Common part of the websocket servers of the Plugin. Sends the updates to the clients
     """
 
-    def __init__(self, smarthome, ip, port, tls, wsproto ):
-        lib.connection.Server.__init__(self, ip, port)
+    def __init__(self, smarthome, tls, wsproto, update_cycle=50, update_batch=100, dumps=None, compress_threshold=1024 ):
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
         self.tls = tls
         self.proto = wsproto
+        self.update_cycle = update_cycle
+        self.update_batch = update_batch
+        self.dumps = json_dumps if dumps is None else dumps
+        self.compress_threshold = compress_threshold
+        self._flush_event = threading.Event()
+        self._flush_thread = None
         smarthome.add_event_listener(['log'], self._send_event)
         self.clients = []
+        self.subscriptions = {}
+        self._subscriptions_lock = threading.Lock()
+        self.series = {}
+        self._series_lock = threading.Lock()
         self.visu_items = {}
         self.visu_logics = {}
 
@@ -175,86 +229,265 @@ class _websocket(lib.connection.Server):
             yield client.addr
 
 
-    def handle_connection(self):
-        sock, address = self.accept()
-        if sock is None:
-            return
-        if self.tls:
-            try:
-                # cert_reqs=ssl.CERT_REQUIRED
-                sock = ssl.wrap_socket(sock, server_side=True, cert_reqs=ssl.CERT_OPTIONAL, certfile=self.tls_crt, ca_certs=self.tls_ca, keyfile=self.tls_key, ssl_version=ssl.PROTOCOL_TLSv1)
-                self.logger.debug('Client cert: {0}'.format(sock.getpeercert()))
-                self.logger.debug('Cipher: {0}'.format(sock.cipher()))
-#               print ssl.OPENSSL_VERSION
-            except Exception as e:
-                self.logger.exception(e)
-                return
-        client = websockethandler(self._sh, self, sock, address, self.visu_items, self.visu_logics, self.proto)
-        self.clients.append(client)
+    def run(self):
+        if self.update_cycle > 0:
+            self._flush_thread = threading.Thread(target=self._flush, name='VISU Websocket flush')
+            self._flush_thread.daemon = True
+            self._flush_thread.start()
 
     def stop(self):
-        for client in self.clients:
+        self._flush_event.set()
+        for client in list(self.clients):
             try:
                 client.close()
             except:
                 pass
-        self.close()
+
+    def _flush(self):
+        # send the coalesced item updates of all clients every update_cycle ms
+        while not self._flush_event.wait(self.update_cycle / 1000):
+            for client in list(self.clients):
+                try:
+                    client.flush_items()
+                except Exception as e:
+                    self.logger.debug("_websocket / _flush: cannot flush client {0}, error {1}".format(client, e))
 
     def update_item(self, item_name, item_value, source):
-        data = {'cmd': 'item', 'items': [[item_name, item_value]]}
-#        self.logger.warning("_websocket: update_item: data {0}".format(data))
-        for client in list(self.clients):
+#        self.logger.warning("_websocket: update_item: {0} = {1}".format(item_name, item_value))
+        if self.update_cycle <= 0:
+            clients = [client for client in self.subscriptions.get(item_name, ()) if client.addr != source]
+            self.broadcast({'cmd': 'item', 'items': [[item_name, item_value]]}, clients, update=True)
+            return
+        for client in self.subscriptions.get(item_name, ()):
             try:
-                client.update(item_name, data, source)
+                client.update(item_name, item_value, source)
             except:
                 pass
 
+    def broadcast(self, data, clients, update=False):
+        # serialize and frame the data only once for all clients, updates of
+        # items and series may be dropped for congested clients
+        message = _message(data, self.dumps, self.compress_threshold)
+        for client in clients:
+            try:
+                client.send_message(message, update)
+            except:
+                pass
+
+    def subscribe(self, client, items):
+        # the sets of clients are replaced instead of modified, so update_item
+        # can iterate them without locking
+        self._subscriptions_lock.acquire()
+        for path in client.monitor_items.difference(items):
+            clients = self.subscriptions[path] - {client}
+            if clients:
+                self.subscriptions[path] = clients
+            else:
+                del(self.subscriptions[path])
+        for path in items.difference(client.monitor_items):
+            self.subscriptions[path] = self.subscriptions.get(path, frozenset()) | {client}
+        client.monitor_items = items
+        self._subscriptions_lock.release()
+
+    def subscribe_series(self, client, sid, update, params, since=None):
+        # clients requesting the same series share its updates, since is the
+        # time of the last point sent to the client
+        self._series_lock.acquire()
+        series = self.series.get(sid)
+        if series is None:
+            self.series[sid] = {'update': update, 'params': params, 'clients': {client: since}}
+        else:
+            # the reply of a later client may end before the last update of
+            # the series, then the series is updated from its start
+            if self._series_start(params) < self._series_start(series['params']):
+                series['params'] = dict(series['params'], start=params['start'])
+                series['update'] = min(series['update'], update)
+            series['clients'][client] = since
+        self._series_lock.release()
+
+    def _series_start(self, params):
+        try:
+            return int(params['start'])
+        except (KeyError, TypeError, ValueError):
+            return 0
+
+    def unsubscribe_series(self, client, sid=None):
+        self._series_lock.acquire()
+        for sid in list(self.series) if sid is None else [sid]:
+            series = self.series.get(sid)
+            if series is None:
+                continue
+            series['clients'].pop(client, None)
+            if not series['clients']:
+                del(self.series[sid])
+        self._series_lock.release()
+
     def remove_client(self, client):
+        self.subscribe(client, frozenset())
+        self.unsubscribe_series(client)
         self.clients.remove(client)
 
 
     def _send_event(self, event, data):
-        for client in list(self.clients):
-            try:
-                client.send_event(event, data)
-            except:
-                pass
+        clients = [client for client in list(self.clients) if client.monitors(event, data)]
+        if clients:
+            data = data.copy()  # don't filter the orignal data dict
+            data['cmd'] = event
+            self.broadcast(data, clients)
 
     def _update_series(self):
-        for client in list(self.clients):
+        now = self._sh.now()
+        self._series_lock.acquire()
+        updates = [(sid, series['params']) for sid, series in self.series.items() if series['update'] < now]
+        self._series_lock.release()
+        for sid, params in updates:
             try:
-                client.update_series()
+                reply = self.visu_items[params['item']]['item'].series(**params)
             except Exception as e:
-                self.logger.warning("_websocket / _update_series: cannot update client {0}, error {1}".format(client, e))
-                pass
+                self.logger.exception("Problem updating series for {0}: {1}".format(params, e))
+                self._series_lock.acquire()
+                self.series.pop(sid, None)
+                self._series_lock.release()
+                continue
+            points = reply['series'] or []
+            self._series_lock.acquire()
+            series = self.series.get(sid)
+            if series is not None:
+                series['update'] = reply['update']
+                series['params'] = reply['params']
+                clients = list(series['clients'].items())
+                if points:
+                    series['clients'] = dict.fromkeys(series['clients'], max(point[0] for point in points))
+            else:
+                clients = []
+            self._series_lock.release()
+            del(reply['update'])
+            del(reply['params'])
+            if reply['series'] is None:
+                continue
+            # clients answered after the start of the update only get the
+            # points they don't have yet, the others share one message
+            first = min(point[0] for point in points) if points else None
+            shared = []
+            for client, since in clients:
+                if since is None or first is None or since <= first:
+                    shared.append(client)
+                else:
+                    tail = [point for point in points if point[0] >= since]
+                    if tail:
+                        self.broadcast(dict(reply, series=tail), [client], update=True)
+            if shared:
+                self.broadcast(reply, shared, update=True)
 
     def dialog(self, header, content):
-        for client in list(self.clients):
-            try:
-                client.json_send({'cmd': 'dialog', 'header': header, 'content': content})
-            except:
-                pass
+        self.broadcast({'cmd': 'dialog', 'header': header, 'content': content}, list(self.clients))
 
     def url(self, url, clientip=''):
+        clients = []
         for client in list(self.clients):
             ip, _, port = client.addr.partition(':')
             if (clientip == '') or (clientip == ip):
                 self.logger.debug("VISU: Websocket send url to ip={}, port={}".format(str(ip),str(port)))
+                clients.append(client)
+        self.broadcast({'cmd': 'url', 'url': url}, clients)
+
+
+#########################################################################
+
+class _websocket(_websocketserver, lib.connection.Server):
+    """
+    Websocket specific class of the Plugin. Handles the websocket connections
+    """
+
+    def __init__(self, smarthome, ip, port, tls, wsproto, update_cycle=50, update_batch=100, dumps=None, compress_threshold=1024 ):
+        lib.connection.Server.__init__(self, ip, port)
+        _websocketserver.__init__(self, smarthome, tls, wsproto, update_cycle, update_batch, dumps, compress_threshold)
+
+    def handle_connection(self):
+        sock, address = self.accept()
+        if sock is None:
+            return
+        if self.tls:
+            try:
+                # cert_reqs=ssl.CERT_REQUIRED
+                sock = ssl.wrap_socket(sock, server_side=True, cert_reqs=ssl.CERT_OPTIONAL, certfile=self.tls_crt, ca_certs=self.tls_ca, keyfile=self.tls_key, ssl_version=ssl.PROTOCOL_TLSv1)
+                self.logger.debug('Client cert: {0}'.format(sock.getpeercert()))
+                self.logger.debug('Cipher: {0}'.format(sock.cipher()))
+#               print ssl.OPENSSL_VERSION
+            except Exception as e:
+                self.logger.exception(e)
+                return
+        client = websockethandler(self._sh, self, sock, address, self.visu_items, self.visu_logics, self.proto)
+        self.clients.append(client)
+
+    def stop(self):
+        _websocketserver.stop(self)
+        self.close()
+
+
+#########################################################################
+
+class _asynciowebsocket(_websocketserver):
+    """
+    Websocket specific class of the Plugin using an asyncio event loop. Handles
+    the websocket connections with flow control of every client
+    """
+
+    def __init__(self, smarthome, ip, port, tls, wsproto, update_cycle=50, update_batch=100, dumps=None, compress_threshold=1024, write_buffer=65536 ):
+        _websocketserver.__init__(self, smarthome, tls, wsproto, update_cycle, update_batch, dumps, compress_threshold)
+        self.ip = ip
+        self.port = port
+        self.write_buffer = write_buffer
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = None
+
+    def run(self):
+        _websocketserver.run(self)
+        self._thread = threading.Thread(target=self._serve, name='VISU Websocket asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        _websocketserver.stop(self)
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+        try:
+            context = None
+            if self.tls:
                 try:
-                    client.json_send({'cmd': 'url', 'url': url})
-                except:
-                    pass
+                    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=self.tls_ca)
+                    context.load_cert_chain(self.tls_crt, self.tls_key)
+                    context.verify_mode = ssl.CERT_OPTIONAL
+                except Exception as e:
+                    self.logger.error("WebSocket: Cannot load the TLS certificate {0}: {1}".format(self.tls_crt, e))
+                    return
+            try:
+                self._server = self._loop.run_until_complete(self._loop.create_server(self._connection, self.ip, self.port, ssl=context))
+            except Exception as e:
+                self.logger.error("WebSocket: Cannot listen on {0}:{1}: {2}".format(self.ip, self.port, e))
+                return
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+        finally:
+            self._loop.close()
+
+    def _connection(self):
+        return asynciohandler(self._sh, self, self.visu_items, self.visu_logics, self.proto)
 
 
 #########################################################################
 
-class websockethandler(lib.connection.Stream):
+class _websocketclient:
     """
-    Websocket handler class of the Plugin. Each instance handles one client connection
+    Common part of the websocket handlers of the Plugin. Handles the protocol of one client connection
     """
 
-    def __init__(self, smarthome, dispatcher, sock, addr, items, logics, proto=4):
-        lib.connection.Stream.__init__(self, sock, addr)
+    def __init__(self, smarthome, dispatcher, addr, items, logics, proto=4):
         self.terminator = b"\r\n\r\n"
         self.logger = logging.getLogger(__name__)
         self._sh = smarthome
@@ -264,12 +497,15 @@ class websockethandler(lib.connection.Stream):
         self.header = {}
         self.monitor = {'item': [], 'rrd': [], 'log': []}
         self.monitor_id = {'item': 'item', 'rrd': 'item', 'log': 'name'}
-        self._update_series = {}
+        self.monitor_items = frozenset()
+        self.framing = None
+        self._fragments = None
+        self._compressed = False
+        self._decompressor = None
         self.items = items
         self.rrd = False
         self.log = False
         self.logs = smarthome.return_logs()
-        self._series_lock = threading.Lock()
         self.logics = logics
         self.proto = proto
         self.logger.info("VISU: Websocket handler uses protocol version {0}".format(self.proto))
@@ -278,13 +514,19 @@ class websockethandler(lib.connection.Stream):
         self.hostname = ''
         self.browser = ''
         self.browserversion = ''
+        self._pending = collections.OrderedDict()
+        self._pending_lock = threading.Lock()
+        self.congested = False
         
 
+    def monitors(self, event, data):
+        if event not in self.monitor:
+            return False
+        return data.get(self.monitor_id[event]) in self.monitor[event]
+
     def send_event(self, event, data):
         data = data.copy()  # don't filter the orignal data dict
-        if event not in self.monitor:
-            return
-        if data[self.monitor_id[event]] in self.monitor[event]:
+        if self.monitors(event, data):
             data['cmd'] = event
 #            self.logger.warning("VISU: send_event send to {0}: {1}".format(self.addr, data))
             self.json_send(data)
@@ -292,6 +534,14 @@ class websockethandler(lib.connection.Stream):
     def json_send(self, data):
         self.logger.debug("Visu: DUMMY send to {0}: {1}".format(self.addr, data))
 
+    def send_message(self, message, update=False):
+        if update and self.congested:  # replies to requests are always sent
+            return
+        if self.framing is None:
+            self.json_send(message.data)
+        else:
+            self.send(message.frame(self.framing))
+
     def handle_close(self):
         # remove circular references
         self._dp.remove_client(self)
@@ -300,33 +550,32 @@ class websockethandler(lib.connection.Stream):
         except:
             pass
 
-    def update(self, path, data, source):
-        if path in self.monitor['item']:
+    def update(self, path, value, source):
+        if path in self.monitor_items:
             if self.addr != source:
-#                self.logger.warning("VISU: update send to {0}: {1}, path={2}, source={3}".format(self.addr, data, path, source))
-                self.json_send(data)
+#                self.logger.warning("VISU: update send to {0}: {1}, path={2}, source={3}".format(self.addr, value, path, source))
+                # coalesce updates of the same item until the next flush
+                self._pending_lock.acquire()
+                self._pending[path] = value
+                flush = len(self._pending) >= self._dp.update_batch
+                self._pending_lock.release()
+                if flush:
+                    self.flush_items()
+            else:
+                # the client knows its own value, an older update must not overwrite it
+                self._pending_lock.acquire()
+                self._pending.pop(path, None)
+                self._pending_lock.release()
 
-    def update_series(self):
-        now = self._sh.now()
-        self._series_lock.acquire()
-        remove = []
-        for sid, series in self._update_series.items():
-            if series['update'] < now:
-                try:
-                    reply = self.items[series['params']['item']]['item'].series(**series['params'])
-                except Exception as e:
-                    self.logger.exception("Problem updating series for {0}: {1}".format(series['params'], e))
-                    remove.append(sid)
-                    continue
-                self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                del(reply['update'])
-                del(reply['params'])
-                if reply['series'] is not None:
-#                    self.logger.warning("Visu: update send to {0}: {1}".format(self.addr, reply))
-                    self.json_send(reply)
-        for sid in remove:
-            del(self._update_series[sid])
-        self._series_lock.release()
+    def flush_items(self):
+        if self.congested:  # keep coalescing the updates until the client reads again
+            return
+        self._pending_lock.acquire()
+        items = [[path, value] for path, value in self._pending.items()]
+        self._pending.clear()
+        self._pending_lock.release()
+        if items:
+            self.json_send({'cmd': 'item', 'items': items})
 
     def difference(self, a, b):
         return list(set(b).difference(set(a)))
@@ -361,6 +610,7 @@ class websockethandler(lib.connection.Stream):
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'item', 'items': items})))	# MSinn
             self.json_send({'cmd': 'item', 'items': items})
             self.monitor['item'] = data['items']
+            self._dp.subscribe(self, frozenset(path for path in data['items'] if path in self.items))
         elif command == 'ping':
             self.logger.debug("VISU json_parse: send to {0}: {1}".format(self.addr, ({'cmd': 'pong'})))
             self.json_send({'cmd': 'pong'})
@@ -404,9 +654,9 @@ class websockethandler(lib.connection.Stream):
                         self.logger.error("Problem fetching series for {0}: {1} - Wrong sqlite plugin?".format(path, e))
                     else:
                         if 'update' in reply:
-                            self._series_lock.acquire()
-                            self._update_series[reply['sid']] = {'update': reply['update'], 'params': reply['params']}
-                            self._series_lock.release()
+                            points = reply['series'] or []
+                            since = max(point[0] for point in points) if points else None
+                            self._dp.subscribe_series(self, reply['sid'], reply['update'], reply['params'], since)
                             del(reply['update'])
                             del(reply['params'])
                         if reply['series'] is not None:
@@ -415,6 +665,8 @@ class websockethandler(lib.connection.Stream):
                             self.logger.info("WebSocket: no entries for series {} {}".format(path, series))
                 else:
                     self.logger.warning("Client {0} requested invalid series: {1}.".format(self.addr, path))
+        elif command == 'series_cancel':
+            self._dp.unsubscribe_series(self, data['sid'])
         elif command == 'log':
             self.log = True
             name = data['name']
@@ -471,79 +723,94 @@ class websockethandler(lib.connection.Stream):
 
     def rfc6455_handshake(self):
         self.logger.debug("rfc6455 Handshake")
-        self.terminator = 8
+        self.terminator = 2
         self.found_terminator = self.rfc6455_parse
         self.json_send = self.rfc6455_send
+        self.framing = 'rfc6455'
         key = self.header[b'Sec-WebSocket-Key'] + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
         key = base64.b64encode(hashlib.sha1(key).digest()).decode()
+        extension = None
+        if self._dp.compress_threshold > 0 and b'Sec-WebSocket-Extensions' in self.header:
+            extension = rfc6455_deflate_offer(self.header[b'Sec-WebSocket-Extensions'].decode())
         self.send('HTTP/1.1 101 Switching Protocols\r\n'.encode())
         self.send('Upgrade: websocket\r\n'.encode())
         self.send('Connection: Upgrade\r\n'.encode())
         self.send('Sec-WebSocket-Accept: {0}\r\n'.format(key).encode())
+        if extension is not None:
+            self.logger.debug("rfc6455 Handshake: {0} uses {1}".format(self.addr, extension))
+            self.framing = 'rfc6455-deflate'
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.send('Sec-WebSocket-Extensions: {0}\r\n'.format(extension).encode())
         self.send('\r\n'.encode())
 
     def rfc6455_parse(self, data):
-        # fin = bit_set(data[0], 7)
-        # rsv1 = bit_set(data[0], 6)
-        # rsv2 = bit_set(data[0], 5)
-        # rsv1 = bit_set(data[0], 4)
-        opcode = data[0] & 0x0f
-        if opcode == 8:
-            self.logger.debug("WebSocket: closing connection to {0}.".format(self.addr))
-            self.close()
-            return
-        header = 2
+        data = bytes(data)
         masked = self.bit_set(data[1], 7)
+        length = data[1] & 0x7f
+        header = 2
         if masked:
             header += 4
-        length = data[1] & 0x7f
         if length == 126:
             header += 2
-            length = int.from_bytes(data[2:4], byteorder='big')
         elif length == 127:
             header += 8
+        if len(data) < header:  # header too short, read more
+            self.inbuffer = data + self.inbuffer
+            self.terminator = header
+            return
+        if length == 126:
+            length = int.from_bytes(data[2:4], byteorder='big')
+        elif length == 127:
             length = int.from_bytes(data[2:10], byteorder='big')
         read = header + length
         if len(data) < read:  # data too short, read more
             self.inbuffer = data + self.inbuffer
             self.terminator = read
             return
+        self.terminator = 2
         if masked:
-            key = data[header - 4:header]
-            payload = bytearray(data[header:])
-            for i in range(length):
-                payload[i] ^= key[i % 4]
+            payload = rfc6455_unmask(data[header:read], data[header - 4:header])
         else:
-            payload = data[header:]
-        self.json_parse(payload.decode())
-        self.terminator = 8
+            payload = data[header:read]
 
-    def rfc6455_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        header = bytearray(2)
-        header[0] = self.set_bit(header[0], 0)  # opcode text
-        header[0] = self.set_bit(header[0], 7)  # final
-        length = len(data)
-        if length < 126:
-            header[1] = length
-        elif length < ((1 << 16) - 1):
-            header[1] = 126
-            header += bytearray(length.to_bytes(2, byteorder='big'))
-        elif length < ((1 << 64) - 1):
-            header[1] = 127
-            header += bytearray(length.to_bytes(8, byteorder='big'))
+        fin = self.bit_set(data[0], 7)
+        compressed = self.bit_set(data[0], 6)
+        opcode = data[0] & 0x0f
+        if opcode == 8:
+            self.logger.debug("WebSocket: closing connection to {0}.".format(self.addr))
+            self.close()
+            return
+        elif opcode == 9:  # ping
+            self.send(rfc6455_frame(payload, opcode=0xa))
+            return
+        elif opcode == 0xa:  # pong
+            return
+        elif opcode == 0:  # continuation of a fragmented message
+            if self._fragments is None:
+                self.logger.debug("WebSocket: unexpected continuation frame from {0}.".format(self.addr))
+                return
+            self._fragments.append(payload)
         else:
-            self.logger.warning("data to big: {0}".format(data))
+            self._fragments = [payload]
+            self._compressed = compressed
+        if not fin:
             return
-        self.send(header + data.encode())
+
+        payload = b''.join(self._fragments)
+        self._fragments = None
+        if self._compressed:
+            if self._decompressor is None:
+                self.logger.warning("WebSocket: {0} sent compressed message without negotiation, closing connection.".format(self.addr))
+                self.close()
+                return
+            payload = self._decompressor.decompress(payload + b'\x00\x00\xff\xff')
+        self.json_parse(payload.decode())
+
+    def rfc6455_send(self, data):
+        self.send_message(_message(data, self._dp.dumps, self._dp.compress_threshold))
 
     def hixie76_send(self, data):
-        data = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        packet = bytearray()
-        packet.append(0x00)
-        packet.extend(data.encode())
-        packet.append(0xff)
-        self.send(packet)
+        self.send_message(_message(data, self._dp.dumps))
 
     def hixie76_parse(self, data):
         self.json_parse(data.decode().lstrip('\x00'))
@@ -568,11 +835,217 @@ class websockethandler(lib.connection.Stream):
         self.send(key.digest())
         self.found_terminator = self.hixie76_parse
         self.json_send = self.hixie76_send
+        self.framing = 'hixie76'
         self.terminator = b"\xff"
 
 
 #########################################################################
 
+class websockethandler(_websocketclient, lib.connection.Stream):
+    """
+    Websocket handler class of the Plugin. Each instance handles one client connection
+    """
+
+    def __init__(self, smarthome, dispatcher, sock, addr, items, logics, proto=4):
+        lib.connection.Stream.__init__(self, sock, addr)
+        _websocketclient.__init__(self, smarthome, dispatcher, addr, items, logics, proto)
+
+
+#########################################################################
+
+class asynciohandler(_websocketclient, asyncio.Protocol):
+    """
+    Websocket handler class of the Plugin for the asyncio server. Each instance
+    handles one client connection. Item updates are coalesced and series
+    updates dropped while more than write_buffer bytes are waiting to be sent
+    to the client, replies to requests are always sent. The connection is
+    closed if the client does not read the replies.
+    """
+
+    def __init__(self, smarthome, dispatcher, items, logics, proto=4):
+        _websocketclient.__init__(self, smarthome, dispatcher, '', items, logics, proto)
+        self.inbuffer = bytearray()
+        self.transport = None
+        self._requests = collections.deque()
+        self._requests_lock = threading.Lock()
+        self._parsing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=self._dp.write_buffer)
+        peer = transport.get_extra_info('peername')
+        self.addr = "{0}:{1}".format(peer[0], peer[1])
+        self._dp.clients.append(self)
+
+    def connection_lost(self, exc):
+        if self in self._dp.clients:
+            self.handle_close()
+
+    def pause_writing(self):
+        self.congested = True
+        self.logger.debug("VISU: Websocket client {0} is congested, dropping updates".format(self.addr))
+
+    def resume_writing(self):
+        self.congested = False
+        self.flush_items()
+
+    def data_received(self, data):
+        self.inbuffer = self.inbuffer + data
+        while self.transport is not None and not self.transport.is_closing():
+            if isinstance(self.terminator, int):
+                if len(self.inbuffer) < self.terminator:
+                    return
+                data = self.inbuffer[:self.terminator]
+                self.inbuffer = self.inbuffer[self.terminator:]
+            else:
+                index = self.inbuffer.find(self.terminator)
+                if index == -1:
+                    return
+                data = self.inbuffer[:index]
+                self.inbuffer = self.inbuffer[index + len(self.terminator):]
+            self.found_terminator(data)
+
+    def json_parse(self, data):
+        # requests (e.g. series queries) are handled by the executor of the
+        # event loop one after another, so they don't block the other clients
+        with self._requests_lock:
+            self._requests.append(data)
+            if self._parsing:
+                return
+            self._parsing = True
+        self._dp._loop.run_in_executor(None, self._parse_requests)
+
+    def _parse_requests(self):
+        while True:
+            with self._requests_lock:
+                if not self._requests:
+                    self._parsing = False
+                    return
+                data = self._requests.popleft()
+            try:
+                _websocketclient.json_parse(self, data)
+            except Exception as e:
+                self.logger.warning("VISU: Problem handling request {0} from {1}: {2}".format(repr(data), self.addr, e))
+
+    def send(self, data):
+        self._dp._loop.call_soon_threadsafe(self._write, bytes(data))
+        return True
+
+    def _write(self, data):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.transport.get_write_buffer_size() > 4 * self._dp.write_buffer:
+            self.logger.warning("VISU: Websocket client {0} does not read, closing connection".format(self.addr))
+            self.transport.abort()
+            return
+        self.transport.write(data)
+
+    def close(self):
+        if self.transport is not None:
+            self._dp._loop.call_soon_threadsafe(self.transport.close)
+
+
+#########################################################################
+
+def rfc6455_frame(payload, opcode=0x1, compressed=False):
+    """
+    Returns a final websocket frame (text by default) containing the payload
+    """
+    first = 0x80 | opcode
+    if compressed:
+        first |= 0x40
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length < (1 << 16):
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + payload
+
+
+def rfc6455_deflate_frame(payload, threshold):
+    """
+    Returns a websocket frame compressed by permessage-deflate (RFC 7692)
+    if the payload is at least threshold bytes long
+    """
+    if len(payload) < threshold:
+        return rfc6455_frame(payload)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return rfc6455_frame(payload[:-4], compressed=True)
+
+
+def rfc6455_deflate_offer(extensions):
+    """
+    Returns the response to the first acceptable permessage-deflate offer
+    of the Sec-WebSocket-Extensions header or None.
+    Messages are compressed without context takeover, so a compressed
+    frame can be sent to every client.
+    """
+    for offer in extensions.split(','):
+        params = [param.strip() for param in offer.split(';')]
+        if params[0] != 'permessage-deflate':
+            continue
+        accept = True
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            name = name.strip()
+            value = value.strip().strip('"')
+            if name == 'server_max_window_bits':
+                accept = accept and value == '15'
+            elif name not in ('server_no_context_takeover', 'client_no_context_takeover', 'client_max_window_bits'):
+                accept = False
+        if accept:
+            return 'permessage-deflate; server_no_context_takeover'
+    return None
+
+
+def rfc6455_unmask(payload, key):
+    """
+    Unmasks the payload of a client frame by XOR of the whole payload
+    """
+    length = len(payload)
+    mask = (key * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, byteorder='big') ^ int.from_bytes(mask, byteorder='big')).to_bytes(length, byteorder='big')
+
+
+def hixie76_frame(payload):
+    return b'\x00' + payload + b'\xff'
+
+
+class _message:
+    """
+    Message sent to several clients, the data is serialized and framed only
+    once per websocket protocol
+    """
+    def __init__(self, data, dumps, threshold=0):
+        self.data = data
+        self._dumps = dumps
+        self._threshold = threshold
+        self._payload = None
+        self._frames = {}
+
+    def payload(self):
+        if self._payload is None:
+            self._payload = self._dumps(self.data)
+        return self._payload
+
+    def frame(self, framing):
+        if framing not in self._frames:
+            if framing == 'rfc6455-deflate':
+                self._frames[framing] = rfc6455_deflate_frame(self.payload(), self._threshold)
+            elif framing == 'hixie76':
+                self._frames[framing] = hixie76_frame(self.payload())
+            else:
+                self._frames[framing] = rfc6455_frame(self.payload())
+        return self._frames[framing]
+
+
+def json_dumps(data):
+    return json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()
+
+
 class JSONEncoder(json.JSONEncoder):
 
     def default(self, obj):
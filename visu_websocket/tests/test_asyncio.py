@@ -0,0 +1,159 @@
+import json
+import os
+import socket
+import struct
+import time
+import unittest
+
+import common
+from plugins.visu_websocket import _asynciowebsocket
+from tests.mock.core import MockSmartHome
+
+class Item:
+
+    def __init__(self, value=0, delay=0):
+        self.value = value
+        self.delay = delay
+
+    def __call__(self, value=None, caller=None, source=None):
+        if value is not None:
+            self.value = value
+        return self.value
+
+    def series(self, func, start, end='now', count=100):
+        time.sleep(self.delay)
+        return {'cmd': 'series', 'series': [[0, self.value]], 'sid': 'slow'}
+
+class Client:
+    """ Websocket client of the tests """
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.sock.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                          b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+        self.buffer = b''
+        while b'\r\n\r\n' not in self.buffer:
+            self.buffer += self.sock.recv(4096)
+        self.buffer = self.buffer[self.buffer.index(b'\r\n\r\n') + 4:]
+
+    def send(self, data):
+        payload = json.dumps(data).encode()
+        key = os.urandom(4)
+        masked = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        self.sock.sendall(struct.pack('!BB', 0x81, 0x80 | len(payload)) + key + masked)
+
+    def read(self, length):
+        while len(self.buffer) < length:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        data = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return data
+
+    def receive(self, timeout=5):
+        self.sock.settimeout(timeout)
+        header = self.read(2)
+        length = header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read(8))[0]
+        return json.loads(self.read(length).decode())
+
+    def close(self):
+        self.sock.close()
+
+class TestVisuWebsocketAsyncio(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _asynciowebsocket(MockSmartHome(), '127.0.0.1', 0, False, 4, update_cycle=0, write_buffer=65536)
+        self.server.visu_items = {'slow': {'acl': 'rw', 'item': Item(1, delay=0.5)}, 'fast': {'acl': 'rw', 'item': Item(2)}}
+        self.server.run()
+        for i in range(100):
+            if self.server._server is not None:
+                break
+            time.sleep(0.01)
+        self.port = self.server._server.sockets[0].getsockname()[1]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.server._thread.join(5)
+
+    def client(self):
+        client = Client(self.port)
+        self.clients.append(client)
+        return client
+
+    def wait_clients(self, count):
+        for i in range(100):
+            if len(self.server.clients) == count:
+                return
+            time.sleep(0.01)
+
+    def test_slow_request_does_not_block_other_clients(self):
+        a = self.client()
+        b = self.client()
+        a.send({'cmd': 'series', 'item': 'slow', 'series': 'avg', 'start': '1h'})
+        time.sleep(0.05)
+        start = time.time()
+        b.send({'cmd': 'ping'})
+        self.assertEqual({'cmd': 'pong'}, b.receive())
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual([[0, 1]], a.receive()['series'])
+
+    def test_requests_of_one_client_are_answered_in_order(self):
+        a = self.client()
+        a.send({'cmd': 'series', 'item': 'slow', 'series': 'avg', 'start': '1h'})
+        a.send({'cmd': 'ping'})
+        self.assertEqual('series', a.receive()['cmd'])
+        self.assertEqual('pong', a.receive()['cmd'])
+
+    def test_congested_client_gets_replies(self):
+        a = self.client()
+        a.send({'cmd': 'monitor', 'items': ['fast']})
+        self.assertEqual({'cmd': 'item', 'items': [['fast', 2]]}, a.receive())
+        self.wait_clients(1)
+        handler = self.server.clients[0]
+        self.server._loop.call_soon_threadsafe(handler.pause_writing)
+        time.sleep(0.05)
+        # item updates are dropped, replies to requests are sent
+        self.server.update_item('fast', 3, 'other')
+        a.send({'cmd': 'monitor', 'items': ['fast']})
+        self.assertEqual({'cmd': 'item', 'items': [['fast', 2]]}, a.receive())
+        a.send({'cmd': 'ping'})
+        self.assertEqual({'cmd': 'pong'}, a.receive())
+        # coalesced updates are sent when the client reads again
+        handler.update('fast', 4, 'other')
+        handler.update('fast', 5, 'other')
+        self.server._loop.call_soon_threadsafe(handler.resume_writing)
+        self.assertEqual({'cmd': 'item', 'items': [['fast', 5]]}, a.receive())
+
+class TestVisuWebsocketAsyncioStart(unittest.TestCase):
+
+    def test_missing_certificate_is_logged(self):
+        server = _asynciowebsocket(MockSmartHome(), '127.0.0.1', 0, True, 4, update_cycle=0)
+        server.tls_crt = server.tls_key = server.tls_ca = '/nonexistent/home.crt'
+        with self.assertLogs('plugins.visu_websocket', 'ERROR') as logs:
+            server.run()
+            server._thread.join(5)
+        self.assertFalse(server._thread.is_alive())
+        self.assertIn('TLS certificate', logs.output[0])
+        self.assertTrue(server._loop.is_closed())
+        server.stop()
+
+    def test_listen_error_closes_loop(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        self.addCleanup(sock.close)
+        server = _asynciowebsocket(MockSmartHome(), '127.0.0.1', sock.getsockname()[1], False, 4, update_cycle=0)
+        with self.assertLogs('plugins.visu_websocket', 'ERROR'):
+            server.run()
+            server._thread.join(5)
+        self.assertTrue(server._loop.is_closed())
+        server.stop()
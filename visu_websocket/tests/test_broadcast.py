@@ -0,0 +1,82 @@
+import datetime
+import time
+import unittest
+
+import common
+from plugins.visu_websocket import WebSocket, _message, json_dumps, rfc6455_frame
+from tests.mock.core import MockSmartHome
+
+class Client:
+
+    def __init__(self, framing='rfc6455'):
+        self.framing = framing
+        self.sent = 0
+
+    def send_message(self, message, update=False):
+        self.send(message.frame(self.framing))
+
+    def json_send(self, data):
+        self.send(rfc6455_frame(json_dumps(data)))
+
+    def send(self, data):
+        self.sent += len(data)
+
+class TestVisuWebsocketBroadcast(unittest.TestCase):
+
+    def test_rfc6455_frame(self):
+        self.assertEqual(b'\x81\x02{}', rfc6455_frame(b'{}'))
+        self.assertEqual(b'\x81\x7e\x00\x7e', rfc6455_frame(b'x' * 126)[:4])
+        self.assertEqual(b'\x81\x7f\x00\x00\x00\x00\x00\x01\x00\x00', rfc6455_frame(b'x' * (1 << 16))[:10])
+
+    def test_json_dumps(self):
+        self.assertEqual(b'{"cmd":"item","items":[["a","2017-01-01T12:00:00"]]}', json_dumps({'cmd': 'item', 'items': [['a', datetime.datetime(2017, 1, 1, 12)]]}))
+
+    def test_orjson_backend_like_json(self):
+        try:
+            import orjson
+        except ImportError:
+            self.skipTest("orjson not installed")
+        plugin = WebSocket(MockSmartHome(), json_backend='orjson')
+        self.assertIsNot(json_dumps, plugin.websocket.dumps)
+        tz = datetime.timezone(datetime.timedelta(hours=1))
+        data = {'cmd': 'proto', 'ver': 4, 'items': [
+            ['a', datetime.datetime(2017, 1, 1, 12, 0, 0, 123456)],
+            ['b', datetime.datetime(2017, 1, 1, 12, tzinfo=tz)],
+            ['c', datetime.date(2017, 1, 1)],
+            ['d', datetime.time(12, 30)],
+            ['e', 1.5]
+        ]}
+        self.assertEqual(json_dumps(data), plugin.websocket.dumps(data))
+
+    def test_message_serialized_once(self):
+        calls = []
+        def dumps(data):
+            calls.append(data)
+            return json_dumps(data)
+        message = _message({'cmd': 'dialog', 'header': 'h', 'content': 'c'}, dumps)
+        for client in [Client(), Client(), Client('hixie76')]:
+            client.send_message(message)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(b'\x00{"cmd":"dialog","header":"h","content":"c"}\xff', message.frame('hixie76'))
+
+    def test_broadcast_benchmark(self):
+        """ Compare updates per second sending 1000 item updates to 50 clients
+            serialized per client and serialized once
+        """
+        clients = [Client() for i in range(50)]
+        updates = [{'cmd': 'item', 'items': [['item.{}'.format(i), i * 0.5]]} for i in range(1000)]
+
+        start = time.time()
+        for data in updates:
+            for client in clients:
+                client.json_send(data)
+        duration = time.time() - start
+        print("{:>10}: {:>10.0f} updates/s".format('per client', len(updates) / duration))
+
+        start = time.time()
+        for data in updates:
+            message = _message(data, json_dumps)
+            for client in clients:
+                client.send_message(message)
+        duration = time.time() - start
+        print("{:>10}: {:>10.0f} updates/s".format('shared', len(updates) / duration))
@@ -0,0 +1,30 @@
+import unittest
+import zlib
+
+import common
+from plugins.visu_websocket import rfc6455_deflate_frame, rfc6455_deflate_offer, rfc6455_unmask
+
+class TestVisuWebsocketRfc6455(unittest.TestCase):
+
+    def test_unmask(self):
+        key = b'\x01\x02\x03\x04'
+        payload = b'{"cmd":"ping"}'
+        masked = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        self.assertEqual(payload, rfc6455_unmask(masked, key))
+        self.assertEqual(b'', rfc6455_unmask(b'', key))
+
+    def test_deflate_frame_below_threshold(self):
+        self.assertEqual(b'\x81\x02{}', rfc6455_deflate_frame(b'{}', 1024))
+
+    def test_deflate_frame(self):
+        payload = b'{"cmd":"item","items":[' + b','.join(b'["item",1]' for i in range(200)) + b']}'
+        frame = rfc6455_deflate_frame(payload, 1024)
+        self.assertEqual(0xc1, frame[0])
+        self.assertLess(len(frame), len(payload))
+        self.assertEqual(payload, zlib.decompressobj(-zlib.MAX_WBITS).decompress(frame[2:] + b'\x00\x00\xff\xff'))
+
+    def test_deflate_offer(self):
+        self.assertEqual('permessage-deflate; server_no_context_takeover', rfc6455_deflate_offer('permessage-deflate; client_max_window_bits'))
+        self.assertEqual('permessage-deflate; server_no_context_takeover', rfc6455_deflate_offer('permessage-deflate; server_max_window_bits=10, permessage-deflate'))
+        self.assertEqual(None, rfc6455_deflate_offer('permessage-deflate; server_max_window_bits=10'))
+        self.assertEqual(None, rfc6455_deflate_offer('x-webkit-deflate-frame'))
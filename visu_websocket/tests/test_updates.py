@@ -0,0 +1,152 @@
+import datetime
+import unittest
+
+import common
+from plugins.visu_websocket import _websocketclient, _websocketserver
+from tests.mock.core import MockSmartHome
+
+class Client(_websocketclient):
+
+    def __init__(self, sh, server, addr, items):
+        _websocketclient.__init__(self, sh, server, addr, items, {})
+        self.sent = []
+        server.clients.append(self)
+
+    def json_send(self, data):
+        self.sent.append(data)
+
+class Item:
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+        self.calls = 0
+        self.points = None
+
+    def __call__(self, value=None, caller=None, source=None):
+        return self.value
+
+    def series(self, func, start, end='now', count=100, update=False, sid=None, item=None, step=None):
+        self.calls += 1
+        sid = self.name + '|' + func
+        points = [[self.calls, self.value]] if self.points is None else self.points
+        return {'cmd': 'series', 'series': points, 'sid': sid,
+                'params': {'func': func, 'start': start, 'end': end, 'count': count, 'sid': sid, 'item': self.name, 'update': True},
+                'update': datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=1)}
+
+class TestVisuWebsocketUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.sh = MockSmartHome()
+        self.server = _websocketserver(self.sh, False, 4, update_cycle=50, update_batch=3)
+        self.items = {name: {'acl': 'rw', 'item': Item(name)} for name in ('a', 'b', 'c', 'd')}
+        self.server.visu_items = self.items
+
+    def client(self, addr, items):
+        client = Client(self.sh, self.server, addr, self.items)
+        self.server.subscribe(client, frozenset(items))
+        return client
+
+    def test_coalesce_until_flush(self):
+        client = self.client('1.1.1.1:1', ['a', 'b'])
+        self.server.update_item('a', 1, 'x')
+        self.server.update_item('b', 1, 'x')
+        self.server.update_item('a', 2, 'x')
+        self.assertEqual([], client.sent)
+        client.flush_items()
+        self.assertEqual([{'cmd': 'item', 'items': [['a', 2], ['b', 1]]}], client.sent)
+        client.flush_items()
+        self.assertEqual(1, len(client.sent))
+
+    def test_flush_full_batch(self):
+        client = self.client('1.1.1.1:1', ['a', 'b', 'c', 'd'])
+        for path in ('a', 'b', 'c'):
+            self.server.update_item(path, 1, 'x')
+        self.assertEqual([{'cmd': 'item', 'items': [['a', 1], ['b', 1], ['c', 1]]}], client.sent)
+
+    def test_own_update_drops_pending_value(self):
+        client = self.client('1.1.1.1:1', ['a'])
+        self.server.update_item('a', 1, 'other')
+        self.server.update_item('a', 2, '1.1.1.1:1')
+        client.flush_items()
+        self.assertEqual([], client.sent)
+        self.server.update_item('a', 3, 'other')
+        client.flush_items()
+        self.assertEqual([{'cmd': 'item', 'items': [['a', 3]]}], client.sent)
+
+    def test_congested_client_coalesces(self):
+        client = self.client('1.1.1.1:1', ['a'])
+        client.congested = True
+        self.server.update_item('a', 1, 'x')
+        client.flush_items()
+        self.server.update_item('a', 2, 'x')
+        self.assertEqual([], client.sent)
+        client.congested = False
+        client.flush_items()
+        self.assertEqual([{'cmd': 'item', 'items': [['a', 2]]}], client.sent)
+
+    def test_subscriptions_by_item(self):
+        first = self.client('1.1.1.1:1', ['a', 'b'])
+        second = self.client('1.1.1.2:1', ['b'])
+        self.assertEqual({'a': {first}, 'b': {first, second}}, self.server.subscriptions)
+        self.server.subscribe(first, frozenset(['c']))
+        self.assertEqual({'b': {second}, 'c': {first}}, self.server.subscriptions)
+        self.server.remove_client(second)
+        self.assertEqual({'c': {first}}, self.server.subscriptions)
+        self.server.update_item('b', 1, 'x')
+        first.flush_items()
+        self.assertEqual([], first.sent)
+
+    def test_series_shared_by_clients(self):
+        first = self.client('1.1.1.1:1', [])
+        second = self.client('1.1.1.2:1', [])
+        for client in (first, second):
+            client.json_parse('{"cmd": "series", "item": "a", "series": "avg", "start": "1h"}')
+        self.assertEqual(1, len(self.server.series))
+        item = self.items['a']['item']
+        calls = item.calls
+        self.server._update_series()
+        self.assertEqual(calls + 1, item.calls)
+        self.assertEqual(first.sent[-1], second.sent[-1])
+        self.server.unsubscribe_series(first)
+        self.server.unsubscribe_series(second)
+        self.assertEqual({}, self.server.series)
+
+    def test_series_later_client_gets_tail(self):
+        first = self.client('1.1.1.1:1', [])
+        second = self.client('1.1.1.2:1', [])
+        item = self.items['a']['item']
+        item.points = [[1, 0], [2, 0]]
+        first.json_parse('{"cmd": "series", "item": "a", "series": "avg", "start": "1h"}')
+        item.points = [[2, 0], [3, 0]]
+        self.server._update_series()
+        item.points = [[1, 0], [4, 0]]
+        second.json_parse('{"cmd": "series", "item": "a", "series": "avg", "start": "1h"}')
+        item.points = [[3, 0], [4, 0], [5, 0]]
+        self.server._update_series()
+        self.assertEqual([[3, 0], [4, 0], [5, 0]], first.sent[-1]['series'])
+        self.assertEqual([[4, 0], [5, 0]], second.sent[-1]['series'])
+
+    def test_series_window_of_later_client(self):
+        first = self.client('1.1.1.1:1', [])
+        second = self.client('1.1.1.2:1', [])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.server.subscribe_series(first, 'a|avg', now, {'func': 'avg', 'start': 2000}, 2000)
+        # the reply of the second client was queried before the last update
+        self.server.subscribe_series(second, 'a|avg', now, {'func': 'avg', 'start': 1000}, 1000)
+        self.assertEqual(1000, self.server.series['a|avg']['params']['start'])
+        self.assertEqual({first: 2000, second: 1000}, self.server.series['a|avg']['clients'])
+
+    def test_series_cancel(self):
+        first = self.client('1.1.1.1:1', [])
+        second = self.client('1.1.1.2:1', [])
+        for client in (first, second):
+            client.json_parse('{"cmd": "series", "item": "a", "series": "avg", "start": "1h"}')
+        sid = list(self.server.series)[0]
+        first.json_parse('{"cmd": "series_cancel", "sid": "%s"}' % sid)
+        self.assertEqual([second], list(self.server.series[sid]['clients']))
+        sent = len(first.sent)
+        self.server._update_series()
+        self.assertEqual(sent, len(first.sent))
+        second.json_parse('{"cmd": "series_cancel", "sid": "%s"}' % sid)
+        self.assertEqual({}, self.server.series)